@@ -2,6 +2,16 @@
 #  All rights reserved; available under the terms of the BSD License.
 """
 
+Status: Unmaintained
+====================
+
+.. image:: http://unmaintained.tech/badge.svg
+     :target: http://unmaintained.tech/
+     :alt: No Maintenance Intended
+
+I am `no longer actively maintaining this project <https://rfk.id.au/blog/entry/archiving-open-source-projects/>`_.
+
+
 myppy:  make you a portable python
 ==================================
 
@@ -56,6 +66,97 @@ and you can install them using e.g.::
 This would build and install a custom wxPython version that is patched to 
 be more portable.
 
+Recipes that don't depend on each other can be built in parallel.  Set the
+MYPPY_BUILD_JOBS environment variable to the number of builds to run at once::
+
+    #> MYPPY_BUILD_JOBS=8 myppy PATH/TO/ENV init
+
+Set MYPPY_MAKE_JOBS to let make run several jobs at once within each build.
+All the builds share a single GNU make jobserver, so no more than that many
+jobs will be running in total however many recipes are being built.
+
+Set MYPPY_FETCH_JOBS to download all the required source files in the
+background while the first recipes are building.  You can also populate the
+download cache ahead of time using e.g.::
+
+    #> myppy PATH/TO/ENV fetch py_wxpython
+
+Downloads are kept in a cache shared by all your envs, in ~/.cache/myppy
+by default; set the MYPPY_DOWNLOAD_CACHE environment variable to use some
+other directory, e.g. one shared by all users.  Files in the cache are stored
+by the hash of their contents, so different files with the same name can't
+get mixed up.  Set MYPPY_DOWNLOAD_CACHE_SIZE (e.g. to "4G") to limit its
+size; the least recently used files will be removed to make room.
+Interrupted downloads are resumed where they left off, and big files can
+be downloaded in several parallel pieces by setting MYPPY_DOWNLOAD_SEGMENTS.
+
+Source archives are unpacked once (using pigz, pbzip2 or lbzip2 if they're
+installed) and the pristine trees kept in the env's cache, so unpacking the
+same archive again just clones the tree using reflinks or hardlinks.
+Set MYPPY_RECOMPRESS to "zstd", "lz4" or "tar" to also keep a copy of each
+gzipped or bzipped tarball in the download cache in that format, which is
+much faster to unpack.
+
+Source files can also be fetched from mirrors, by setting MYPPY_MIRRORS to
+a file (or a semicolon-separated string) of lines like this::
+
+    http://get.qt.nokia.com/qt/source/  /mnt/mirror/qt/  http://my.host/qt/
+
+Each mirror can be a URL or a local directory.  Local directories that have
+the file are always used first.  Otherwise the mirrors are probed when first
+used, and each download goes to the fastest one that works, falling back to
+the original URL if all the mirrors fail.
+
+To build on a machine without internet access, bundle up all the source files
+needed for some recipes into a single file, then load them into the download
+cache on the other machine::
+
+    #> myppy PATH/TO/ENV bundle-sources py_wxpython -o sources.tar
+    #> myppy PATH/TO/OTHER/ENV import-sources sources.tar
+
+The files installed by each recipe are also kept in an artifact cache, under
+a key made from the recipe's code, its sources, its compiler flags and the
+keys of its dependencies.  If the same recipe is installed again with nothing
+changed, it's unpacked from the cache instead of being fetched and built.
+The cache lives in the env's "cache" directory unless MYPPY_ARTIFACT_CACHE
+names another one; set it to an empty string to turn the cache off.  To
+share builds between machines, point it at a shared directory or at the URL
+of an HTTP server that accepts PUT requests (such as nginx with WebDAV)::
+
+    #> MYPPY_ARTIFACT_CACHE=http://my.host/myppy/ myppy PATH/TO/ENV init
+
+Artifacts are checked against their recorded sha256 hash before use, and
+"init" finishes with a report of which recipes were found in the cache.
+The build keys include the env's location, so envs sharing a cache should
+all be built at the same path.
+
+On linux, set MYPPY_CCACHE_DIR to compile everything through `ccache`_ using
+a cache in that directory, which can be shared by all the envs on a machine.
+This makes rebuilding a recipe after a small change much faster, and the
+number of cache hits is printed after each recipe is built.
+
+The build key of each recipe is also recorded when it's installed.  If you
+change a recipe (say, to patch lib_openssl) then the "update" command will
+rebuild it, along with every installed recipe that depends on it::
+
+    #> myppy PATH/TO/ENV update
+
+To check that every binary in an env will run on older linux systems, use
+the "audit" command.  It prints a JSON report of the newest glibc symbol
+versions needed by each binary, along with any libraries that can't be
+found, and exits with an error status if there were problems.  The limits
+can be given on the command-line, e.g.::
+
+    #> myppy PATH/TO/ENV audit GLIBC_2.5 GLIBCXX_3.4.9
+
+Big recipes often install shared libraries that your app never loads.  The
+"libdeps" command shows which libraries are reachable from a given set of
+binaries (or from all the non-library binaries in the env), and "export"
+makes a copy of the env without the unused ones::
+
+    #> myppy PATH/TO/ENV libdeps local/bin/python py_pyside
+    #> myppy PATH/TO/ENV export PATH/TO/SMALLER/ENV local/bin/python py_pyside
+
 
 Using a myppy environment
 -------------------------
@@ -105,6 +206,8 @@ References
 
 .. _esky:   http://pypi.python.org/pypi/esky/
 
+.. _ccache:   http://ccache.dev/
+
 .. _signedimp:   http://pypi.python.org/pypi/signedimp/
 
 
@@ -118,7 +221,9 @@ __ver_tuple__ = (__ver_major__,__ver_minor__,__ver_patch__,__ver_sub__)
 __version__ = "%d.%d.%d%s" % __ver_tuple__
 
 
+import os
 import sys
+import json
 import subprocess
 
 if sys.platform == "darwin":
@@ -130,6 +235,8 @@ elif sys.platform == "win32":
 else:
     raise ImportError("myppy not available on platform %r" % (sys.platform,))
 
+from myppy.libgraph import LibraryGraph
+
 
 
 def main(argv):
@@ -149,12 +256,12 @@ def main(argv):
         print "commands:"
         maxcmdlen = max(len(cls.__name__) for cls in _cmd.__subclasses__())
         for cls in _cmd.__subclasses__():
-            nm = cls.__name__[1:]
+            nm = cls.__name__[1:].replace("_","-")
             padding = " " * (maxcmdlen - len(nm)) + " "
             print "           ", nm+":", padding, cls.__doc__
         return 0
     try:
-        cmd = globals()["_"+cmd]
+        cmd = globals()["_"+cmd.replace("-","_")]
     except KeyError:
         print "Unknown command:", cmd
         return 1
@@ -191,8 +298,33 @@ class _install(_cmd):
     def run(target,args):
         for arg in args:
             target.load_recipe(arg)
+        target.install_recipes(args)
+
+class _fetch(_cmd):
+    """download the sources for recipes and their deps"""
+    @staticmethod
+    def run(target,args):
+        for arg in args:
+            target.load_recipe(arg)
+        target.fetch_recipes(args)
+
+class _bundle_sources(_cmd):
+    """bundle sources for recipes and their deps into the file given by -o"""
+    @staticmethod
+    def run(target,args):
+        assert "-o" in args and args.index("-o") == len(args) - 2
+        bundle = args[-1]
+        recipes = args[:-2]
+        for arg in recipes:
+            target.load_recipe(arg)
+        target.bundle_sources(recipes,bundle)
+
+class _import_sources(_cmd):
+    """load a source bundle into the download cache"""
+    @staticmethod
+    def run(target,args):
         for arg in args:
-            target.install(arg)
+            target.import_sources(arg)
 
 class _uninstall(_cmd):
     """uninstall recipes from the env"""
@@ -207,10 +339,15 @@ class _reinstall(_cmd):
     def run(target,args):
         for arg in args:
             target.load_recipe(arg)
-        for arg in args:
-            target.uninstall(arg)
-        for arg in args:
-            target.install(arg)
+        target.uninstall_recipes(args)
+        target.install_recipes(args)
+
+class _update(_cmd):
+    """rebuild recipes that have changed, and everything depending on them"""
+    @staticmethod
+    def run(target,args):
+        assert not args
+        target.update()
 
 class _shell(_cmd):
     """start an interactive shell inside env"""
@@ -232,6 +369,46 @@ class _do(_cmd):
         except subprocess.CalledProcessError, e:
             return e.returncode
 
+class _audit(_cmd):
+    """check binaries in the env for portability problems"""
+    @staticmethod
+    def run(target,args):
+        #  Only envs that know how to inspect their binaries can audit them.
+        if not hasattr(target,"audit"):
+            print "AUDIT IS NOT SUPPORTED ON THIS PLATFORM"
+            return 1
+        for arg in args:
+            target.set_version_limit(arg)
+        report = target.audit()
+        print json.dumps(report,indent=2,sort_keys=True)
+        if report["failures"]:
+            return 1
+
+class _libdeps(_cmd):
+    """show which libraries are needed by the given binaries"""
+    @staticmethod
+    def run(target,args):
+        graph = LibraryGraph(target)
+        unused = graph.get_unused(graph.get_entry_points(args))
+        total = 0
+        for relpath in sorted(graph.files):
+            if graph.is_library(relpath):
+                recipe = graph.recipes[relpath]
+                if relpath in unused:
+                    print "UNUSED", relpath, "(%s)" % (recipe,)
+                    total += os.path.getsize(graph.files[relpath].path)
+                else:
+                    print "NEEDED", relpath, "(%s)" % (recipe,)
+        print "UNUSED LIBRARIES TOTAL", total, "BYTES"
+
+class _export(_cmd):
+    """copy the env, leaving out libraries not needed by the given binaries"""
+    @staticmethod
+    def run(target,args):
+        assert args
+        graph = LibraryGraph(target)
+        graph.export(args[0],graph.get_entry_points(args[1:]))
+
 class _record(_cmd):
     """record files installed by hand"""
     @staticmethod
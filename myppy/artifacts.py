@@ -0,0 +1,248 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.artifacts:  cache the files installed by each recipe build
+
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import json
+import errno
+import socket
+import shutil
+import httplib
+import tarfile
+import urllib
+import urllib2
+import traceback
+from StringIO import StringIO
+
+from myppy import util
+from myppy import unpack
+from myppy.download import Downloader
+
+
+def get_artifact_store(spec):
+    """Get the ArtifactStore for the given URL or directory."""
+    if spec.startswith(("http://","https://",)):
+        return HTTPArtifactStore(spec)
+    if spec.startswith("file://"):
+        spec = urllib.url2pathname(spec[len("file://"):])
+    return LocalArtifactStore(spec)
+
+
+class ArtifactStore(object):
+    """Somewhere to keep artifacts, as a flat collection of named files.
+
+    Subclasses must make each write() atomic, so that nobody ever reads a
+    partly-written file; there's no need for locking beyond that.
+    """
+
+    def read(self,name,fOut):
+        """Copy the named file into fOut, returning False if it's missing."""
+        raise NotImplementedError
+
+    def write(self,name,fIn):
+        """Store the contents of the seekable file object fIn under a name."""
+        raise NotImplementedError
+
+    def get_path(self,name):
+        """Get a local path for the named file, or None if there isn't one."""
+        return None
+
+
+class LocalArtifactStore(ArtifactStore):
+    """ArtifactStore in a local (possibly network-mounted) directory."""
+
+    def __init__(self,dirpath):
+        self.dirpath = dirpath
+
+    def read(self,name,fOut):
+        try:
+            fIn = open(os.path.join(self.dirpath,name),"rb")
+        except EnvironmentError, e:
+            if e.errno not in (errno.ENOENT,):
+                raise
+            return False
+        try:
+            shutil.copyfileobj(fIn,fOut,1024 * 512)
+        finally:
+            fIn.close()
+        return True
+
+    def write(self,name,fIn):
+        if not os.path.isdir(self.dirpath):
+            try:
+                os.makedirs(self.dirpath)
+            except EnvironmentError, e:
+                if e.errno not in (errno.EEXIST,):
+                    raise
+        path = os.path.join(self.dirpath,name)
+        #  The dir may be shared between machines, so the pid isn't enough.
+        tmpfile = "%s.tmp-%s-%d" % (path,socket.gethostname(),os.getpid(),)
+        try:
+            with open(tmpfile,"wb") as fOut:
+                shutil.copyfileobj(fIn,fOut,1024 * 512)
+            os.rename(tmpfile,path)
+        except Exception:
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+            raise
+
+    def get_path(self,name):
+        path = os.path.join(self.dirpath,name)
+        if not os.path.isfile(path):
+            return None
+        return path
+
+
+class HTTPArtifactStore(ArtifactStore):
+    """ArtifactStore on a plain HTTP server, using GET and PUT requests.
+
+    The server is trusted to make each PUT atomic, which e.g. nginx's
+    WebDAV module does by writing into a temporary file.
+
+    Requests that take longer than the timeout (TIMEOUT seconds by default)
+    fail with socket.timeout, so an unresponsive server just means misses.
+    """
+
+    TIMEOUT = 30
+
+    def __init__(self,baseurl,timeout=None):
+        if not baseurl.endswith("/"):
+            baseurl += "/"
+        if timeout is None:
+            timeout = self.TIMEOUT
+        self.baseurl = baseurl
+        self.downloader = Downloader(timeout)
+
+    def read(self,name,fOut):
+        try:
+            self.downloader.download(self.baseurl + name,fOut)
+        except urllib2.HTTPError, e:
+            if e.code not in (404,):
+                raise
+            return False
+        return True
+
+    def write(self,name,fIn):
+        fIn.seek(0,os.SEEK_END)
+        size = fIn.tell()
+        fIn.seek(0)
+        self.downloader.upload(self.baseurl + name,fIn,size)
+
+
+class ArtifactCache(object):
+    """A cache of the files installed by recipe builds.
+
+    Each artifact is a gzipped tarball of the files that one build of a
+    recipe installed into an env, with paths relative to the env root.  It's
+    stored under a key identifying everything that went into the build, so
+    that an identical build can be installed by just unpacking the tarball.
+
+    For each key the store holds a small JSON file giving the sha256 hash
+    and size of the tarball, which is itself stored under a name including
+    that hash.  The tarball is always written before the JSON file and is
+    checked against it when read, so concurrent publishers of the same key
+    can't corrupt each other's artifacts, and nor can a half-written file.
+    Any problem reading from the store is treated as a cache miss.
+    """
+
+    FORMAT_VERSION = 2
+
+    def __init__(self,store,workdir):
+        self.store = store
+        self.workdir = workdir
+        self._info = {}
+
+    def _get_info(self,key):
+        """Get the published info for the given key, or None."""
+        if key not in self._info:
+            f = StringIO()
+            try:
+                if not self.store.read(key + ".json",f):
+                    return None
+                info = json.loads(f.getvalue())
+                info = (str(info["sha256"]),int(info["size"]))
+            except (EnvironmentError,httplib.HTTPException,):
+                traceback.print_exc()
+                print "ARTIFACT STORE ERROR FOR", key
+                return None
+            except (ValueError,KeyError,TypeError,):
+                print "CORRUPTED ARTIFACT INFO FOR", key
+                return None
+            self._info[key] = info
+        return self._info[key]
+
+    def _get_name(self,key,sha256):
+        return "%s-%s.tar.gz" % (key,sha256,)
+
+    def has(self,key):
+        """Check whether there's an artifact stored under the given key."""
+        return (self._get_info(key) is not None)
+
+    def pack(self,key,rootdir,files):
+        """Store the given files from rootdir as the artifact for a key.
+
+        Entries in the list of files that end with a path separator are
+        stored as empty directories.
+        """
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        enc = sys.getfilesystemencoding()
+        tmpfile = os.path.join(self.workdir,"%s.tmp%d" % (key,os.getpid(),))
+        try:
+            tar = tarfile.open(tmpfile,"w:gz")
+            try:
+                for file in files:
+                    arcname = file[len(rootdir)+1:].rstrip(os.sep)
+                    if isinstance(arcname,unicode):
+                        arcname = arcname.encode(enc)
+                        file = file.encode(enc)
+                    tar.add(file.rstrip(os.sep),arcname,recursive=False)
+            finally:
+                tar.close()
+            (sha256,) = util.hashfile(tmpfile,("sha256",))
+            size = os.path.getsize(tmpfile)
+            with open(tmpfile,"rb") as f:
+                self.store.write(self._get_name(key,sha256),f)
+            info = json.dumps({"sha256":sha256,"size":size})
+            self.store.write(key + ".json",StringIO(info))
+            self._info[key] = (sha256,size)
+        finally:
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+
+    def unpack(self,key,destdir):
+        """Extract the artifact for the given key into destdir.
+
+        RuntimeError is raised if the artifact is missing or corrupted.
+        """
+        info = self._get_info(key)
+        if info is None:
+            raise RuntimeError("no artifact for key %s" % (key,))
+        (sha256,size) = info
+        name = self._get_name(key,sha256)
+        path = self.store.get_path(name)
+        tmpfile = None
+        if path is None:
+            if not os.path.isdir(self.workdir):
+                os.makedirs(self.workdir)
+            path = tmpfile = os.path.join(self.workdir,name)
+        try:
+            if tmpfile is not None:
+                with open(tmpfile,"wb") as f:
+                    if not self.store.read(name,f):
+                        raise RuntimeError("missing artifact: %s" % (name,))
+            if os.path.getsize(path) != size or \
+               util.hashfile(path,("sha256",))[0] != sha256:
+                del self._info[key]
+                raise RuntimeError("corrupted artifact: %s" % (name,))
+            unpack.extract(path,destdir)
+        finally:
+            if tmpfile is not None and os.path.exists(tmpfile):
+                os.unlink(tmpfile)
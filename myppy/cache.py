@@ -0,0 +1,731 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.cache:  content-addressed cache of downloaded files
+
+"""
+
+from __future__ import with_statement
+
+import os
+import time
+import json
+import tarfile
+import errno
+import httplib
+import hashlib
+import sqlite3
+import urllib
+import urllib2
+import urlparse
+import shutil
+import threading
+from contextlib import contextmanager
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from myppy import util
+from myppy import unpack
+from myppy.download import Downloader, RangeNotSupported
+
+
+class DownloadCache(object):
+    """A cache of downloaded files, addressed by the hash of their contents.
+
+    Each file is stored as objects/XX/SHA256/BASENAME under the cache dir,
+    so files from different URLs with the same basename can't be confused.
+    An index database maps each URL to the hash of its contents, and records
+    the size and mtime of each file as of when its hashes were last checked,
+    so that finding a valid cached file usually costs a single stat.
+
+    Several envs, in several processes, can safely share a single cache.
+    Files are downloaded into a temp file and renamed into place, and each
+    URL is downloaded while holding an exclusive lock on a lock file.  If
+    max_size is given then the least recently used files are evicted to
+    keep the total size of the cache below that many bytes.
+
+    Interrupted downloads are resumed the next time the file is fetched,
+    if the server supports it.  If segments is greater than one, big files
+    are downloaded in that many parallel segments.
+
+    If a MirrorMap is given, each URL can also be fetched from any of its
+    mirrors.  The mirrors are probed concurrently the first time they're
+    used, and the throughput seen from each is recorded in the index, so
+    later downloads go to the fastest mirror first and fall back to the
+    others if it fails.
+
+    If recompress names one of unpack.RECOMPRESS_FORMATS, then a copy of
+    each slow-to-unpack tarball is kept in that format alongside the
+    original, and can be found using get_fast_copy().
+    """
+
+    INDEX_NAME = "index.db"
+
+    #  Name of the manifest at the start of a source bundle.
+    BUNDLE_MANIFEST = "MANIFEST.json"
+
+    #  Files used within this many seconds are never evicted, since another
+    #  process might be about to read them.
+    EVICTION_GRACE = 60 * 60
+
+    #  Only files at least this big are downloaded in segments.
+    SEGMENT_MIN_SIZE = 8 * 1024 * 1024
+
+    #  Mirrors are probed by downloading this much of the file, and are
+    #  considered dead if they go this many seconds without responding.
+    PROBE_SIZE = 256 * 1024
+    PROBE_TIMEOUT = 10
+
+    #  Recorded mirror throughputs older than this are re-probed.
+    MIRROR_STATS_TTL = 7 * 24 * 60 * 60
+
+    def __init__(self,cachedir,downloader=None,max_size=None,segments=1,
+                      mirrors=None,recompress=None):
+        if downloader is None:
+            downloader = Downloader()
+        if recompress is not None:
+            if recompress not in unpack.RECOMPRESS_FORMATS:
+                raise ValueError("unknown recompress format: %s" %
+                                 (recompress,))
+        self.cachedir = cachedir
+        self.downloader = downloader
+        self.max_size = max_size
+        self.segments = segments
+        self.mirrors = mirrors
+        self.recompress = recompress
+        self._local = threading.local()
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _makedirs(self,path):
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno not in (errno.EEXIST,):
+                raise
+
+    def _db(self):
+        """Get the index db connection for the current thread."""
+        #  A forked child must not share its parent's connection.
+        if getattr(self._local,"pid",None) != os.getpid():
+            self._makedirs(self.cachedir)
+            dbpath = os.path.join(self.cachedir,self.INDEX_NAME)
+            db = sqlite3.connect(dbpath,timeout=60,isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS objects ("
+                       "  sha256 TEXT NOT NULL PRIMARY KEY,"
+                       "  md5 TEXT NOT NULL,"
+                       "  path TEXT NOT NULL,"
+                       "  size INTEGER NOT NULL,"
+                       "  mtime REAL NOT NULL,"
+                       "  last_used REAL NOT NULL"
+                       ")")
+            db.execute("CREATE INDEX IF NOT EXISTS objects_md5"
+                       "  ON objects (md5)")
+            db.execute("CREATE TABLE IF NOT EXISTS urls ("
+                       "  url TEXT NOT NULL PRIMARY KEY,"
+                       "  sha256 TEXT NOT NULL"
+                       ")")
+            db.execute("CREATE TABLE IF NOT EXISTS recompressed ("
+                       "  sha256 TEXT NOT NULL PRIMARY KEY,"
+                       "  size INTEGER NOT NULL"
+                       ")")
+            db.execute("CREATE TABLE IF NOT EXISTS mirrors ("
+                       "  base TEXT NOT NULL PRIMARY KEY,"
+                       "  throughput REAL NOT NULL,"
+                       "  updated REAL NOT NULL"
+                       ")")
+            self._local.pid = os.getpid()
+            self._local.db = db
+        return self._local.db
+
+    @contextmanager
+    def _lock(self,url):
+        """Context manager holding an exclusive lock on the given URL."""
+        key = hashlib.sha1(url).hexdigest()
+        if fcntl is None:
+            with self._locks_lock:
+                lock = self._locks.setdefault(key,threading.Lock())
+            with lock:
+                yield
+        else:
+            lockdir = os.path.join(self.cachedir,"locks")
+            self._makedirs(lockdir)
+            with open(os.path.join(lockdir,key + ".lock"),"a") as f:
+                fcntl.flock(f.fileno(),fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f.fileno(),fcntl.LOCK_UN)
+
+    def fetch(self,url,md5=None):
+        """Get a local copy of the given URL, downloading it if necessary.
+
+        If an md5 is given, the file must have that md5 hash.  A cached file
+        with that hash will be used even if it came from a different URL.
+        """
+        path = self.lookup(url,md5)
+        if path is None:
+            with self._lock(url):
+                path = self.lookup(url,md5)
+                if path is None:
+                    path = self._download(url,md5)
+            if self.recompress is not None:
+                self._recompress(path)
+            self._evict(path)
+        elif self.recompress is not None:
+            self._recompress(path)
+        return path
+
+    def lookup(self,url,md5=None):
+        """Get the path of a valid cached copy of the given URL, or None."""
+        db = self._db()
+        q = "SELECT objects.sha256, md5, path, size, mtime" \
+            "  FROM urls JOIN objects ON objects.sha256 = urls.sha256" \
+            "  WHERE url=?"
+        row = db.execute(q,(url,)).fetchone()
+        if row is not None and md5 is not None and row[1] != md5:
+            print "BAD MD5 FOR", url
+            print md5, row[1]
+            db.execute("DELETE FROM urls WHERE url=?",(url,))
+            row = None
+        if row is None and md5 is not None:
+            q = "SELECT sha256, md5, path, size, mtime" \
+                "  FROM objects WHERE md5=?"
+            row = db.execute(q,(md5,)).fetchone()
+        if row is None:
+            return None
+        (sha256,_,relpath,size,mtime) = row
+        path = os.path.join(self.cachedir,relpath)
+        if not self._verify(sha256,path,size,mtime):
+            return None
+        db.execute("INSERT OR REPLACE INTO urls (url, sha256) VALUES (?,?)",
+                   (url,sha256,))
+        db.execute("UPDATE objects SET last_used=? WHERE sha256=?",
+                   (time.time(),sha256,))
+        return path
+
+    def get_sha256(self,path):
+        """Get the sha256 hash of a file returned by fetch(), or None.
+
+        This is read from the file's location in the cache, so it's cheap
+        and doesn't need the index.  None is returned for other files.
+        """
+        objdir = os.path.join(self.cachedir,"objects","")
+        if not path.startswith(objdir):
+            return None
+        sha256 = os.path.basename(os.path.dirname(path))
+        if len(sha256) != 64 or sha256.strip("0123456789abcdef"):
+            return None
+        return sha256
+
+    def get_fast_copy(self,path):
+        """Get the recompressed copy of a file returned by fetch(), or None.
+
+        None is also returned if the copy can't be unpacked on this machine.
+        """
+        fastpath = self._get_fast_path(path)
+        if fastpath is None or not os.path.exists(fastpath):
+            return None
+        if not fastpath.endswith(".tar"):
+            if unpack.find_decompressor(fastpath) is None:
+                return None
+        return fastpath
+
+    def _get_fast_path(self,path):
+        """Get the path for the recompressed copy of a file, or None."""
+        if self.recompress is None or self.get_sha256(path) is None:
+            return None
+        nm = os.path.basename(path)
+        for ext in unpack.SLOW_FORMATS:
+            if nm.endswith(ext):
+                fastext = unpack.RECOMPRESS_FORMATS[self.recompress][0]
+                return os.path.join(os.path.dirname(path),
+                                    nm[:-len(ext)] + fastext)
+        return None
+
+    def _recompress(self,path):
+        """Make a recompressed copy of a cached file, if it needs one."""
+        fastpath = self._get_fast_path(path)
+        if fastpath is None or os.path.exists(fastpath):
+            return
+        print "RECOMPRESSING", path
+        if unpack.recompress(path,fastpath,self.recompress):
+            self._db().execute("INSERT OR REPLACE INTO recompressed"
+                               "  (sha256, size) VALUES (?,?)",
+                               (self.get_sha256(path),
+                                os.path.getsize(fastpath),))
+
+    def write_bundle(self,f,urls):
+        """Write the cached files for the given URLs into a bundle.
+
+        A bundle is an uncompressed tar stream holding a JSON manifest of
+        the URLs and the hashes of their contents, followed by the files
+        themselves, so it can be written and read in a single pass.  Every
+        URL must already be in the cache.
+        """
+        db = self._db()
+        q = "SELECT objects.sha256, md5, size" \
+            "  FROM urls JOIN objects ON objects.sha256 = urls.sha256" \
+            "  WHERE url=?"
+        manifest = []
+        files = []
+        for url in urls:
+            path = self.lookup(url)
+            if path is None:
+                raise RuntimeError("not in download cache: %s" % (url,))
+            (sha256,md5,size) = db.execute(q,(url,)).fetchone()
+            name = "%s/%s" % (sha256,os.path.basename(path),)
+            manifest.append({"url":url,"name":name,"sha256":sha256,
+                             "md5":md5,"size":size})
+            if (name,path) not in files:
+                files.append((name,path))
+        tar = tarfile.open(fileobj=f,mode="w|")
+        try:
+            data = json.dumps(manifest,indent=2,sort_keys=True)
+            info = tarfile.TarInfo(self.BUNDLE_MANIFEST)
+            info.size = len(data)
+            info.mtime = time.time()
+            tar.addfile(info,StringIO(data))
+            for (name,path) in files:
+                print "BUNDLING", path
+                with open(path,"rb") as fIn:
+                    tar.addfile(tar.gettarinfo(path,name,fIn),fIn)
+        finally:
+            tar.close()
+
+    def read_bundle(self,f):
+        """Load the files from a bundle into the cache.
+
+        Files that the cache already has, according to the hashes in the
+        bundle's manifest, are skipped without being read.  Other files are
+        hashed as they're copied in, and must match the manifest.  This
+        returns the list of URLs found in the bundle.
+        """
+        tar = tarfile.open(fileobj=f,mode="r|")
+        try:
+            members = iter(tar)
+            info = next(members,None)
+            if info is None or info.name != self.BUNDLE_MANIFEST:
+                raise ValueError("not a source bundle")
+            manifest = json.load(tar.extractfile(info))
+            entries = {}
+            for entry in manifest:
+                entries.setdefault(entry["name"],[]).append(entry)
+            tmpdir = os.path.join(self.cachedir,"tmp")
+            self._makedirs(tmpdir)
+            db = self._db()
+            for info in members:
+                if info.name not in entries:
+                    continue
+                sha256 = entries[info.name][0]["sha256"]
+                md5 = entries[info.name][0]["md5"]
+                if self._has_object(sha256):
+                    print "ALREADY CACHED", info.name
+                else:
+                    print "IMPORTING", info.name
+                    tmpfile = os.path.join(tmpdir,sha256 + ".import")
+                    with open(tmpfile,"wb") as fTmp:
+                        fOut = _HashingFile(fTmp,("md5","sha256",))
+                        shutil.copyfileobj(tar.extractfile(info),fOut)
+                    if fOut.hexdigests() != [md5,sha256]:
+                        os.unlink(tmpfile)
+                        raise RuntimeError("corrupted bundle file: %s"
+                                           % (info.name,))
+                    nm = os.path.basename(info.name)
+                    self._store(entries[info.name][0]["url"],tmpfile,nm,
+                                sha256,md5)
+                for e in entries.pop(info.name):
+                    db.execute("INSERT OR REPLACE INTO urls (url, sha256)"
+                               "  VALUES (?,?)",(e["url"],sha256,))
+            if entries:
+                missing = ", ".join(sorted(entries))
+                raise RuntimeError("bundle is missing files: %s" % (missing,))
+        finally:
+            tar.close()
+        return [e["url"] for e in manifest]
+
+    def _has_object(self,sha256):
+        """Check whether the cache has a valid file with the given hash."""
+        q = "SELECT path, size, mtime FROM objects WHERE sha256=?"
+        row = self._db().execute(q,(sha256,)).fetchone()
+        if row is None:
+            return False
+        path = os.path.join(self.cachedir,row[0])
+        return self._verify(sha256,path,row[1],row[2])
+
+    def _verify(self,sha256,path,size,mtime):
+        """Check that a cached file still has the expected contents.
+
+        The file is only re-hashed if its size or mtime have changed since
+        it was last checked.
+        """
+        try:
+            st = os.stat(path)
+        except OSError, e:
+            if e.errno not in (errno.ENOENT,):
+                raise
+            self._forget(sha256)
+            return False
+        if st.st_size == size and st.st_mtime == mtime:
+            return True
+        if util.hashfile(path,("sha256",))[0] == sha256:
+            q = "UPDATE objects SET size=?, mtime=? WHERE sha256=?"
+            self._db().execute(q,(st.st_size,st.st_mtime,sha256,))
+            return True
+        print "CORRUPTED CACHE FILE", path
+        self._remove(path)
+        self._forget(sha256)
+        return False
+
+    def _forget(self,sha256):
+        db = self._db()
+        db.execute("DELETE FROM urls WHERE sha256=?",(sha256,))
+        db.execute("DELETE FROM objects WHERE sha256=?",(sha256,))
+        db.execute("DELETE FROM recompressed WHERE sha256=?",(sha256,))
+
+    def _remove(self,path):
+        """Remove a cached file, along with any recompressed copy of it."""
+        try:
+            shutil.rmtree(os.path.dirname(path))
+        except OSError, e:
+            if e.errno not in (errno.ENOENT,):
+                raise
+
+    def _download(self,url,md5):
+        """Download the given URL into the cache, returning its path.
+
+        The file is downloaded into a ".part" file in the cache's tmp dir,
+        which is kept if the download fails so that the next attempt can
+        pick up where this one left off.  It's renamed into place once it
+        has been downloaded and checked.  Each of the URL's mirrors is tried
+        in turn until one of them gives a good download.
+        """
+        nm = os.path.basename(urlparse.urlparse(url).path) or "download"
+        tmpdir = os.path.join(self.cachedir,"tmp")
+        self._makedirs(tmpdir)
+        key = hashlib.sha1(url).hexdigest()
+        partfile = os.path.join(tmpdir,key + ".part")
+        sources = self._get_sources(url)
+        if len(sources) == 1:
+            record = lambda base,throughput: None
+        else:
+            record = self._record_throughput
+        for (i,(base,srcurl)) in enumerate(sources):
+            last = (i == len(sources) - 1)
+            print "DOWNLOADING", srcurl
+            done = 0
+            if os.path.exists(partfile):
+                done = os.path.getsize(partfile)
+            tstart = time.time()
+            try:
+                (digest_md5,sha256) = self._download_from(srcurl,partfile)
+            except (EnvironmentError,httplib.HTTPException), e:
+                record(base,None)
+                if last:
+                    raise
+                print "MIRROR FAILED", base, e
+                continue
+            if md5 is not None and md5 != digest_md5:
+                os.unlink(partfile)
+                self._save_validator(partfile,None)
+                record(base,None)
+                if last:
+                    raise RuntimeError("corrupted download: %s" % (srcurl,))
+                print "CORRUPTED DOWNLOAD FROM MIRROR", base
+                continue
+            size = os.path.getsize(partfile)
+            if size > done:
+                size -= done
+            elapsed = max(time.time() - tstart,1e-6)
+            record(base,size / elapsed)
+            break
+        for fnm in os.listdir(tmpdir):
+            if fnm.startswith(key + ".part."):
+                os.unlink(os.path.join(tmpdir,fnm))
+        return self._store(url,partfile,nm,sha256,digest_md5)
+
+    def _store(self,url,tmpfile,nm,sha256,md5):
+        """Move a checked file into the cache as the contents of a URL.
+
+        The given hashes must be those of the file's contents.  This returns
+        the path of the file within the cache.
+        """
+        db = self._db()
+        q = "SELECT sha256, md5, path, size, mtime" \
+            "  FROM objects WHERE sha256=?"
+        row = db.execute(q,(sha256,)).fetchone()
+        if row is not None:
+            #  We already had this content, from a different URL.
+            path = os.path.join(self.cachedir,row[2])
+            if self._verify(sha256,path,row[3],row[4]):
+                os.unlink(tmpfile)
+                db.execute("INSERT OR REPLACE INTO urls (url, sha256)"
+                           "  VALUES (?,?)",(url,sha256,))
+                db.execute("UPDATE objects SET last_used=?"
+                           "  WHERE sha256=?",(time.time(),sha256,))
+                return path
+        relpath = os.path.join("objects",sha256[:2],sha256,nm)
+        path = os.path.join(self.cachedir,relpath)
+        self._makedirs(os.path.dirname(path))
+        os.rename(tmpfile,path)
+        st = os.stat(path)
+        db.execute("INSERT OR REPLACE INTO objects"
+                   "  (sha256, md5, path, size, mtime, last_used)"
+                   "  VALUES (?,?,?,?,?,?)",
+                   (sha256,md5,relpath,st.st_size,st.st_mtime,time.time(),))
+        db.execute("INSERT OR REPLACE INTO urls (url, sha256) VALUES (?,?)",
+                   (url,sha256,))
+        return path
+
+    def _download_from(self,url,partfile):
+        """Download the URL into the given part file, in segments if we can.
+
+        This returns the md5 and sha256 digests of the downloaded file.
+        """
+        if self.segments > 1:
+            (size,ranges,validator) = self.downloader.get_info(url)
+            if ranges and size >= self.SEGMENT_MIN_SIZE:
+                try:
+                    return self._download_segments(url,partfile,size,
+                                                   validator)
+                except RangeNotSupported:
+                    pass
+        return self._download_part(url,partfile)
+
+    def _get_sources(self,url):
+        """Get the (base,url) pairs to download the URL from, fastest first.
+
+        Mirrors without a recent throughput measurement are probed first.
+        Mirrors that have failed go last.  A local mirror that has the file
+        is always used first, without probing anything.
+        """
+        if self.mirrors is None:
+            return [(url,url)]
+        sources = self.mirrors.get_sources(url)
+        if len(sources) == 1:
+            return sources
+        for source in sources:
+            (scheme,_,path,_,_) = urlparse.urlsplit(source[1])
+            if scheme == "file" and os.path.isfile(urllib.url2pathname(path)):
+                return [source] + [s for s in sources if s != source]
+        db = self._db()
+        cutoff = time.time() - self.MIRROR_STATS_TTL
+        throughputs = {}
+        for (base,_) in sources:
+            q = "SELECT throughput FROM mirrors WHERE base=? AND updated>?"
+            row = db.execute(q,(base,cutoff,)).fetchone()
+            if row is not None:
+                throughputs[base] = row[0]
+        if len(throughputs) < len(sources):
+            print "PROBING MIRRORS FOR", url
+            prober = Downloader(self.PROBE_TIMEOUT)
+            probe = lambda url: self._probe(url,prober)
+            pool = ThreadPool(len(sources))
+            try:
+                results = pool.map(probe,[u for (_,u) in sources])
+            finally:
+                pool.close()
+                pool.join()
+            for ((base,_),throughput) in zip(sources,results):
+                db.execute("INSERT OR REPLACE INTO mirrors"
+                           "  (base, throughput, updated) VALUES (?,?,?)",
+                           (base,throughput,time.time(),))
+                throughputs[base] = throughput
+        #  The sort is stable, so ties keep the configured order.
+        return sorted(sources,key=lambda s: -throughputs[s[0]])
+
+    def _probe(self,url,prober):
+        """Measure the throughput when downloading the start of a URL.
+
+        This returns the throughput in bytes per second, or -1 if the URL
+        couldn't be downloaded at all, using the given Downloader.
+        """
+        fOut = _CountingFile()
+        tstart = time.time()
+        try:
+            try:
+                prober.download(url,fOut,0,self.PROBE_SIZE)
+            except RangeNotSupported:
+                fIn = urllib2.urlopen(url,timeout=self.PROBE_TIMEOUT)
+                try:
+                    fOut.write(fIn.read(self.PROBE_SIZE))
+                finally:
+                    fIn.close()
+        except (EnvironmentError,httplib.HTTPException):
+            return -1
+        return fOut.size / max(time.time() - tstart,1e-6)
+
+    def _record_throughput(self,base,throughput):
+        """Record the throughput seen from a mirror, or None if it failed.
+
+        Successful downloads are averaged with previous measurements, so a
+        single slow download doesn't send a good mirror to the back.
+        """
+        db = self._db()
+        if throughput is None:
+            throughput = -1
+        else:
+            q = "SELECT throughput FROM mirrors WHERE base=?"
+            row = db.execute(q,(base,)).fetchone()
+            if row is not None and row[0] > 0:
+                throughput = (throughput + row[0]) / 2
+        db.execute("INSERT OR REPLACE INTO mirrors"
+                   "  (base, throughput, updated) VALUES (?,?,?)",
+                   (base,throughput,time.time(),))
+
+    def _load_validator(self,partfile):
+        """Get the validator of the file being downloaded into a part file."""
+        try:
+            with open(partfile + ".validator","rb") as f:
+                return f.read() or None
+        except EnvironmentError, e:
+            if e.errno not in (errno.ENOENT,):
+                raise
+            return None
+
+    def _save_validator(self,partfile,validator):
+        """Record the validator of the file being downloaded into a part file.
+
+        Without one, the download can't safely be resumed, since the file
+        might have changed in the meantime.
+        """
+        if validator is None:
+            try:
+                os.unlink(partfile + ".validator")
+            except EnvironmentError, e:
+                if e.errno not in (errno.ENOENT,):
+                    raise
+        else:
+            with open(partfile + ".validator","wb") as f:
+                f.write(validator)
+
+    def _download_part(self,url,partfile):
+        """Download the URL into the given part file, resuming if possible.
+
+        This returns the md5 and sha256 digests of the downloaded file.
+        """
+        offset = 0
+        if os.path.exists(partfile):
+            offset = os.path.getsize(partfile)
+        validator = self._load_validator(partfile)
+        if offset and validator is None:
+            print "CAN'T RESUME UNVALIDATED DOWNLOAD", url
+        elif offset:
+            print "RESUMING", url, "FROM BYTE", offset
+            try:
+                with open(partfile,"ab") as f:
+                    self.downloader.download(url,f,offset,if_range=validator)
+            except RangeNotSupported:
+                print "CAN'T RESUME", url
+            else:
+                return util.hashfile(partfile,("md5","sha256",))
+        self._save_validator(partfile,None)
+        with open(partfile,"wb") as f:
+            fOut = _HashingFile(f,("md5","sha256",))
+            save = lambda validator: self._save_validator(partfile,validator)
+            self.downloader.download(url,fOut,got_validator=save)
+        return fOut.hexdigests()
+
+    def _download_segments(self,url,partfile,size,validator):
+        """Download the URL in several segments at once, then join them up.
+
+        Each segment is downloaded into its own part file, so they can be
+        resumed individually as long as the file's validator hasn't changed.
+        This returns the md5 and sha256 digests of the joined file.
+        """
+        seglen = -(-size // self.segments)
+        segments = []
+        for start in xrange(0,size,seglen):
+            end = min(size,start + seglen)
+            segments.append((start,end,"%s.%d-%d" % (partfile,start,end)))
+        if validator is None or validator != self._load_validator(partfile):
+            tmpdir = os.path.dirname(partfile)
+            prefix = os.path.basename(partfile) + "."
+            for fnm in os.listdir(tmpdir):
+                if fnm.startswith(prefix) and fnm[len(prefix):][:1].isdigit():
+                    os.unlink(os.path.join(tmpdir,fnm))
+        self._save_validator(partfile,validator)
+        def download(segment):
+            (start,end,segfile) = segment
+            done = 0
+            if os.path.exists(segfile):
+                done = os.path.getsize(segfile)
+            if done > end - start:
+                os.unlink(segfile)
+                done = 0
+            if done < end - start:
+                with open(segfile,"ab") as f:
+                    self.downloader.download(url,f,start + done,end,
+                                             if_range=validator)
+        pool = ThreadPool(len(segments))
+        try:
+            pool.map(download,segments)
+        finally:
+            pool.close()
+            pool.join()
+        with open(partfile,"wb") as f:
+            fOut = _HashingFile(f,("md5","sha256",))
+            for (_,_,segfile) in segments:
+                with open(segfile,"rb") as fIn:
+                    shutil.copyfileobj(fIn,fOut,1024*512)
+        return fOut.hexdigests()
+
+    def _evict(self,keep):
+        """Evict least recently used files until we're under max_size."""
+        if self.max_size is None:
+            return
+        db = self._db()
+        q = "SELECT (SELECT SUM(size) FROM objects)," \
+            "  (SELECT SUM(size) FROM recompressed)"
+        total = sum(n or 0 for n in db.execute(q).fetchone())
+        if not total or total <= self.max_size:
+            return
+        q = "SELECT objects.sha256, path," \
+            "  objects.size + COALESCE(recompressed.size,0)" \
+            "  FROM objects LEFT JOIN recompressed" \
+            "  ON recompressed.sha256 = objects.sha256" \
+            "  WHERE last_used < ? ORDER BY last_used"
+        cutoff = time.time() - self.EVICTION_GRACE
+        for (sha256,relpath,size) in db.execute(q,(cutoff,)).fetchall():
+            path = os.path.join(self.cachedir,relpath)
+            if path == keep:
+                continue
+            print "EVICTING", path
+            self._remove(path)
+            self._forget(sha256)
+            total -= size
+            if total <= self.max_size:
+                break
+
+
+class _HashingFile(object):
+    """File-like wrapper that hashes everything written through it."""
+
+    def __init__(self,f,algorithms):
+        self.f = f
+        self.hashes = [hashlib.new(nm) for nm in algorithms]
+
+    def write(self,data):
+        for hash in self.hashes:
+            hash.update(data)
+        self.f.write(data)
+
+    def hexdigests(self):
+        return [hash.hexdigest() for hash in self.hashes]
+
+
+class _CountingFile(object):
+    """File-like object that just counts the bytes written to it."""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self,data):
+        self.size += len(data)
@@ -0,0 +1,232 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.download:  helpers for downloading source files
+
+"""
+
+from __future__ import with_statement
+
+import os
+import socket
+import shutil
+import urllib
+import urllib2
+import urlparse
+import httplib
+import threading
+
+
+class RangeNotSupported(urllib2.URLError):
+    """Error raised when a server won't send just part of a file."""
+    pass
+
+
+def get_validator(resp):
+    """Get the validator identifying the version of a file in an HTTP response.
+
+    This is its ETag if it has a strong one, otherwise its Last-Modified time,
+    suitable for sending in an If-Range header.  It's None if there isn't one.
+    """
+    etag = resp.getheader("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return resp.getheader("last-modified")
+
+
+class Downloader(object):
+    """Download files over HTTP, re-using connections where possible.
+
+    Each thread keeps its own keep-alive connection to each host it talks to,
+    so a thread downloading several files from the same host only connects
+    once.  URLs that aren't plain http or https, or that would need to go via
+    a proxy, are handed off to urllib2.
+
+    Parts of a file can be downloaded using HTTP Range requests, which lets
+    interrupted downloads be resumed and big files be fetched in segments.
+    Files can also be uploaded with a plain HTTP PUT.
+
+    If a timeout is given, any connection or read that takes longer than
+    that many seconds fails with socket.timeout.
+    """
+
+    MAX_REDIRECTS = 10
+    CHUNK_SIZE = 1024 * 512
+
+    def __init__(self,timeout=None):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def download(self,url,fOut,start=0,end=None,if_range=None,
+                 got_validator=None):
+        """Download the given URL, writing its contents into a file object.
+
+        If start or end are given, only the bytes from start up to (but not
+        including) end are downloaded; RangeNotSupported is raised if the
+        server can't do that.  A download that ends before the advertised
+        length is reached raises URLError.
+
+        If if_range is given, the range is only sent if the file still has
+        that validator (see get_validator), and RangeNotSupported is raised
+        if it has changed.  If given, got_validator is called with the
+        validator of the downloaded file before any of it is written.
+        """
+        headers = {}
+        if start or end is not None:
+            if end is None:
+                headers["Range"] = "bytes=%d-" % (start,)
+            else:
+                headers["Range"] = "bytes=%d-%d" % (start,end - 1,)
+            if if_range is not None:
+                headers["If-Range"] = if_range
+        (url,resp) = self._open(url,"GET",headers)
+        if resp is None:
+            if headers:
+                raise RangeNotSupported("can't resume download: %s" % (url,))
+            if got_validator is not None:
+                got_validator(None)
+            fIn = self._urlopen(url)
+            try:
+                shutil.copyfileobj(fIn,fOut)
+            finally:
+                fIn.close()
+            return
+        (scheme,netloc,_,_,_) = urlparse.urlsplit(url)
+        try:
+            if headers:
+                crange = resp.getheader("content-range") or ""
+                if resp.status != 206 or \
+                   not crange.startswith("bytes %d-" % (start,)):
+                    #  Don't read the whole file just to reuse the connection.
+                    self._drop_connection(scheme,netloc)
+                    raise RangeNotSupported("range not supported: %s" % (url,))
+            if got_validator is not None:
+                got_validator(get_validator(resp))
+            length = resp.getheader("content-length")
+            received = 0
+            chunk = resp.read(self.CHUNK_SIZE)
+            while chunk:
+                fOut.write(chunk)
+                received += len(chunk)
+                chunk = resp.read(self.CHUNK_SIZE)
+            if length is not None and received != int(length):
+                self._drop_connection(scheme,netloc)
+                raise urllib2.URLError("truncated download: %s" % (url,))
+        except (httplib.HTTPException,socket.error):
+            #  The connection is in an unknown state, don't re-use it.
+            self._drop_connection(scheme,netloc)
+            raise
+
+    def upload(self,url,fIn,size):
+        """Upload the contents of a file object to the given URL via PUT.
+
+        The file object must be seekable, in case the request has to be
+        retried on a fresh connection.  Only plain http and https URLs
+        are supported.
+        """
+        (scheme,netloc,path,query,_) = urlparse.urlsplit(url)
+        if scheme not in ("http","https") or scheme in urllib.getproxies():
+            raise urllib2.URLError("can't upload to %s" % (url,))
+        selector = path or "/"
+        if query:
+            selector += "?" + query
+        headers = {"Content-Length":str(size)}
+        resp = self._request(scheme,netloc,"PUT",selector,headers,fIn)
+        try:
+            resp.read()
+        except (httplib.HTTPException,socket.error):
+            self._drop_connection(scheme,netloc)
+            raise
+        if resp.status not in (200,201,204):
+            raise urllib2.HTTPError(url,resp.status,resp.reason,resp.msg,None)
+
+    def get_info(self,url):
+        """Get the size of the file at the given URL, whether the server can
+        send parts of it, and its validator.  The size and validator are None
+        if they aren't known.
+        """
+        (url,resp) = self._open(url,"HEAD")
+        if resp is None:
+            return (None,False,None)
+        resp.read()
+        length = resp.getheader("content-length")
+        if length is not None:
+            length = int(length)
+        ranges = (resp.getheader("accept-ranges") == "bytes")
+        return (length,ranges,get_validator(resp))
+
+    def _open(self,url,method,headers={}):
+        """Send a request for the URL, following any redirects.
+
+        This returns the final URL and the response, ready for its body to be
+        read.  If the URL can't be fetched directly, the response is None and
+        it should be opened using urllib2 instead.
+        """
+        for _ in xrange(self.MAX_REDIRECTS):
+            (scheme,netloc,path,query,_) = urlparse.urlsplit(url)
+            if scheme not in ("http","https") or scheme in urllib.getproxies():
+                return (url,None)
+            selector = path or "/"
+            if query:
+                selector += "?" + query
+            resp = self._request(scheme,netloc,method,selector,headers)
+            try:
+                if resp.status in (301,302,303,307):
+                    resp.read()
+                    url = urlparse.urljoin(url,resp.getheader("location"))
+                    continue
+                if resp.status not in (200,206):
+                    resp.read()
+                    raise urllib2.HTTPError(url,resp.status,resp.reason,
+                                            resp.msg,None)
+            except (httplib.HTTPException,socket.error):
+                self._drop_connection(scheme,netloc)
+                raise
+            return (url,resp)
+        raise urllib2.URLError("too many redirects: %s" % (url,))
+
+    def _urlopen(self,url):
+        """Open a URL using urllib2, with our timeout if we have one."""
+        if self.timeout is None:
+            return urllib2.urlopen(url)
+        return urllib2.urlopen(url,timeout=self.timeout)
+
+    def _connections(self):
+        """Get the dict of open connections for the current thread."""
+        #  A forked child must not share its parent's sockets.
+        if getattr(self._local,"pid",None) != os.getpid():
+            self._local.pid = os.getpid()
+            self._local.connections = {}
+        return self._local.connections
+
+    def _drop_connection(self,scheme,netloc):
+        conn = self._connections().pop((scheme,netloc),None)
+        if conn is not None:
+            conn.close()
+
+    def _request(self,scheme,netloc,method,selector,headers={},body=None):
+        """Send a request, re-using an existing connection if possible."""
+        conns = self._connections()
+        reused = (scheme,netloc) in conns
+        if not reused:
+            kwds = {}
+            if self.timeout is not None:
+                kwds["timeout"] = self.timeout
+            if scheme == "https":
+                conn = httplib.HTTPSConnection(netloc,**kwds)
+            else:
+                conn = httplib.HTTPConnection(netloc,**kwds)
+            conns[(scheme,netloc)] = conn
+        conn = conns[(scheme,netloc)]
+        try:
+            if body is not None:
+                body.seek(0)
+            conn.request(method,selector,body,headers)
+            return conn.getresponse()
+        except (httplib.HTTPException,socket.error):
+            self._drop_connection(scheme,netloc)
+            #  The server may have timed out an idle keep-alive connection.
+            if not reused:
+                raise
+            return self._request(scheme,netloc,method,selector,headers,body)
@@ -0,0 +1,609 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.elf:  minimal in-process reader and editor for ELF binaries
+
+This module reads the handful of things myppy cares about from an ELF file
+(file type, interpreter, rpath, needed libraries and symbol versions) in
+a single pass over an mmap of the file, instead of shelling out to "file"
+and "objdump" and parsing their output.
+
+It can also make a few simple modifications to an ELF file in place:
+
+    * set_rpath():        replace the DT_RPATH or DT_RUNPATH string
+    * set_interpreter():  replace the program interpreter
+    * strip():            remove the symbol table and debugging sections
+
+None of these can grow the file's loaded segments, so the new rpath or
+interpreter must fit in the space used by the old one; they return False
+if the file couldn't be modified.
+
+"""
+
+from __future__ import with_statement
+
+import os
+import mmap
+import struct
+
+
+ELF_MAGIC = "\x7fELF"
+
+ET_REL = 1
+ET_EXEC = 2
+ET_DYN = 3
+ET_CORE = 4
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+SHT_NULL = 0
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHT_REL = 9
+SHT_RELA = 4
+SHT_DYNSYM = 11
+SHT_SYMTAB_SHNDX = 18
+
+SHF_ALLOC = 0x2
+SHF_INFO_LINK = 0x40
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_HASH = 4
+DT_STRTAB = 5
+DT_SYMTAB = 6
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+DT_CONFIG = 0x6ffffefa
+DT_DEPAUDIT = 0x6ffffefb
+DT_AUDIT = 0x6ffffefc
+DT_VERSYM = 0x6ffffff0
+DT_VERDEF = 0x6ffffffc
+DT_VERDEFNUM = 0x6ffffffd
+DT_VERNEED = 0x6ffffffe
+DT_VERNEEDNUM = 0x6fffffff
+DT_AUXILIARY = 0x7ffffffd
+DT_FILTER = 0x7fffffff
+
+#  Dynamic tags whose value is an offset into the dynamic string table.
+STRING_TAGS = (DT_NEEDED,DT_SONAME,DT_RPATH,DT_RUNPATH,DT_CONFIG,
+               DT_DEPAUDIT,DT_AUDIT,DT_AUXILIARY,DT_FILTER,)
+
+FILE_TYPES = {
+    ET_REL: "relocatable",
+    ET_EXEC: "executable",
+    ET_DYN: "shared object",
+    ET_CORE: "core file",
+}
+
+#  struct formats for the various ELF structures, by ELF class.
+_FORMATS = {
+    32: {
+        "ehdr": "HHIIIIIHHHHHH",
+        "phdr": "IIIIIIII",
+        "shdr": "IIIIIIIIII",
+        "dyn": "iI",
+        "sym": "IIIBBH",
+    },
+    64: {
+        "ehdr": "HHIQQQIHHHHHH",
+        "phdr": "IIQQQQQQ",
+        "shdr": "IIQQQQIIQQ",
+        "dyn": "qQ",
+        "sym": "IBBHQQ",
+    },
+}
+
+
+class ELFInfo(object):
+    """Information read from an ELF file.
+
+    Attributes:
+
+        * elfclass:        32 or 64
+        * byteorder:       "<" for little-endian, ">" for big-endian
+        * type:            the ELF file type, e.g. "executable"
+        * interpreter:     path of the program interpreter, or None
+        * rpath:           the DT_RPATH string, or None
+        * runpath:         the DT_RUNPATH string, or None
+        * soname:          the DT_SONAME string, or None
+        * needed:          list of DT_NEEDED library names
+        * versions_needed: set of required symbol versions, e.g. "GLIBC_2.3"
+        * symbol_versions: dict mapping each dynamic symbol that requires
+                           a version from another library to that version
+
+    The file offsets of the interpreter, rpath and runpath strings and of the
+    dynamic section are kept as well, for use when modifying them in place.
+    """
+
+    def __init__(self,path):
+        self.path = path
+        self.elfclass = None
+        self.byteorder = None
+        self.e_type = None
+        self.interpreter = None
+        self.interpreter_offset = None
+        self.interpreter_size = None
+        self.rpath = None
+        self.rpath_offset = None
+        self.runpath = None
+        self.runpath_offset = None
+        self.soname = None
+        self.needed = []
+        self.versions_needed = set()
+        self.symbol_versions = {}
+        self.dynamic = []
+        self.dynamic_offset = None
+        self.dynstr_offset = None
+        self.dynstr_size = None
+
+    @property
+    def type(self):
+        return FILE_TYPES.get(self.e_type,"unknown")
+
+    @property
+    def is_executable(self):
+        """Whether this is a (possibly position-independent) executable."""
+        if self.e_type == ET_EXEC:
+            return True
+        return (self.e_type == ET_DYN and self.interpreter is not None)
+
+    def requires_version(self,prefix):
+        """List (version,symbols) pairs for versions with the given prefix.
+
+        For example, requires_version("GLIBC_") will list all the versions of
+        glibc needed by this file, along with the symbols needing them.
+        """
+        versions = {}
+        for version in self.versions_needed:
+            if version.startswith(prefix):
+                versions[version] = []
+        for (symbol,version) in self.symbol_versions.iteritems():
+            if version in versions:
+                versions[version].append(symbol)
+        return sorted((v,sorted(s)) for (v,s) in versions.iteritems())
+
+    def __repr__(self):
+        return "<ELFInfo %s %r>" % (self.type,self.path,)
+
+
+def is_elf(path):
+    """Check whether the given file looks like an ELF file."""
+    with open(path,"rb") as f:
+        return (f.read(len(ELF_MAGIC)) == ELF_MAGIC)
+
+
+def read_elf(path,symbols=True):
+    """Read an ELFInfo for the given file, or return None if it's not ELF.
+
+    If "symbols" is false then the symbol_versions attribute isn't filled
+    in, which saves scanning the dynamic symbol table.
+    """
+    with open(path,"rb") as f:
+        if f.read(len(ELF_MAGIC)) != ELF_MAGIC:
+            return None
+        size = os.fstat(f.fileno()).st_size
+        data = mmap.mmap(f.fileno(),size,access=mmap.ACCESS_READ)
+        try:
+            return _ELFReader(path,data).read(symbols)
+        finally:
+            data.close()
+
+
+def get_library_path(info):
+    """List the directories in an ELF file's own library search path.
+
+    This is the DT_RUNPATH if present, or the DT_RPATH if not, with any
+    references to $ORIGIN expanded to the directory containing the file.
+    """
+    origin = os.path.dirname(info.path)
+    libdirs = []
+    for libdir in (info.runpath or info.rpath or "").split(":"):
+        if libdir:
+            libdir = libdir.replace("${ORIGIN}",origin)
+            libdirs.append(libdir.replace("$ORIGIN",origin))
+    return libdirs
+
+
+class _ELFReader(object):
+    """Helper that does the actual parsing of an mmapped ELF file."""
+
+    def __init__(self,path,data):
+        self.data = data
+        self.info = ELFInfo(path)
+        self.loads = []
+        self.tags = {}
+        self.versions = {}
+
+    def unpack(self,fmt,offset):
+        fmt = self.info.byteorder + fmt
+        if offset < 0 or offset + struct.calcsize(fmt) > len(self.data):
+            raise ValueError("truncated ELF file: %s" % (self.info.path,))
+        return struct.unpack_from(fmt,self.data,offset)
+
+    def string(self,offset):
+        end = self.data.find("\x00",offset)
+        if offset < 0 or end < 0:
+            raise ValueError("bad string offset in %s" % (self.info.path,))
+        return self.data[offset:end]
+
+    def read(self,symbols=True):
+        info = self.info
+        info.elfclass = {1:32,2:64}.get(ord(self.data[4]))
+        info.byteorder = {1:"<",2:">"}.get(ord(self.data[5]))
+        if info.elfclass is None or info.byteorder is None:
+            raise ValueError("unsupported ELF file: %s" % (info.path,))
+        self.fmts = _FORMATS[info.elfclass]
+        self.ehdr = ehdr = self.unpack(self.fmts["ehdr"],16)
+        info.e_type = ehdr[0]
+        (phoff,shoff) = ehdr[4:6]
+        (phentsize,phnum,shentsize,shnum) = ehdr[8:12]
+        #  Program headers give us the interpreter and the dynamic section,
+        #  along with the loadable segments for mapping vaddrs to offsets.
+        dynamic = None
+        self.segments = []
+        for i in xrange(phnum):
+            phdr = self.unpack(self.fmts["phdr"],phoff + i*phentsize)
+            if info.elfclass == 32:
+                (p_type,p_offset,p_vaddr,_,p_filesz) = phdr[:5]
+            else:
+                (p_type,_,p_offset,p_vaddr,_,p_filesz) = phdr[:6]
+            self.segments.append((p_type,p_offset,p_filesz))
+            if p_type == PT_LOAD:
+                self.loads.append((p_vaddr,p_offset,p_filesz))
+            elif p_type == PT_INTERP:
+                info.interpreter_offset = p_offset
+                info.interpreter_size = p_filesz
+                info.interpreter = self.string(p_offset)
+            elif p_type == PT_DYNAMIC:
+                dynamic = (p_offset,p_filesz)
+        if dynamic is not None:
+            self.read_dynamic(*dynamic)
+            if symbols:
+                self.read_symbol_versions()
+        return info
+
+    def read_sections(self):
+        """Read the section headers.
+
+        This returns a list of section names, and a list of the section
+        headers as lists of fields in the order they appear in the file.
+        """
+        (shoff,shentsize,shnum,shstrndx) = (self.ehdr[5],) + self.ehdr[10:]
+        sections = []
+        for i in xrange(shnum):
+            shdr = self.unpack(self.fmts["shdr"],shoff + i*shentsize)
+            sections.append(list(shdr))
+        names = [""] * len(sections)
+        if 0 < shstrndx < len(sections):
+            strtab = sections[shstrndx][4]
+            for (i,shdr) in enumerate(sections):
+                names[i] = self.string(strtab + shdr[0])
+        return (names,sections)
+
+    def count_symbols(self):
+        """Count the number of entries in the dynamic symbol table."""
+        #  This isn't recorded in the dynamic section itself; find it from
+        #  the section headers if present, or from the hash table if not.
+        symsize = struct.calcsize(self.fmts["sym"])
+        for shdr in self.read_sections()[1]:
+            if shdr[1] == SHT_DYNSYM:
+                return shdr[5] // symsize
+        if DT_HASH in self.tags:
+            return self.unpack("II",self.offset(self.tags[DT_HASH]))[1]
+        return None
+
+    def dynstr_refs(self):
+        """Get the set of dynamic string table offsets in use.
+
+        This includes every string referenced from the dynamic section, the
+        symbol version tables and the dynamic symbol table.
+        """
+        tags = self.tags
+        refs = set()
+        for (tag,val) in self.info.dynamic:
+            if tag in STRING_TAGS:
+                refs.add(val)
+        if DT_VERNEED in tags:
+            vn_offset = self.offset(tags[DT_VERNEED])
+            for _ in xrange(tags.get(DT_VERNEEDNUM,0)):
+                (_,vn_cnt,vn_file,vn_aux,vn_next) = \
+                    self.unpack("HHIII",vn_offset)
+                refs.add(vn_file)
+                vna_offset = vn_offset + vn_aux
+                for _ in xrange(vn_cnt):
+                    (_,_,_,vna_name,vna_next) = self.unpack("IHHII",vna_offset)
+                    refs.add(vna_name)
+                    vna_offset += vna_next
+                if not vn_next:
+                    break
+                vn_offset += vn_next
+        if DT_VERDEF in tags:
+            vd_offset = self.offset(tags[DT_VERDEF])
+            for _ in xrange(tags.get(DT_VERDEFNUM,0)):
+                (_,_,_,vd_cnt,_,vd_aux,vd_next) = \
+                    self.unpack("HHHHIII",vd_offset)
+                vda_offset = vd_offset + vd_aux
+                for _ in xrange(vd_cnt):
+                    (vda_name,vda_next) = self.unpack("II",vda_offset)
+                    refs.add(vda_name)
+                    vda_offset += vda_next
+                if not vd_next:
+                    break
+                vd_offset += vd_next
+        if DT_SYMTAB in tags:
+            nsyms = self.count_symbols()
+            if nsyms is None:
+                raise ValueError("can't size symbol table: %s" % (self.info.path,))
+            symtab = self.offset(tags[DT_SYMTAB])
+            symsize = struct.calcsize(self.fmts["sym"])
+            for i in xrange(nsyms):
+                refs.add(self.unpack("I",symtab + i*symsize)[0])
+        return refs
+
+    def offset(self,vaddr):
+        """Convert a virtual address into an offset in the file."""
+        for (p_vaddr,p_offset,p_filesz) in self.loads:
+            if p_vaddr <= vaddr < p_vaddr + p_filesz:
+                return vaddr - p_vaddr + p_offset
+        raise ValueError("bad address in %s: %x" % (self.info.path,vaddr,))
+
+    def read_dynamic(self,offset,size):
+        info = self.info
+        info.dynamic_offset = offset
+        entsize = struct.calcsize(self.fmts["dyn"])
+        for i in xrange(size // entsize):
+            (tag,val) = self.unpack(self.fmts["dyn"],offset + i*entsize)
+            if tag == DT_NULL:
+                break
+            info.dynamic.append((tag,val))
+        self.tags = tags = dict(info.dynamic)
+        if DT_STRTAB not in tags:
+            return
+        info.dynstr_offset = strtab = self.offset(tags[DT_STRTAB])
+        info.dynstr_size = tags.get(DT_STRSZ)
+        for (tag,val) in info.dynamic:
+            if tag == DT_NEEDED:
+                info.needed.append(self.string(strtab + val))
+            elif tag == DT_RPATH:
+                info.rpath = self.string(strtab + val)
+                info.rpath_offset = strtab + val
+            elif tag == DT_RUNPATH:
+                info.runpath = self.string(strtab + val)
+                info.runpath_offset = strtab + val
+            elif tag == DT_SONAME:
+                info.soname = self.string(strtab + val)
+        #  Each Verneed entry names a library, and has a list of Vernaux
+        #  entries naming the versions needed from that library.
+        versions = {}
+        if DT_VERNEED in tags:
+            vn_offset = self.offset(tags[DT_VERNEED])
+            for _ in xrange(tags.get(DT_VERNEEDNUM,0)):
+                (_,vn_cnt,_,vn_aux,vn_next) = self.unpack("HHIII",vn_offset)
+                vna_offset = vn_offset + vn_aux
+                for _ in xrange(vn_cnt):
+                    (_,_,vna_other,vna_name,vna_next) = \
+                        self.unpack("IHHII",vna_offset)
+                    version = self.string(strtab + vna_name)
+                    info.versions_needed.add(version)
+                    versions[vna_other] = version
+                    vna_offset += vna_next
+                if not vn_next:
+                    break
+                vn_offset += vn_next
+        self.versions = versions
+
+    def read_symbol_versions(self):
+        """Work out which needed version each dynamic symbol is bound to."""
+        info = self.info
+        tags = self.tags
+        if not self.versions or DT_VERSYM not in tags:
+            return
+        if DT_SYMTAB not in tags:
+            return
+        nsyms = self.count_symbols()
+        if nsyms is None:
+            return
+        symsize = struct.calcsize(self.fmts["sym"])
+        symtab = self.offset(tags[DT_SYMTAB])
+        versym = self.offset(tags[DT_VERSYM])
+        versyms = self.unpack("%dH" % (nsyms,),versym)
+        for (i,verndx) in enumerate(versyms):
+            version = self.versions.get(verndx & 0x7fff)
+            if version is not None and i > 0:
+                st_name = self.unpack("I",symtab + i*symsize)[0]
+                name = self.string(info.dynstr_offset + st_name)
+                info.symbol_versions[name] = version
+
+
+def _edit_elf(path,edit):
+    """Apply an in-place edit to an ELF file.
+
+    The given function is called with an _ELFReader for the file, and must
+    return None if it can't make the edit, or a list of (offset,data) pairs
+    to write into the file and the size at which to truncate it.
+    """
+    with open(path,"r+b") as f:
+        if f.read(len(ELF_MAGIC)) != ELF_MAGIC:
+            raise ValueError("not an ELF file: %s" % (path,))
+        size = os.fstat(f.fileno()).st_size
+        data = mmap.mmap(f.fileno(),size,access=mmap.ACCESS_READ)
+        try:
+            reader = _ELFReader(path,data)
+            reader.read(symbols=False)
+            result = edit(reader)
+        finally:
+            data.close()
+        if result is None:
+            return False
+        (writes,newsize) = result
+        for (offset,bytes) in writes:
+            f.seek(offset)
+            f.write(bytes)
+        if newsize < size:
+            f.truncate(newsize)
+    return True
+
+
+def set_rpath(path,rpath):
+    """Set the rpath of an ELF file in place.
+
+    The new value replaces the existing DT_RPATH and/or DT_RUNPATH strings,
+    so there must be one of those at least as long as the new value, and
+    it must not share its storage with any other string in the file.
+    Returns True if the rpath was set, False if there wasn't room.
+    """
+    def edit(reader):
+        info = reader.info
+        offsets = set((info.rpath_offset,info.runpath_offset))
+        offsets.discard(None)
+        if not offsets:
+            return None
+        refs = set(info.dynstr_offset + ref for ref in reader.dynstr_refs())
+        writes = []
+        for offset in offsets:
+            size = len(reader.string(offset))
+            if len(rpath) > size:
+                return None
+            #  The linker may have merged other strings into this one.
+            for ref in refs:
+                if offset <= ref < offset + size and ref not in offsets:
+                    return None
+            writes.append((offset,rpath.ljust(size,"\x00")))
+        return (writes,len(reader.data))
+    return _edit_elf(path,edit)
+
+
+def set_interpreter(path,interpreter):
+    """Set the program interpreter of an ELF file in place.
+
+    The new interpreter must fit in the space used by the old one.  Returns
+    True if the interpreter was set, False if it wasn't possible.
+    """
+    def edit(reader):
+        info = reader.info
+        if info.interpreter is None:
+            return None
+        if len(interpreter) + 1 > info.interpreter_size:
+            return None
+        data = interpreter.ljust(info.interpreter_size,"\x00")
+        return ([(info.interpreter_offset,data)],len(reader.data))
+    return _edit_elf(path,edit)
+
+
+def _is_strippable(names,sections,index):
+    """Check whether the given section can be removed by strip()."""
+    name = names[index]
+    (sh_type,sh_flags) = sections[index][1:3]
+    if sh_flags & SHF_ALLOC:
+        return False
+    if sh_type in (SHT_SYMTAB,SHT_SYMTAB_SHNDX):
+        return True
+    if name.startswith(".debug") or name.startswith(".zdebug"):
+        return True
+    if name.startswith(".stab"):
+        return True
+    #  The string table used by the symbol table.
+    for shdr in sections:
+        if shdr[1] == SHT_SYMTAB and shdr[6] == index:
+            return True
+    #  Relocations that apply to a removed section.
+    if sh_type in (SHT_REL,SHT_RELA) and 0 < sections[index][7] < index:
+        return _is_strippable(names,sections,sections[index][7])
+    return False
+
+
+def _refers_to(sections,index,targets):
+    """Check whether the given section links to any of the target sections."""
+    (sh_type,sh_flags) = sections[index][1:3]
+    (sh_link,sh_info) = sections[index][6:8]
+    if sh_link in targets:
+        return True
+    if sh_flags & SHF_INFO_LINK or sh_type in (SHT_REL,SHT_RELA):
+        return (sh_info in targets)
+    return False
+
+
+def strip(path):
+    """Remove the symbol table and debugging sections from an ELF file.
+
+    Only sections that aren't loaded at runtime are removed, and the
+    remaining non-loaded sections are packed in after the last segment.
+    Any other non-loaded section that refers to a removed one goes too, and
+    the section name table is kept even if the symbol table shares it.
+    Returns True if the file is now stripped, False if it's malformed, i.e.
+    a loaded section refers to a removed one or to a missing section.
+    """
+    def edit(reader):
+        info = reader.info
+        (names,sections) = reader.read_sections()
+        removed = set(i for i in xrange(1,len(sections))
+                        if _is_strippable(names,sections,i))
+        shstrndx = reader.ehdr[12]
+        removed.discard(shstrndx)
+        while True:
+            dependents = set(i for i in xrange(1,len(sections))
+                               if i not in removed and
+                                  _refers_to(sections,i,removed))
+            if not dependents:
+                break
+            for i in dependents:
+                if sections[i][2] & SHF_ALLOC:
+                    return None
+            removed.update(dependents)
+        if not removed:
+            return ([],len(reader.data))
+        newindex = {}
+        for i in xrange(len(sections)):
+            if i not in removed:
+                newindex[i] = len(newindex)
+        #  Everything after the end of the last segment can be moved.
+        (_,_,_,_,phoff,_,_,_,phentsize,phnum) = reader.ehdr[:10]
+        tail = phoff + phentsize * phnum
+        for (_,p_offset,p_filesz) in reader.segments:
+            tail = max(tail,p_offset + p_filesz)
+        movable = []
+        for i in sorted(newindex):
+            shdr = sections[i]
+            (sh_type,sh_link) = (shdr[1],shdr[6])
+            if sh_link in removed or sh_link >= len(sections):
+                return None
+            if i > 0 and sh_type != SHT_NOBITS and shdr[4] >= tail:
+                movable.append(shdr)
+        writes = []
+        offset = tail
+        for shdr in sorted(movable,key=lambda shdr: shdr[4]):
+            align = max(1,shdr[8])
+            offset = (offset + align - 1) // align * align
+            writes.append((offset,reader.data[shdr[4]:shdr[4]+shdr[5]]))
+            shdr[4] = offset
+            offset += shdr[5]
+        #  Write out the new section header table.
+        align = info.elfclass // 8
+        shoff = (offset + align - 1) // align * align
+        fmt = info.byteorder + reader.fmts["shdr"]
+        shdrs = []
+        for i in sorted(newindex):
+            shdr = sections[i]
+            shdr[6] = newindex[shdr[6]]
+            if shdr[2] & SHF_INFO_LINK or shdr[1] in (SHT_REL,SHT_RELA):
+                if shdr[7] not in newindex:
+                    return None
+                shdr[7] = newindex[shdr[7]]
+            shdrs.append(struct.pack(fmt,*shdr))
+        shdrs = "".join(shdrs)
+        writes.append((shoff,shdrs))
+        ehdr = list(reader.ehdr)
+        ehdr[5] = shoff
+        ehdr[10] = struct.calcsize(fmt)
+        ehdr[11] = len(newindex)
+        ehdr[12] = newindex[shstrndx]
+        ehdr = struct.pack(info.byteorder + reader.fmts["ehdr"],*ehdr)
+        writes.append((16,ehdr))
+        return (writes,shoff + len(shdrs))
+    return _edit_elf(path,edit)
@@ -10,15 +10,30 @@ from __future__ import with_statement
 
 import os
 import sys
+import stat
+import time
 import subprocess
 import shutil
 import sqlite3
 import errno
-import urlparse
-import urllib2
+import inspect
+import hashlib
+import platform
+import traceback
+import Queue
+import cPickle as pickle
+from multiprocessing.pool import ThreadPool
 from functools import wraps
 
 from myppy import util
+from myppy.download import Downloader
+from myppy.cache import DownloadCache
+from myppy.mirrors import MirrorMap
+from myppy.unpack import SourceTreeCache
+from myppy.artifacts import ArtifactCache, get_artifact_store
+from myppy.resolver import DependencyResolver
+from myppy.jobserver import JobServer
+from myppy.forkserver import ForkServer
 
 
 from myppy.recipes import base as _base_recipes
@@ -37,12 +52,36 @@ class MyppyEnv(object):
         * install():    install a given recipe into the environment
         * uninstall():  uninstall a recipe from the environment
 
+    Independent recipes can be built concurrently; set the environment
+    variable MYPPY_BUILD_JOBS to the maximum number of simultaneous builds.
+    The files installed by each build are kept in the artifact cache given
+    by MYPPY_ARTIFACT_CACHE, and installed from there when nothing that
+    went into the build has changed.
+    Bulk file operations such as uninstalling, or post-processing the newly
+    built binaries, will use up to MYPPY_WORKERS threads or processes.
+    Set MYPPY_MAKE_JOBS to let make run that many jobs in parallel, shared
+    between all the concurrent builds.
+
     """
  
     DEPENDENCIES = ["python27","py_pip","py_myppy"]
 
     DB_NAME = os.path.join("local","myppy.db")
 
+    #  Downloads are shared by all envs of the same user, unless overridden
+    #  by MYPPY_DOWNLOAD_CACHE.  Relative paths are relative to the env root.
+    DOWNLOAD_CACHE = os.path.join("~",".cache","myppy")
+    DB_VERSION = 3
+
+    #  Recipes that every other recipe is implicitly built with, such as the
+    #  compiler.  Their build keys feed into those of all other recipes.
+    TOOLCHAIN = []
+
+    #  Recipe attributes that feed into the key of each cached build.
+    BUILD_KEY_ATTRS = ("CC","CXX","CFLAGS","CXXFLAGS","LDFLAGS",
+                       "CONFIGURE_SCRIPT","CONFIGURE_ARGS","CONFIGURE_VARS",
+                       "MAKE_VARS","INSTALL_PREFIX",)
+
     def __init__(self,rootdir):
         if not isinstance(rootdir,unicode):
             rootdir = rootdir.decode(sys.getfilesystemencoding())
@@ -51,8 +90,52 @@ class MyppyEnv(object):
         self.cachedir = os.path.join(self.rootdir,"cache")
         self.env = os.environ.copy()
         self._old_files_cache = None
+        self._file_snapshot = None
+        self._fetched = {}
+        #  Identifies this run of myppy, e.g. for sharing prepared sources.
+        self.session_id = "%d-%r" % (os.getpid(),time.time(),)
         self._add_env_path("PATH",os.path.join(self.PREFIX,"bin"))
         self._has_db_lock = 0
+        self.build_jobs = max(1,int(os.environ.get("MYPPY_BUILD_JOBS",1)))
+        self.fetch_jobs = max(0,int(os.environ.get("MYPPY_FETCH_JOBS",0)))
+        self.workers = max(1,int(os.environ.get("MYPPY_WORKERS",1)))
+        make_jobs = max(1,int(os.environ.get("MYPPY_MAKE_JOBS",1)))
+        if make_jobs > 1:
+            self.jobserver = JobServer(make_jobs)
+        else:
+            self.jobserver = None
+        self._downloader = Downloader()
+        cachedir = os.environ.get("MYPPY_DOWNLOAD_CACHE",self.DOWNLOAD_CACHE)
+        cachedir = os.path.expanduser(cachedir)
+        if not os.path.isabs(cachedir):
+            cachedir = os.path.join(self.rootdir,cachedir)
+        max_size = os.environ.get("MYPPY_DOWNLOAD_CACHE_SIZE")
+        if max_size:
+            max_size = util.parse_size(max_size)
+        segments = max(1,int(os.environ.get("MYPPY_DOWNLOAD_SEGMENTS",1)))
+        mirrors = os.environ.get("MYPPY_MIRRORS")
+        if mirrors:
+            mirrors = MirrorMap.load(mirrors)
+        recompress = os.environ.get("MYPPY_RECOMPRESS")
+        self.download_cache = DownloadCache(cachedir,self._downloader,
+                                            max_size or None,segments,
+                                            mirrors or None,
+                                            recompress or None)
+        trees = os.path.join(self.cachedir,"trees")
+        self.source_trees = SourceTreeCache(trees)
+        artifacts = os.path.join(self.cachedir,"artifacts")
+        artifacts = os.environ.get("MYPPY_ARTIFACT_CACHE",artifacts)
+        if artifacts:
+            if "://" not in artifacts and not os.path.isabs(artifacts):
+                artifacts = os.path.join(self.rootdir,artifacts)
+            store = get_artifact_store(artifacts)
+            workdir = os.path.join(self.builddir,"artifacts")
+            self.artifacts = ArtifactCache(store,workdir)
+        else:
+            self.artifacts = None
+        #  Recipes installed by this run, by what the artifact cache did.
+        self.artifact_report = {"hit":[],"miss":[],"uncacheable":[]}
+        self.resolver = DependencyResolver(self)
         if not os.path.exists(self.rootdir):
             os.makedirs(self.rootdir)
         dbpath = os.path.join(self.rootdir,self.DB_NAME)
@@ -71,6 +154,8 @@ class MyppyEnv(object):
             self._has_db_lock -= 1
             if not self._has_db_lock:
                 self._db.execute("ROLLBACK TRANSACTION")
+                self.resolver.invalidate()
+                self._file_snapshot = None
         else:
             self._has_db_lock -= 1
             if not self._has_db_lock:
@@ -112,8 +197,23 @@ class MyppyEnv(object):
 
     def init(self):
         """Build the base myppy python environment."""
-        for dep in self.DEPENDENCIES:
-            self.install(dep,initialising=True,explicit=False)
+        #  Later base dependencies may implicitly need the earlier ones
+        #  (e.g. everything needs the LSB compiler) so keep them in order.
+        self.install_recipes(self.DEPENDENCIES,initialising=True,
+                             explicit=False,ordered=True)
+        self.report_artifacts()
+
+    def report_artifacts(self):
+        """Print which recipes were installed from the artifact cache."""
+        if self.artifacts is None:
+            return
+        report = self.artifact_report
+        print "ARTIFACT CACHE: %d HITS, %d MISSES, %d UNCACHEABLE" \
+              % (len(report["hit"]),len(report["miss"]),
+                 len(report["uncacheable"]),)
+        for status in ("hit","miss","uncacheable",):
+            for recipe in report[status]:
+                print "   ", status.upper(), recipe
         
     def clean(self):
         """Clean out temporary built files and the like."""
@@ -121,10 +221,13 @@ class MyppyEnv(object):
             shutil.rmtree(self.builddir)
         if os.path.exists(self.cachedir):
             shutil.rmtree(self.cachedir)
-        q = "SELECT DISTINCT recipe FROM installed_files"
-        for row in self._db.execute(q):
+        q = "SELECT name FROM recipes WHERE EXISTS"\
+            " (SELECT 1 FROM recipe_files WHERE recipe_id=recipes.id)"
+        unneeded = []
+        for row in self._db.execute(q).fetchall():
             if not self.is_explicitly_installed(row[0]):
-                self.uninstall(row[0])
+                unneeded.append(row[0])
+        self.uninstall_recipes(unneeded)
         for fpath in self.find_new_files():
             if os.path.isfile(fpath) or os.path.islink(fpath):
                 os.unlink(fpath)
@@ -167,90 +270,592 @@ class MyppyEnv(object):
         return True
 
     def is_installed(self,recipe):
-        q = "SELECT filepath FROM installed_files WHERE recipe=? LIMIT 1"
+        q = "SELECT 1 FROM recipe_files WHERE recipe_id="\
+            " (SELECT id FROM recipes WHERE name=?) LIMIT 1"
         return (self._db.execute(q,(recipe,)).fetchone() is not None)
 
     def is_explicitly_installed(self,recipe):
         if not self.is_installed(recipe):
             return False
-        deps = set(self.DEPENDENCIES)
-        for row in self._db.execute("SELECT recipe FROM installed_recipes"):
-            deps.add(row[0])
-        todo = list(deps)
-        while todo:
-            r = self.load_recipe(todo.pop(0))
-            for dep in r.DEPENDENCIES:
-                if dep not in deps:
-                    deps.add(dep)
-                    todo.append(dep)
-        return recipe in deps
+        return recipe in self.resolver.get_required()
   
     def install(self,recipe,initialising=False,explicit=True):
         """Install the named recipe into this myppy env."""
-        if not self.is_installed(recipe):
-            r = self.load_recipe(recipe)
-            if not initialising and not self.is_initialised():
-                self.init()
-            for conflict in r.CONFLICTS_WITH:
+        self.install_recipes([recipe],initialising,explicit)
+
+    def install_recipes(self,recipes,initialising=False,explicit=True,
+                        ordered=False):
+        """Install the named recipes into this myppy env.
+
+        The complete dependency graph is resolved up front, then each recipe
+        is built as soon as all of its dependencies have been installed.  Up
+        to self.build_jobs recipes will be built concurrently.  If "ordered"
+        is true then each of the named recipes, along with any dependencies
+        it brings in, will wait for all of the recipes named before it.
+        """
+        recipes = list(recipes)
+        if not initialising and not self.is_initialised():
+            for recipe in recipes:
+                if not self.is_installed(recipe):
+                    self.init()
+                    break
+        (order,prereqs,loaded) = self._get_install_graph(recipes,ordered)
+        for recipe in order:
+            for conflict in loaded[recipe].CONFLICTS_WITH:
+                if conflict in prereqs:
+                    msg = "Recipe %r conflicts with %r, "
+                    msg += "which is also being installed"
+                    msg %= (recipe,conflict,)
+                    raise RuntimeError(msg)
                 if self.is_explicitly_installed(conflict):
                     msg = "Recipe %r conflicts with %r, "
                     msg += "which is already installed"
                     msg %= (recipe,conflict,)
                     raise RuntimeError(msg)
                 self.uninstall(conflict)
-            for dep in r.DEPENDENCIES:
-                if dep != recipe:
-                    self.install(dep,initialising=initialising,explicit=False)
-            for dep in r.BUILD_DEPENDENCIES:
-                if dep != recipe:
-                    self.install(dep,initialising=initialising,explicit=False)
-            print "FETCHING", recipe
-            r.fetch()
+        self._run_install_graph(order,prereqs,loaded)
+        if explicit:
+            for recipe in recipes:
+                if not self.is_explicitly_installed(recipe):
+                    with self:
+                        recipe_id = self._get_recipe_id(recipe,create=True)
+                        q = "UPDATE recipes SET explicit=1 WHERE id=?"
+                        self._db.execute(q,(recipe_id,))
+                    self.resolver.invalidate()
+
+    def _get_install_graph(self,recipes,ordered=False,skip_installed=True):
+        """Find all recipes that must be installed to get the named ones.
+
+        This returns a tuple (order,prereqs,loaded) where "order" lists the
+        recipes to install in a dependency-respecting order, "prereqs" maps
+        each recipe to the set of other recipes it must wait for, and "loaded"
+        maps each recipe name to a loaded recipe object.  Recipes that are
+        already installed are left out unless "skip_installed" is false.
+        """
+        order = []
+        prereqs = {}
+        loaded = {}
+        def add(recipe,stack):
+            if recipe in prereqs:
+                return
+            if skip_installed and self.is_installed(recipe):
+                return
+            if recipe in stack:
+                cycle = " -> ".join(stack[stack.index(recipe):] + [recipe])
+                raise RuntimeError("dependency cycle: %s" % (cycle,))
+            loaded[recipe] = self.resolver.get_recipe_class(recipe)(self)
+            deps = self.resolver.get_direct_dependencies(recipe)
+            stack.append(recipe)
+            for dep in deps:
+                add(dep,stack)
+            stack.pop()
+            prereqs[recipe] = set(dep for dep in deps if dep in prereqs)
+            order.append(recipe)
+        for recipe in recipes:
+            start = len(order)
+            add(recipe,[])
+            if ordered:
+                for nm in order[start:]:
+                    prereqs[nm].update(order[:start])
+        return (order,prereqs,loaded)
+
+    def _run_install_graph(self,order,prereqs,loaded):
+        """Build and install recipes from the given dependency graph.
+
+        Builds run in forked subprocesses so that they can proceed in parallel
+        (they chdir all over the place) but installation and recording of the
+        files is done one recipe at a time in this process, so that each new
+        file is attributed to the correct recipe.  Recipes that share a build
+        directory are never built at the same time.
+
+        If self.fetch_jobs is nonzero then the sources for every recipe are
+        downloaded in the background, and each recipe starts building as soon
+        as its own sources have arrived.
+
+        Recipes whose build key matches an artifact in self.artifacts aren't
+        fetched or built at all; the artifact is installed instead.
+        """
+        keys = self._get_build_keys(order,loaded)
+        cached = set()
+        if self.artifacts is not None:
+            for recipe in order:
+                key = keys[recipe]
+                if key is not None and self.artifacts.has(key):
+                    cached.add(recipe)
+        results = Queue.Queue()
+        tofetch = [nm for nm in order if nm not in cached]
+        #  Builds are forked from a helper started before any other threads,
+        #  such as those doing the prefetching.
+        builder = None
+        if self.build_jobs > 1:
+            def build(recipe):
+                return self._build_recipe_state(recipe,loaded[recipe])
+            def finished(recipe,state):
+                results.put((recipe,state))
+            builder = ForkServer(build,finished)
+        try:
+            self._schedule_install_graph(order,prereqs,loaded,keys,cached,
+                                         tofetch,results,builder)
+        finally:
+            if builder is not None:
+                builder.close()
+
+    def _schedule_install_graph(self,order,prereqs,loaded,keys,cached,
+                                tofetch,results,builder):
+        """Main loop of _run_install_graph."""
+        waiting = dict((nm,set(prereqs[nm])) for nm in order)
+        running = {}
+        fetches = {}
+        fetched = set()
+        if self.fetch_jobs and tofetch:
+            fetches = self.prefetch(tofetch,lambda url: results.put(url))
+        failed = []
+        while waiting or running:
+            fetching = False
+            if not failed:
+                for recipe in order:
+                    if len(running) >= self.build_jobs:
+                        break
+                    if recipe not in waiting or waiting[recipe]:
+                        continue
+                    r = loaded[recipe]
+                    if recipe in cached:
+                        del waiting[recipe]
+                        running[recipe] = None
+                        results.put((recipe,{}))
+                        continue
+                    if recipe in fetches:
+                        urls = [url for (url,_) in r.SOURCES]
+                        if not fetched.issuperset(urls):
+                            fetching = True
+                            continue
+                    srcnm = os.path.basename(r.SOURCE_URL)
+                    if srcnm in running.values():
+                        continue
+                    del waiting[recipe]
+                    try:
+                        for res in fetches.get(recipe,()):
+                            res.get()
+                    except Exception:
+                        traceback.print_exc()
+                        print "FAILED TO FETCH", recipe
+                        failed.append(recipe)
+                        continue
+                    if builder is None:
+                        self._build_recipe(recipe,r)
+                        results.put((recipe,{}))
+                    else:
+                        builder.run(recipe)
+                    running[recipe] = srcnm
+            if not running and not fetching:
+                if failed:
+                    break
+                raise RuntimeError("unable to schedule: %s" % (waiting,))
+            item = results.get()
+            if isinstance(item,basestring):
+                fetched.add(item)
+                continue
+            (recipe,state) = item
+            del running[recipe]
+            if recipe in cached:
+                try:
+                    self._install_artifact(recipe,loaded[recipe],keys[recipe])
+                except Exception:
+                    traceback.print_exc()
+                    print "FAILED TO INSTALL ARTIFACT FOR", recipe
+                    cached.discard(recipe)
+                    waiting[recipe] = set()
+                    continue
+                self.artifact_report["hit"].append(recipe)
+            else:
+                if state is None:
+                    print "FAILED TO BUILD", recipe
+                    failed.append(recipe)
+                    continue
+                loaded[recipe].__dict__.update(state)
+                self._install_built_recipe(recipe,loaded[recipe],keys[recipe])
+                if keys[recipe] is None:
+                    self.artifact_report["uncacheable"].append(recipe)
+                else:
+                    self.artifact_report["miss"].append(recipe)
+            for deps in waiting.itervalues():
+                deps.discard(recipe)
+        if failed:
+            raise RuntimeError("failed to build: %s" % (", ".join(failed),))
+
+    def _build_recipe(self,recipe,r):
+        """Fetch and build the given recipe, without installing it.
+
+        Recipes that support staged installs are also installed into their
+        staging dir, ready to be merged into the env.
+        """
+        print "FETCHING", recipe
+        r.fetch()
+        print "BUILDING", recipe
+        r.build()
+        if r.STAGED_INSTALL:
+            print "STAGING", recipe
+            if os.path.exists(r.STAGING_DIR):
+                shutil.rmtree(r.STAGING_DIR)
+            os.makedirs(r.STAGING_DIR)
+            r.install()
+
+    def _build_recipe_state(self,recipe,r):
+        """Build the given recipe in a forked subprocess, returning its state.
+
+        The state is the recipe object's __dict__ as it was at the end of the
+        build, so that it can be installed from the parent process exactly as
+        if it had been built there.
+        """
+        self._build_recipe(recipe,r)
+        state = r.__dict__.copy()
+        state.pop("target",None)
+        try:
+            pickle.dumps(state,pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            traceback.print_exc()
+            state = {}
+        return state
+
+    def _install_built_recipe(self,recipe,r,key=None):
+        """Install a built recipe and record the files that it created.
+
+        If a build key is given, the recorded files are also stored under
+        that key in the artifact cache.
+        """
+        with self:
+            print "INSTALLING", recipe
+            if r.STAGED_INSTALL:
+                files = self._merge_staged_files(r.STAGING_DIR)
+                shutil.rmtree(r.STAGING_DIR)
+            else:
+                r.install()
+                files = list(self.find_new_files())
+            print "RECORDING INSTALLED FILES FOR", recipe
+            self.record_files(recipe,files)
+            self._set_build_key(recipe,key)
+            print "INSTALLED", recipe
+        if key is not None and self.artifacts is not None:
+            print "CACHING ARTIFACT FOR", recipe
+            try:
+                self.artifacts.pack(key,self.rootdir,files)
+            except Exception:
+                traceback.print_exc()
+                print "FAILED TO CACHE ARTIFACT FOR", recipe
+
+    def _install_artifact(self,recipe,r,key):
+        """Install a recipe from the artifact cache, instead of building it.
+
+        The artifact is unpacked into the recipe's staging dir and merged
+        into the env just like a staged install.
+        """
+        stagedir = r.STAGING_DIR
+        if os.path.exists(stagedir):
+            shutil.rmtree(stagedir)
+        print "UNPACKING ARTIFACT FOR", recipe
+        try:
+            self.artifacts.unpack(key,stagedir + self.rootdir)
             with self:
-                print "BUILDING", recipe
-                r.build()
                 print "INSTALLING", recipe
-                r.install()
+                files = self._merge_staged_files(stagedir)
                 print "RECORDING INSTALLED FILES FOR", recipe
-                files = list(self.find_new_files())
                 self.record_files(recipe,files)
+                self._set_build_key(recipe,key)
                 print "INSTALLED", recipe
-        if explicit and not self.is_explicitly_installed(recipe):
-            q = "INSERT INTO installed_recipes VALUES (?)"
-            self._db.execute(q,(recipe,))
+        finally:
+            if os.path.exists(stagedir):
+                shutil.rmtree(stagedir)
+
+    def _get_build_keys(self,order,loaded):
+        """Get the build key of each recipe in an install graph.
+
+        Each key is a hash of the recipe's class source (including its base
+        classes), its source URLs and MD5s, its compiler flags and other
+        BUILD_KEY_ATTRS, and the keys of the recipes it depends on, including
+        the env's TOOLCHAIN recipes.  Keys for recipes in the graph are
+        computed from their current definitions, while those of other deps
+        are the keys recorded when they were installed.  The key is None if
+        any of those can't be determined, e.g. because one of its deps was
+        installed without a key being recorded.
+
+        Since the key of a recipe covers the keys of its deps, it doubles as
+        a fingerprint for noticing when an installed recipe is out of date.
+        """
+        keys = {}
+        def get_key(recipe,stack):
+            if recipe in keys:
+                return keys[recipe]
+            if recipe not in loaded:
+                return self._get_build_key(recipe)
+            if recipe in stack:
+                cycle = " -> ".join(stack[stack.index(recipe):] + [recipe])
+                raise RuntimeError("dependency cycle: %s" % (cycle,))
+            stack.append(recipe)
+            try:
+                keys[recipe] = self._compute_build_key(recipe,loaded[recipe],
+                                                       get_key,stack)
+            finally:
+                stack.pop()
+            return keys[recipe]
+        for recipe in order:
+            get_key(recipe,[])
+        return keys
+
+    def _compute_build_key(self,recipe,r,get_key,stack):
+        """Compute the build key for a single recipe; see _get_build_keys."""
+        depkeys = []
+        for dep in sorted(self._get_build_key_deps(recipe)):
+            depkey = get_key(dep,stack)
+            if depkey is None:
+                return None
+            depkeys.append((dep,depkey))
+        h = hashlib.sha256()
+        def add(*items):
+            h.update(repr(items))
+            h.update("\0")
+        add(ArtifactCache.FORMAT_VERSION,sys.platform,platform.machine(),
+            self.PREFIX,recipe)
+        for cls in type(r).__mro__:
+            if cls is not object:
+                try:
+                    source = inspect.getsource(cls)
+                except (IOError,TypeError,):
+                    #  Classes created on the fly have no source of
+                    #  their own, but their bases will.
+                    source = None
+                add(cls.__module__,cls.__name__,source)
+        add(r.SOURCES)
+        for attr in self.BUILD_KEY_ATTRS:
+            #  Only attributes the recipe doesn't define at all are skipped;
+            #  if computing one fails, so does computing the key.
+            if hasattr(type(r),attr):
+                value = getattr(r,attr)
+            else:
+                value = None
+            if value is not None and not isinstance(value,basestring):
+                value = list(value)
+            add(attr,value)
+        add(depkeys)
+        return h.hexdigest()
+
+    def _get_build_key_deps(self,recipe):
+        """Get the recipes whose build keys feed into the given recipe's."""
+        deps = set(self.resolver.get_direct_dependencies(recipe))
+        if recipe in self.TOOLCHAIN:
+            deps.update(self.TOOLCHAIN[:self.TOOLCHAIN.index(recipe)])
+        else:
+            deps.update(self.TOOLCHAIN)
+        return deps
+
+    def _get_build_key(self,recipe):
+        """Get the build key recorded for an installed recipe, or None."""
+        q = "SELECT build_key FROM recipes WHERE name=?"
+        row = self._db.execute(q,(recipe,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return str(row[0])
+
+    def _set_build_key(self,recipe,key):
+        """Record the build key for an installed recipe."""
+        with self:
+            recipe_id = self._get_recipe_id(recipe,create=True)
+            q = "UPDATE recipes SET build_key=? WHERE id=?"
+            self._db.execute(q,(key,recipe_id,))
+
+    def _merge_staged_files(self,stagedir):
+        """Move files from a staging dir into the env, returning new files.
+
+        The staging dir is expected to contain a single tree mirroring the
+        absolute path of this env, as created by "make install DESTDIR=..".
+        Existing files are replaced, but only files that weren't already
+        recorded as installed are returned.
+        """
+        stageroot = stagedir + self.rootdir
+        #  Everything must be under the staged copy of the env root.
+        dirpath = stagedir
+        while dirpath != stageroot:
+            names = [nm for (nm,_) in util.scandir(dirpath)]
+            if not names:
+                return []
+            nextnm = stageroot[len(dirpath)+1:].split(os.sep)[0]
+            if names != [nextnm]:
+                msg = "files staged outside of the env: %s"
+                raise RuntimeError(msg % (dirpath,))
+            dirpath = os.path.join(dirpath,nextnm)
+        files = []
+        todo = [stageroot]
+        while todo:
+            srcdir = todo.pop(0)
+            dstdir = self.rootdir + srcdir[len(stageroot):]
+            if not os.path.isdir(dstdir):
+                os.makedirs(dstdir)
+            names = list(util.scandir(srcdir))
+            if not names and not self._is_oldfile(dstdir + os.sep):
+                files.append(dstdir + os.sep)
+            for (nm,st) in names:
+                if st is None:
+                    msg = "undecodable filename in %s"
+                    raise RuntimeError(msg % (srcdir,))
+                srcpath = os.path.join(srcdir,nm)
+                dstpath = os.path.join(dstdir,nm)
+                if stat.S_ISDIR(st.st_mode):
+                    todo.append(srcpath)
+                else:
+                    if util.isrealdir(dstpath):
+                        raise RuntimeError("can't replace dir %s" % (dstpath,))
+                    os.rename(srcpath,dstpath)
+                    if not self._is_oldfile(dstpath):
+                        files.append(dstpath)
+        return files
+
+    def update(self):
+        """Rebuild any installed recipes that have changed since installation.
+
+        A recipe is out of date if the build key computed from its current
+        definition differs from the one recorded when it was installed.
+        Out-of-date recipes are rebuilt along with everything installed that
+        depends on them, in dependency order.  Recipes installed without a
+        recorded key are assumed to be up to date, and their key is recorded.
+        Any missing deps of the installed recipes are installed too.
+        """
+        q = "SELECT name, build_key, explicit FROM recipes WHERE EXISTS"\
+            " (SELECT 1 FROM recipe_files WHERE recipe_id=recipes.id)"
+        recorded = {}
+        explicit = []
+        for (recipe,key,is_explicit) in self._db.execute(q).fetchall():
+            #  Recipe names and keys go into other keys, so must be str.
+            recipe = str(recipe)
+            if key is not None:
+                key = str(key)
+            try:
+                self.resolver.get_recipe_class(recipe)
+            except (AttributeError,KeyError,):
+                print "NOT UPDATING UNKNOWN RECIPE", recipe
+                continue
+            recorded[recipe] = key
+            if is_explicit:
+                explicit.append(recipe)
+        (order,prereqs,loaded) = self._get_install_graph(sorted(recorded),
+                                                         skip_installed=False)
+        keys = self._get_build_keys(order,loaded)
+        stale = []
+        for recipe in order:
+            if recipe not in recorded:
+                print "MISSING", recipe
+                stale.append(recipe)
+            elif recorded[recipe] is not None \
+                    and recorded[recipe] != keys[recipe]:
+                print "CHANGED", recipe
+                stale.append(recipe)
+            else:
+                for dep in self._get_build_key_deps(recipe):
+                    if dep in stale:
+                        print "DEPENDS ON CHANGED", dep + ":", recipe
+                        stale.append(recipe)
+                        break
+        for recipe in order:
+            if recipe not in stale and recorded[recipe] is None:
+                self._set_build_key(recipe,keys[recipe])
+        if not stale:
+            print "EVERYTHING IS UP TO DATE"
+            return
+        print "UPDATING", " ".join(stale)
+        self.uninstall_recipes([recipe for recipe in stale
+                                if recipe in recorded])
+        for recipe in stale:
+            prereqs[recipe] = set(dep for dep in prereqs[recipe]
+                                  if dep in stale)
+        self._run_install_graph(stale,prereqs,loaded)
+        for recipe in explicit:
+            if recipe in stale:
+                with self:
+                    recipe_id = self._get_recipe_id(recipe,create=True)
+                    q = "UPDATE recipes SET explicit=1 WHERE id=?"
+                    self._db.execute(q,(recipe_id,))
+        self.resolver.invalidate()
 
     def uninstall(self,recipe):
         """Uninstall the named recipe from this myppy env."""
-        # TODO: remove things depending on it
+        self.uninstall_recipes([recipe])
+
+    def uninstall_recipes(self,recipes):
+        """Uninstall the named recipes from this myppy env.
+
+        The bookkeeping is done in bulk for all of the recipes at once, so
+        this is a lot faster than uninstalling them one at a time.
+        """
+        # TODO: remove things depending on them
         with self:
-            q = "DELETE FROM installed_recipes WHERE recipe=?"
-            self._db.execute(q,(recipe,))
-            q = "SELECT filepath FROM installed_files WHERE recipe=?"\
-                " ORDER BY filepath DESC"
-            files = [r[0] for r in self._db.execute(q,(recipe,))]
-            q = "DELETE FROM installed_files WHERE recipe=?"
-            self._db.execute(q,(recipe,))
+            recipe_ids = []
+            for recipe in recipes:
+                recipe_id = self._get_recipe_id(recipe)
+                if recipe_id is not None:
+                    recipe_ids.append((recipe_id,))
+            if not recipe_ids:
+                return
+            files = []
+            for (recipe_id,) in recipe_ids:
+                q = "SELECT explicit FROM recipes WHERE id=?"
+                if self._db.execute(q,(recipe_id,)).fetchone()[0]:
+                    self.resolver.invalidate()
+                q = "SELECT filepath FROM recipe_files WHERE recipe_id=?"
+                files.extend(r[0] for r in self._db.execute(q,(recipe_id,)))
+            q = "DELETE FROM recipe_files WHERE recipe_id=?"
+            self._db.executemany(q,recipe_ids)
+            self._db.executemany("DELETE FROM recipes WHERE id=?",recipe_ids)
             for file in files:
                 assert util.relpath(file) == file
-                if self._old_files_cache is not None:
-                    self._old_files_cache.remove(file)
-            for file in files:
-                filepath = os.path.join(self.rootdir,file)
-                if not os.path.exists(filepath):
-                    continue
-                if filepath.endswith(os.sep):
-                    print "PRUNING", filepath
-                    util.prune_dir(filepath)
-                else:
-                    print "REMOVING", filepath
-                    os.unlink(filepath)
-                    dirpath = os.path.dirname(filepath) + os.sep
-                    if not os.listdir(dirpath):
-                        q = "SELECT * FROM installed_files WHERE filepath=?"
-                        if not self._is_oldfile(dirpath):
-                            print "PRUNING", filepath
-                            util.prune_dir(dirpath)
-                
+            if self._old_files_cache is not None:
+                self._old_files_cache.difference_update(files)
+            self._remove_files(files)
+
+    def _remove_files(self,files):
+        """Remove the given files from the env, pruning any emptied dirs.
+
+        Files are unlinked using up to self.workers threads.  Then every
+        directory that might have been emptied is pruned, deepest first,
+        unless it has itself been recorded as an installed file.
+        """
+        filepaths = []
+        prune = set()
+        for file in sorted(files,reverse=True):
+            filepath = os.path.join(self.rootdir,file)
+            if filepath.endswith(os.sep):
+                prune.add(filepath)
+            else:
+                print "REMOVING", filepath
+                filepaths.append(filepath)
+        def remove(filepath):
+            try:
+                os.unlink(filepath)
+            except OSError, e:
+                if e.errno not in (errno.ENOENT,):
+                    raise
+        if self.workers > 1 and len(filepaths) > 1:
+            pool = ThreadPool(self.workers)
+            try:
+                pool.map(remove,filepaths,chunksize=100)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for filepath in filepaths:
+                remove(filepath)
+        seen = set()
+        for filepath in filepaths:
+            dirpath = os.path.dirname(filepath)
+            while dirpath.startswith(self.rootdir + os.sep):
+                if dirpath in seen:
+                    break
+                seen.add(dirpath)
+                if not self._is_oldfile(dirpath + os.sep):
+                    prune.add(dirpath + os.sep)
+                dirpath = os.path.dirname(dirpath)
+        #  A subdirectory's path is always longer than that of its parent.
+        for dirpath in sorted(prune,key=len,reverse=True):
+            if os.path.lexists(dirpath[:-1]) and util.prune_dir(dirpath):
+                print "PRUNING", dirpath
+
     def load_recipe(self,recipe):
         return getattr(_base_recipes,recipe)(self)
 
@@ -272,35 +877,56 @@ class MyppyEnv(object):
         for excl in (self.builddir,self.cachedir,):
             if path == excl or path.startswith(excl + os.sep):
                 return True
-        if os.path.basename(path) == "myppy.db":
-            return True
-        if os.path.basename(path) == "myppy.db-journal":
+        if os.path.basename(path) in ("myppy.db","myppy.db-journal",
+                                      "myppy.db-wal","myppy.db-shm",):
             return True
         return False
 
     def _is_oldfile(self,file):
         if self._old_files_cache is None:
             self._old_files_cache = set()
-            for r in self._db.execute("SELECT filepath FROM installed_files"):
+            for r in self._db.execute("SELECT filepath FROM recipe_files"):
                 self._old_files_cache.add(r[0])
         file = file[len(self.rootdir)+1:]
         assert util.relpath(file) == file
         if file in self._old_files_cache:
             return True
-        q = "SELECT * FROM installed_files WHERE filepath=?"
+        q = "SELECT 1 FROM recipe_files WHERE filepath=?"
         if self._db.execute(q,(file,)).fetchone():
             return True
         return False
  
     def find_new_files(self):
+        """Find all files in the env that aren't recorded as installed.
+
+        Walking the whole env is slow once it gets big, so the listing of
+        each directory is kept in the file_snapshot table along with that
+        directory's inode and mtime.  A directory whose inode and mtime
+        haven't changed can't have gained any new entries, so its listing
+        is taken from the snapshot rather than from the filesystem.
+        """
         #  os.walk has a bad habit of choking on unicode errors, so
         #  we do it by hand and get it right.  Anything that can't
         #  be decoded properly gets deleted.
+        snapshot = self._get_file_snapshot()
+        updates = {}
         todo = [self.rootdir]
         while todo:
             dirpath = todo.pop(0)
+            reldir = dirpath[len(self.rootdir)+1:]
             try:
-                names = os.listdir(dirpath)
+                st = os.lstat(dirpath)
+                (inode,mtime,names) = snapshot.get(reldir,(None,None,None))
+                if inode != st.st_ino or mtime != st.st_mtime:
+                    entries = self._scan_dir(dirpath)
+                    names = [(nm,isdir) for (nm,isdir,_) in entries]
+                    #  Changes made within the timestamp resolution of the
+                    #  filesystem won't show up in the mtime, so don't trust
+                    #  the listing of a very recently modified directory.
+                    mtime = st.st_mtime
+                    if mtime > time.time() - 2:
+                        mtime = -1
+                    updates[reldir] = (st.st_ino,mtime,entries)
             except OSError, e:
                 if e.errno not in (errno.ENOENT,):
                     raise
@@ -309,68 +935,321 @@ class MyppyEnv(object):
                 if not self._is_oldfile(dirpath + os.sep):
                     yield dirpath + os.sep
             else:
-                for nm in names:
-                    try:
-                        fpath = os.path.join(dirpath,nm)
-                    except UnicodeDecodeError:
-                        with util.cd(dirpath):
-                            if util.isrealdir(nm):
-                                shutil.rmtree(nm)
-                            else:
-                                os.unlink(nm)
+                for (nm,isdir) in names:
+                    fpath = os.path.join(dirpath,nm)
+                    if not self._is_tempfile(fpath):
+                        if isdir:
+                            todo.append(fpath)
+                        else:
+                            if not self._is_oldfile(fpath):
+                                yield fpath
+        self._update_file_snapshot(updates)
+
+    def _scan_dir(self,dirpath):
+        """List (name,isdir,stat) tuples for the entries in a directory.
+
+        Any entry whose name can't be decoded properly is deleted.
+        """
+        entries = []
+        for (nm,st) in util.scandir(dirpath):
+            if st is None:
+                with util.cd(dirpath):
+                    if util.isrealdir(nm):
+                        shutil.rmtree(nm)
                     else:
-                        if not self._is_tempfile(fpath):
-                            if util.isrealdir(fpath):
-                                todo.append(fpath)
-                            else:
-                                if not self._is_oldfile(fpath):
-                                    yield fpath
+                        os.unlink(nm)
+            else:
+                entries.append((nm,stat.S_ISDIR(st.st_mode),st))
+        return entries
+
+    def _get_file_snapshot(self):
+        """Get the snapshot of the env's directory listings.
+
+        This is a dict mapping each directory (relative to the env root) to
+        a tuple (inode,mtime,names) giving the inode and mtime at which it
+        was listed, and a list of (name,isdir) pairs for its entries.
+        """
+        if self._file_snapshot is None:
+            snapshot = {}
+            q = "SELECT path, inode, mtime FROM file_snapshot WHERE isdir"
+            for (path,inode,mtime) in self._db.execute(q):
+                snapshot[path] = (inode,mtime,[])
+            q = "SELECT parent, path, isdir FROM file_snapshot"\
+                " WHERE parent IS NOT NULL"
+            for (parent,path,isdir) in self._db.execute(q):
+                nm = os.path.basename(path)
+                snapshot[parent][2].append((nm,bool(isdir)))
+            self._file_snapshot = snapshot
+        return self._file_snapshot
+
+    def _update_file_snapshot(self,updates):
+        """Store fresh directory listings in the snapshot.
+
+        The argument maps relative directory paths to a tuple giving the
+        inode and mtime of the directory, and a list of (name,isdir,stat)
+        tuples for its entries.  A directory's own inode and mtime are only
+        ever stored when that directory itself has been listed.
+        """
+        if not updates:
+            return
+        snapshot = self._get_file_snapshot()
+        with self:
+            for (reldir,(inode,mtime,entries)) in updates.iteritems():
+                if reldir in snapshot:
+                    q = "UPDATE file_snapshot SET inode=?, mtime=?"\
+                        " WHERE path=?"
+                    self._db.execute(q,(inode,mtime,reldir,))
+                    old_subdirs = set(nm for (nm,isdir) in snapshot[reldir][2]
+                                      if isdir)
+                else:
+                    q = "INSERT INTO file_snapshot VALUES (?,?,1,?,0,?)"
+                    parent = os.path.dirname(reldir) if reldir else None
+                    self._db.execute(q,(reldir,parent,inode,mtime,))
+                    old_subdirs = set()
+                q = "DELETE FROM file_snapshot WHERE parent=? AND NOT isdir"
+                self._db.execute(q,(reldir,))
+                for (nm,isdir,_) in entries:
+                    if isdir:
+                        old_subdirs.discard(nm)
+                for nm in old_subdirs:
+                    self._forget_snapshot_dir(os.path.join(reldir,nm))
+                for (nm,isdir,st) in entries:
+                    path = os.path.join(reldir,nm)
+                    if not isdir:
+                        q = "INSERT INTO file_snapshot VALUES (?,?,0,?,?,?)"
+                        self._db.execute(q,(path,reldir,st.st_ino,
+                                            st.st_size,st.st_mtime,))
+                    elif path not in snapshot and path not in updates:
+                        #  This hasn't been listed, so it's not yet valid.
+                        q = "INSERT INTO file_snapshot VALUES (?,?,1,?,0,-1)"
+                        self._db.execute(q,(path,reldir,st.st_ino,))
+                        snapshot[path] = (st.st_ino,-1,[])
+                names = [(nm,isdir) for (nm,isdir,_) in entries]
+                snapshot[reldir] = (inode,mtime,names)
+
+    def _forget_snapshot_dir(self,reldir):
+        """Remove a directory and its contents from the snapshot."""
+        (_,_,names) = self._file_snapshot.pop(reldir,(None,None,()))
+        for (nm,isdir) in names:
+            if isdir:
+                self._forget_snapshot_dir(os.path.join(reldir,nm))
+        self._db.execute("DELETE FROM file_snapshot WHERE parent=?",(reldir,))
+        self._db.execute("DELETE FROM file_snapshot WHERE path=?",(reldir,))
 
     def record_files(self,recipe,files):
         """Record the given list of files as installed for the given recipe."""
         files = list(files)
         assert files, "recipe '%s' didn't install any files" % (recipe,)
+        files = [file[len(self.rootdir)+1:] for file in files]
         for file in files:
-            file = file[len(self.rootdir)+1:]
             assert util.relpath(file) == file
-            self._db.execute("INSERT INTO installed_files VALUES (?,?)",
-                             (recipe,file,))
-            if self._old_files_cache is not None:
-                self._old_files_cache.add(file)
+        with self:
+            recipe_id = self._get_recipe_id(recipe,create=True)
+            q = "INSERT INTO recipe_files (recipe_id, filepath) VALUES (?,?)"
+            self._db.executemany(q,((recipe_id,file) for file in files))
+        if self._old_files_cache is not None:
+            self._old_files_cache.update(files)
 
     def _initdb(self):
-        self._db.execute("CREATE TABLE IF NOT EXISTS installed_recipes ("
-                         "  recipe STRING NOT NULL"
+        """Create or upgrade the database schema.
+
+        The schema version is kept in sqlite's "user_version" pragma, and
+        databases from older versions of myppy are migrated in place by the
+        _migrate_db_to_vN methods.
+        """
+        #  Let readers get at the db during long-running installs.
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        with self:
+            version = self._db.execute("PRAGMA user_version").fetchone()[0]
+            if version > self.DB_VERSION:
+                msg = "%s is from a newer version of myppy (schema v%d)"
+                raise RuntimeError(msg % (self.DB_NAME,version,))
+            while version < self.DB_VERSION:
+                version += 1
+                getattr(self,"_migrate_db_to_v%d" % (version,))()
+                self._db.execute("PRAGMA user_version=%d" % (version,))
+
+    def _migrate_db_to_v1(self):
+        """Move to indexed tables, keeping any files recorded by older envs.
+
+        Unversioned databases have an "installed_recipes" table listing the
+        explicitly-installed recipes and an unindexed "installed_files" table
+        of (recipe,filepath) pairs.  These are replaced by views over the new
+        tables so that any external tools reading them keep working.
+        """
+        self._db.execute("CREATE TABLE recipes ("
+                         "  id INTEGER PRIMARY KEY,"
+                         "  name TEXT NOT NULL UNIQUE,"
+                         "  explicit INTEGER NOT NULL DEFAULT 0"
                          ")")
-        self._db.execute("CREATE TABLE IF NOT EXISTS installed_files ("
-                         "  recipe STRING NOT NULL,"
-                         "  filepath STRING NOT NULL"
+        self._db.execute("CREATE TABLE recipe_files ("
+                         "  id INTEGER PRIMARY KEY,"
+                         "  recipe_id INTEGER NOT NULL REFERENCES recipes(id),"
+                         "  filepath TEXT NOT NULL UNIQUE"
+                         ")")
+        self._db.execute("CREATE INDEX recipe_files_recipe_id"
+                         "  ON recipe_files (recipe_id)")
+        q = "SELECT name FROM sqlite_master WHERE type='table'"
+        tables = set(row[0] for row in self._db.execute(q))
+        if "installed_recipes" in tables:
+            self._db.execute("INSERT OR IGNORE INTO recipes (name, explicit)"
+                             "  SELECT DISTINCT recipe, 1"
+                             "  FROM installed_recipes")
+            self._db.execute("DROP TABLE installed_recipes")
+        if "installed_files" in tables:
+            self._db.execute("INSERT OR IGNORE INTO recipes (name)"
+                             "  SELECT DISTINCT recipe FROM installed_files")
+            self._db.execute("INSERT OR IGNORE INTO recipe_files"
+                             "  (recipe_id, filepath)"
+                             "  SELECT recipes.id, installed_files.filepath"
+                             "  FROM installed_files JOIN recipes"
+                             "  ON recipes.name = installed_files.recipe")
+            self._db.execute("DROP TABLE installed_files")
+        self._db.execute("CREATE VIEW installed_recipes AS"
+                         "  SELECT name AS recipe FROM recipes"
+                         "  WHERE explicit")
+        self._db.execute("CREATE VIEW installed_files AS"
+                         "  SELECT recipes.name AS recipe,"
+                         "         recipe_files.filepath AS filepath"
+                         "  FROM recipe_files JOIN recipes"
+                         "  ON recipes.id = recipe_files.recipe_id")
+        #  The snapshot is only a cache, so just start it afresh.
+        self._db.execute("DROP TABLE IF EXISTS file_snapshot")
+        self._db.execute("CREATE TABLE file_snapshot ("
+                         "  path TEXT NOT NULL PRIMARY KEY,"
+                         "  parent TEXT,"
+                         "  isdir INTEGER NOT NULL,"
+                         "  inode INTEGER NOT NULL,"
+                         "  size INTEGER NOT NULL,"
+                         "  mtime REAL NOT NULL"
+                         ")")
+        self._db.execute("CREATE INDEX file_snapshot_parent"
+                         "  ON file_snapshot (parent)")
+
+    def _migrate_db_to_v2(self):
+        """Add a cache of binary post-processing results.
+
+        Envs that audit or modify binaries as they are installed can store
+        what they found here, keyed by a hash of the file contents, so that
+        identical binaries don't have to be processed again.
+        """
+        self._db.execute("CREATE TABLE binary_audit ("
+                         "  hash TEXT NOT NULL PRIMARY KEY,"
+                         "  policy INTEGER NOT NULL,"
+                         "  glibc TEXT,"
+                         "  glibcxx TEXT,"
+                         "  errors TEXT NOT NULL,"
+                         "  stripped INTEGER NOT NULL,"
+                         "  rpath TEXT"
                          ")")
 
+    def _migrate_db_to_v3(self):
+        """Record the build key of each installed recipe.
+
+        Recipes installed before this version have no key, so anything that
+        depends on them can't be installed from the artifact cache.
+        """
+        self._db.execute("ALTER TABLE recipes ADD COLUMN build_key TEXT")
+
+    def _get_recipe_id(self,recipe,create=False):
+        """Get the id of the named recipe's row in the db.
+
+        If there's no such row this returns None, unless "create" is true in
+        which case the row is created.
+        """
+        q = "SELECT id FROM recipes WHERE name=?"
+        row = self._db.execute(q,(recipe,)).fetchone()
+        if row is not None:
+            return row[0]
+        if not create:
+            return None
+        q = "INSERT INTO recipes (name) VALUES (?)"
+        return self._db.execute(q,(recipe,)).lastrowid
+
     def fetch(self,url,md5=None):
         """Fetch the file at the given URL, using cached version if possible."""
-        cachedir = os.environ.get("MYPPY_DOWNLOAD_CACHE",self.cachedir)
-        if cachedir:
-            if not os.path.isabs(cachedir[0]):
-                cachedir = os.path.join(self.rootdir,cachedir)
-            if not os.path.isdir(cachedir):
-                os.makedirs(cachedir)
-        nm = os.path.basename(urlparse.urlparse(url).path)
-        cachefile = os.path.join(cachedir,nm)
-        if md5 is not None and os.path.exists(cachefile):
-            if md5 != util.md5file(cachefile):
-                print "BAD MD5 FOR", cachefile
-                print md5, util.md5file(cachefile)
-                os.unlink(cachefile)
-        if not os.path.exists(cachefile):
-            print "DOWNLOADING", url
-            fIn = urllib2.urlopen(url)
+        #  Remember what we've already fetched, so that forked builds don't
+        #  have to open the cache index while prefetch threads are using it.
+        (path,path_md5) = self._fetched.get(url,(None,None))
+        if path is None or (md5 is not None and md5 != path_md5) \
+                        or not os.path.exists(path):
+            path = self.download_cache.fetch(url,md5)
+            self._fetched[url] = (path,md5)
+        return path
+
+    def unpack(self,src,destdir):
+        """Unpack a fetched source archive into the given directory.
+
+        Archives are extracted once into the env's cache of source trees,
+        then cloned into place.  If the download cache has a recompressed
+        copy of the archive, that's extracted in preference to the original.
+        """
+        sha256 = self.download_cache.get_sha256(src)
+        fastsrc = self.download_cache.get_fast_copy(src)
+        self.source_trees.unpack(fastsrc or src,destdir,sha256)
+
+    def prefetch(self,recipes,callback=None):
+        """Start downloading the source files for the named recipes.
+
+        Downloads happen in a pool of up to self.fetch_jobs background threads.
+        This returns a dict mapping each recipe name to a list of AsyncResult
+        objects, one per source file.  If given, the callback function will be
+        called with the URL of each download as it finishes, successfully
+        or otherwise.
+        """
+        pool = ThreadPool(max(1,self.fetch_jobs))
+        pending = {}
+        downloads = {}
+        def fetch(url,md5):
             try:
-                 with open(cachefile,"wb") as fOut:
-                    shutil.copyfileobj(fIn,fOut)
+                return self.fetch(url,md5)
             finally:
-                fIn.close()
-        if md5 is not None and md5 != util.md5file(cachefile):
-            raise RuntimeError("corrupted download: %s" % (url,))
-        return cachefile
+                if callback is not None:
+                    callback(url)
+        try:
+            for recipe in recipes:
+                pending[recipe] = []
+                for (url,md5) in self.resolver.get_recipe(recipe).SOURCES:
+                    if url not in downloads:
+                        downloads[url] = pool.apply_async(fetch,(url,md5))
+                    pending[recipe].append(downloads[url])
+        finally:
+            pool.close()
+        return pending
+
+    def fetch_recipes(self,recipes):
+        """Download the sources for the named recipes and all their deps."""
+        (order,_,_) = self._get_install_graph(recipes,skip_installed=False)
+        failed = []
+        for (recipe,results) in self.prefetch(order).iteritems():
+            for res in results:
+                try:
+                    res.get()
+                except Exception:
+                    traceback.print_exc()
+                    failed.append(recipe)
+        if failed:
+            raise RuntimeError("failed to fetch: %s" % (", ".join(failed),))
+
+    def bundle_sources(self,recipes,bundle):
+        """Write the sources for the named recipes and their deps to a file.
+
+        Any sources that aren't already cached are downloaded first.  The
+        bundle can be loaded into another download cache using the
+        import_sources() method.
+        """
+        self.fetch_recipes(recipes)
+        (order,_,_) = self._get_install_graph(recipes,skip_installed=False)
+        urls = []
+        for recipe in order:
+            for (url,_) in self.resolver.get_recipe(recipe).SOURCES:
+                if url not in urls:
+                    urls.append(url)
+        with open(bundle,"wb") as f:
+            self.download_cache.write_bundle(f,urls)
 
+    def import_sources(self,bundle):
+        """Load the sources from a bundle file into the download cache."""
+        with open(bundle,"rb") as f:
+            return self.download_cache.read_bundle(f)
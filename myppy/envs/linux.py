@@ -5,8 +5,12 @@ from __future__ import with_statement
 
 import os
 import stat
-import subprocess
+import errno
+import hashlib
+import multiprocessing
 
+from myppy import util
+from myppy import elf
 from myppy.envs import base
 
 from myppy.recipes import linux as _linux_recipes
@@ -14,9 +18,39 @@ from myppy.recipes import linux as _linux_recipes
 
 class MyppyEnv(base.MyppyEnv):
 
-    DEPENDENCIES = ["bin_lsbsdk","patchelf"]
+    DEPENDENCIES = ["bin_lsbsdk"]
     DEPENDENCIES.extend(base.MyppyEnv.DEPENDENCIES)
 
+    TOOLCHAIN = ["bin_lsbsdk"]
+
+    #  Bump this whenever the way binaries are checked or modified changes,
+    #  to throw away previously cached results.
+    AUDIT_POLICY = 3
+
+    #  Binaries must not need symbols from these versions of these libs
+    #  or newer.  Override with e.g. MYPPY_VERSION_LIMITS="GLIBC_2.5".
+    SYMBOL_VERSION_LIMITS = {"GLIBC_":"2.4","GLIBCXX_":"3.4.8"}
+
+    #  Directories searched for libraries that aren't provided by the env.
+    SYSTEM_LIB_DIRS = {
+        32: ["/lib","/usr/lib","/lib32","/usr/lib32",
+             "/lib/i386-linux-gnu","/usr/lib/i386-linux-gnu"],
+        64: ["/lib64","/usr/lib64","/lib/x86_64-linux-gnu",
+             "/usr/lib/x86_64-linux-gnu","/lib","/usr/lib"],
+    }
+
+    #  Everything is linked with this as its rpath, to reserve room in the
+    #  binary for the relative rpath that we later set in its place.
+    RPATH_PLACEHOLDER = "/__myppy_rpath_placeholder__".ljust(128,"_")
+
+    #  Likewise for the interpreter, which we later change to INTERPRETER.
+    #  Extra slashes keep this a working path to the LSB loader until then.
+    INTERPRETER = "/lib/ld-linux.so.2"
+    INTERP_PLACEHOLDER = "/lib" + "/" * 48 + "ld-lsb.so.3"
+
+    #  Compiler wrappers that get put behind ccache, if it's enabled.
+    CCACHE_COMPILERS = ("lsbcc","lsbc++",)
+
     @property
     def CC(self):
         return "lsbcc -m32"
@@ -25,9 +59,17 @@ class MyppyEnv(base.MyppyEnv):
     def CXX(self):
         return "lsbc++ -m32"
 
+    #  Recipes that don't use LDFLAGS must get these into their link flags
+    #  some other way, or their binaries can't be relocated.
+    @property
+    def PLACEHOLDER_LDFLAGS(self):
+        flags = "-Wl,-rpath," + self.RPATH_PLACEHOLDER
+        flags += " -Wl,--dynamic-linker=" + self.INTERP_PLACEHOLDER
+        return flags
+
     @property
     def LDFLAGS(self):
-        flags = "-m32"
+        flags = "-m32 " + self.PLACEHOLDER_LDFLAGS
         for libdir in ("lib", "opt/lsb/lib"):
             flags += " -L" + os.path.join(self.PREFIX,libdir)
         return flags
@@ -57,6 +99,10 @@ class MyppyEnv(base.MyppyEnv):
 
     def __init__(self,rootdir):
         super(MyppyEnv,self).__init__(rootdir)
+        self._audit_cache = None
+        self.version_limits = dict(self.SYMBOL_VERSION_LIMITS)
+        for spec in os.environ.get("MYPPY_VERSION_LIMITS","").split():
+            self.set_version_limit(spec)
         if not os.path.exists(os.path.join(self.PREFIX,"lib")):
             os.makedirs(os.path.join(self.PREFIX,"lib"))
         self.env["CC"] = self.CC
@@ -73,78 +119,406 @@ class MyppyEnv(base.MyppyEnv):
         self.env["LSB_SHAREDLIBPATH"] = os.path.join(self.PREFIX,"lib")
         self.env["LSBCC_SHAREDLIBS"] = "python:python2.7:crypto:readline:bz2"
         self.env["LSBCC_VERBOSE"] = os.path.join(self.PREFIX,"lib")
+        self.ccache_dir = os.environ.get("MYPPY_CCACHE_DIR") or None
+        if self.ccache_dir is not None:
+            self._setup_ccache()
+
+    def _setup_ccache(self):
+        """Put ccache in front of the LSB compiler wrappers.
+
+        ccache runs in "masquerade" mode, via symlinks named after lsbcc and
+        lsbc++ at the front of $PATH, so the CC and CXX seen by the recipes
+        (and hence their build keys) don't change.  The cache is shared by
+        all envs using the same MYPPY_CCACHE_DIR: paths under the env root
+        are hashed relative to it, and the LSBCC_* settings that control how
+        the wrappers rewrite include and library paths are hashed along with
+        the compiler itself, again relative to the env root.
+        """
+        ccache = util.which("ccache")
+        if ccache is None:
+            print "CCACHE NOT FOUND, NOT CACHING COMPILER OUTPUT"
+            self.ccache_dir = None
+            return
+        ccache = os.path.abspath(ccache)
+        bindir = os.path.join(self.cachedir,"ccache-bin")
+        if not os.path.isdir(bindir):
+            os.makedirs(bindir)
+        for nm in self.CCACHE_COMPILERS:
+            path = os.path.join(bindir,nm)
+            if os.path.islink(path) and os.readlink(path) == ccache:
+                continue
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(ccache,path)
+        self._add_env_path("PATH",bindir)
+        ccache_dir = os.path.abspath(os.path.expanduser(self.ccache_dir))
+        self.env["CCACHE_DIR"] = ccache_dir
+        self.env["CCACHE_BASEDIR"] = self.rootdir
+        self.env["CCACHE_NOHASHDIR"] = "1"
+        settings = []
+        for (k,v) in sorted(self.env.iteritems()):
+            if k.startswith(("LSBCC","LSBCXX","LSB_",)):
+                settings.append((k,v.replace(self.rootdir,"<ROOT>")))
+        digest = hashlib.sha1(repr(settings)).hexdigest()
+        check = "%%compiler%% -v;cksum %%compiler%%;echo %s" % (digest,)
+        self.env["CCACHE_COMPILERCHECK"] = check
+
+    def _build_recipe(self,recipe,r):
+        """Build the given recipe, reporting how well ccache did for it."""
+        if self.ccache_dir is None:
+            return super(MyppyEnv,self)._build_recipe(recipe,r)
+        if not os.path.isdir(self.builddir):
+            os.makedirs(self.builddir)
+        statslog = os.path.join(self.builddir,recipe + ".ccache-stats")
+        if os.path.exists(statslog):
+            os.unlink(statslog)
+        self.env["CCACHE_STATSLOG"] = statslog
+        try:
+            super(MyppyEnv,self)._build_recipe(recipe,r)
+        finally:
+            del self.env["CCACHE_STATSLOG"]
+        (hits,misses) = _read_ccache_stats(statslog)
+        if hits or misses:
+            rate = 100.0 * hits / (hits + misses)
+            print "COMPILER CACHE FOR %s: %d HITS, %d MISSES (%.0f%%)" \
+                  % (recipe,hits,misses,rate,)
 
     def record_files(self,recipe,files):
+        files = list(files)
         if recipe not in ("bin_lsbsdk",):
-            for fpath in files:
-                fpath = os.path.join(self.rootdir,fpath)
-                fnm = os.path.basename(fpath)
-                if fpath == os.path.realpath(fpath):
-                    if fnm.endswith(".so") or ".so." in fnm:
-                        self._check_glibc_symbols(fpath)
-                        if recipe not in ("python27",):
-                            self._strip(fpath)
-                        self._adjust_rpath(fpath)
-                    elif "." not in fnm or os.access(fpath, os.X_OK):
-                        fileinfo = self.bt("file",fpath)
-                        if "executable" in fileinfo and "ELF" in fileinfo:
-                            if recipe not in ("python27",):
-                                self._strip(fpath)
-                            self._adjust_rpath(fpath)
-                            self._adjust_interp_path(fpath)
+            self._postprocess_files(recipe,files)
         super(MyppyEnv,self).record_files(recipe,files)
 
+    def _postprocess_files(self,recipe,files):
+        """Strip, check and relocate the binaries among the given files.
+
+        The work is spread over a pool of self.workers processes.  Problems
+        with individual files are collected rather than stopping at the first
+        one, and reported together in a single RuntimeError.
+
+        Results are cached in the db by hash of the file contents, so a
+        binary that's identical to one seen before isn't checked again, and
+        one that's identical to already-processed output is left alone.
+        """
+        fpaths = []
+        for fpath in files:
+            fpath = os.path.join(self.rootdir,fpath)
+            if fpath == os.path.realpath(fpath):
+                fnm = os.path.basename(fpath)
+                if fnm.endswith(".so") or ".so." in fnm:
+                    fpaths.append(fpath)
+                elif "." not in fnm or os.access(fpath, os.X_OK):
+                    fpaths.append(fpath)
+        #  Worker processes can't use the db, so give them a copy of the
+        #  cache entries for these files and have them send back new ones.
+        #  Any errors reading the files are left for the workers to report.
+        jobs = []
+        hashes = []
+        for fpath in fpaths:
+            hash = None
+            try:
+                if elf.is_elf(fpath):
+                    hash = util.sha1file(fpath)
+                    hashes.append(hash)
+            except EnvironmentError:
+                pass
+            jobs.append((recipe,fpath,hash))
+        self._audit_cache = {}
+        for i in xrange(0,len(hashes),500):
+            batch = hashes[i:i+500]
+            q = "SELECT hash, glibc, glibcxx, errors, stripped, rpath" \
+                "  FROM binary_audit WHERE policy=? AND hash IN (%s)"
+            q %= (",".join("?" * len(batch)),)
+            for row in self._db.execute(q,[self.AUDIT_POLICY] + batch):
+                self._audit_cache[row[0]] = row[1:]
+        if self.workers > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(self.workers,_init_worker,(self,))
+            try:
+                results = pool.map(_postprocess_file_worker,jobs,chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._postprocess_file(*job) for job in jobs]
+        self._audit_cache = None
+        errors = []
+        entries = []
+        for (fpath,(file_errors,file_entries)) in zip(fpaths,results):
+            for error in file_errors:
+                errors.append("%s: %s" % (fpath,error,))
+            for (hash,entry) in file_entries:
+                entries.append((hash,self.AUDIT_POLICY) + entry)
+        with self:
+            q = "INSERT OR REPLACE INTO binary_audit" \
+                "  (hash, policy, glibc, glibcxx, errors, stripped, rpath)" \
+                "  VALUES (?,?,?,?,?,?,?)"
+            self._db.executemany(q,entries)
+        if errors:
+            msg = "problems with binaries from '%s':\n" % (recipe,)
+            raise RuntimeError(msg + "\n".join(errors))
+
+    def _postprocess_file(self,recipe,fpath,hash=None):
+        """Post-process a single file.
+
+        This returns a list of error messages, and a list of (hash,entry)
+        pairs to be added to the cache of audit results.
+        """
+        try:
+            if not elf.is_elf(fpath):
+                return ([],[])
+            fnm = os.path.basename(fpath)
+            is_lib = fnm.endswith(".so") or ".so." in fnm
+            strip = recipe not in ("python27",)
+            rpath = self._get_rpath(fpath)
+            if hash is None:
+                hash = util.sha1file(fpath)
+            cached = self._audit_cache.get(hash)
+            if cached is not None:
+                (glibc,glibcxx,_,stripped,done_rpath) = cached
+                #  The limits may have changed since this was cached.
+                errors = []
+                if is_lib and (self._is_too_new("GLIBC_",glibc) or
+                               self._is_too_new("GLIBCXX_",glibcxx)):
+                    errors = self._check_glibc_symbols(fpath)
+                if (stripped or not strip) and done_rpath == rpath:
+                    print "SKIPPING UNCHANGED BINARY", fpath
+                    return (errors,[])
+                info = elf.read_elf(fpath)
+            else:
+                info = elf.read_elf(fpath)
+                glibc = self._get_max_version(info,"GLIBC_")
+                glibcxx = self._get_max_version(info,"GLIBCXX_")
+                errors = []
+                if is_lib:
+                    errors = self._check_glibc_symbols(fpath,info)
+            if not is_lib and not info.is_executable:
+                return (errors,[])
+            if strip:
+                self._strip(fpath)
+            if not self._adjust_rpath(fpath,info):
+                errors.append("no room to set rpath to " + rpath)
+                rpath = None
+            if not is_lib and not self._adjust_interp_path(fpath,info):
+                errors.append("no room to set interpreter to " +
+                              self.INTERPRETER)
+            entries = []
+            if cached is None:
+                entry = (glibc,glibcxx,"\n".join(errors),0,None)
+                entries.append((hash,entry))
+            entry = (glibc,glibcxx,"\n".join(errors),int(strip),rpath)
+            entries.append((util.sha1file(fpath),entry))
+            return (errors,entries)
+        except Exception, e:
+            return (["%s: %s" % (e.__class__.__name__,e,)],[])
+
+    def audit(self):
+        """Check the portability of every ELF binary in the env.
+
+        Files are scanned in parallel using a pool of self.workers processes.
+        The result is a dict suitable for dumping as JSON, giving the version
+        limits that were applied, the number of files with problems, and for
+        each ELF file its interpreter, rpath, the newest GLIBC_ and GLIBCXX_
+        versions it needs, and any needed libraries that can't be found.
+        """
+        fpaths = []
+        todo = [self.PREFIX]
+        while todo:
+            dirpath = todo.pop()
+            for (nm,st) in util.scandir(dirpath):
+                if st is None:
+                    continue
+                fpath = os.path.join(dirpath,nm)
+                if stat.S_ISDIR(st.st_mode):
+                    todo.append(fpath)
+                elif stat.S_ISREG(st.st_mode) and not self._is_tempfile(fpath):
+                    fpaths.append(fpath)
+        fpaths.sort()
+        if self.workers > 1 and len(fpaths) > 1:
+            pool = multiprocessing.Pool(self.workers,_init_worker,(self,))
+            try:
+                results = pool.map(_audit_file_worker,fpaths,chunksize=64)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._audit_file(fpath) for fpath in fpaths]
+        files = [r for r in results if r is not None]
+        failures = [r for r in files if r["errors"] or r["unresolved"]]
+        return {"limits": dict(self.version_limits),
+                "failures": len(failures),
+                "files": files}
+
+    def _audit_file(self,fpath):
+        """Audit a single file, returning a dict of results or None."""
+        relpath = fpath[len(self.rootdir)+1:]
+        try:
+            info = elf.read_elf(fpath,symbols=False)
+        except (EnvironmentError,ValueError), e:
+            return {"path": relpath, "errors": [str(e)], "unresolved": []}
+        if info is None:
+            return None
+        result = {"path": relpath, "type": info.type,
+                  "interpreter": info.interpreter,
+                  "rpath": info.rpath, "runpath": info.runpath,
+                  "needed": info.needed, "unresolved": [], "errors": []}
+        for prefix in sorted(self.version_limits):
+            version = self._get_max_version(info,prefix)
+            result[prefix.rstrip("_").lower()] = version
+            if self._is_too_new(prefix,version):
+                #  Only now is it worth finding the offending symbols.
+                if not info.symbol_versions:
+                    info = elf.read_elf(fpath)
+                for (version,symbols) in info.requires_version(prefix):
+                    if self._is_too_new(prefix,version[len(prefix):]):
+                        msg = "%s: %s" % (version," ".join(symbols),)
+                        result["errors"].append(msg)
+        libdirs = elf.get_library_path(info)
+        libdirs.append(os.path.join(self.PREFIX,"lib"))
+        libdirs.extend(self.SYSTEM_LIB_DIRS.get(info.elfclass,()))
+        for lib in info.needed:
+            for libdir in libdirs:
+                if os.path.exists(os.path.join(libdir,lib)):
+                    break
+            else:
+                result["unresolved"].append(lib)
+        return result
+
+    def _get_max_version(self,info,prefix):
+        """Get the newest version with the given prefix needed by a binary."""
+        maxver = None
+        for version in info.versions_needed:
+            if version.startswith(prefix):
+                ver = _parse_version(version[len(prefix):])
+                if ver is not None and (maxver is None or ver > maxver):
+                    maxver = ver
+        if maxver is None:
+            return None
+        return ".".join(map(str,maxver))
+
+    def _is_too_new(self,prefix,version):
+        """Check whether a version of the given library is beyond our limits.
+
+        Versions are strings like "2.3.4", unparseable versions such as
+        GLIBC_PRIVATE are never considered too new.
+        """
+        if version is None or prefix not in self.version_limits:
+            return False
+        ver = _parse_version(version)
+        if ver is None:
+            return False
+        return (ver >= _parse_version(self.version_limits[prefix]))
+
+    def set_version_limit(self,spec):
+        """Set a symbol version limit from a string like "GLIBC_2.4"."""
+        (prefix,_,version) = spec.rpartition("_")
+        if not prefix or _parse_version(version) is None:
+            raise ValueError("invalid version limit: %r" % (spec,))
+        self.version_limits[prefix + "_"] = version
+
     def _strip(self,fpath):
         mod = os.stat(fpath).st_mode
         os.chmod(fpath,stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
-        self.do("strip",fpath)
-        os.chmod(fpath,mod)
+        try:
+            #  elf.strip() only gives up on malformed files, which strip(1)
+            #  is just as likely to mangle; leave those as they are.
+            if not elf.strip(fpath):
+                print "UNABLE TO STRIP", fpath
+        finally:
+            os.chmod(fpath,mod)
 
-    def _check_glibc_symbols(self,fpath):
+    def _check_glibc_symbols(self,fpath,info=None):
+        """Get a list of errors for symbols needing too new a glibc."""
         print "VERIFYING GLIBC SYMBOLS", fpath
+        if info is None:
+            info = elf.read_elf(fpath)
         errors = []
-        for ln in self.bt("objdump","-T",fpath).split("\n"):
-            for field in ln.split():
-                if field.startswith("GLIBC_"):
-                    ver = field.split("_",1)[1].split(".")
-                    ver = map(int,ver)
-                    if ver >= [2,4,]:
-                        errors.append(ln.strip())
-                elif field.startswith("GLIBCXX_"):
-                    ver = field.split("_",1)[1].split(".")
-                    ver = map(int,ver)
-                    if ver > [3,4,7]:
-                        errors.append(ln.strip())
-        assert not errors, "\n".join(errors)
-
-    def _adjust_rpath(self,fpath):
-        #  patchelf might not be installed if we're just initialising the env.
-        if os.path.exists(os.path.join(self.PREFIX,"bin","patchelf")):
-            print "ADJUSTING RPATH", fpath
-            backrefs = []
-            froot = os.path.dirname(fpath)
-            while froot != self.PREFIX:
-                backrefs.append("..")
-                froot = os.path.dirname(froot)
-            rpath = "/".join(backrefs) + "/lib"
-            rpath = "${ORIGIN}:${ORIGIN}/" + rpath
-            self.do("patchelf","--set-rpath",rpath,fpath)
-
-    def _adjust_interp_path(self,fpath):
-        #  Tweak executables so they use the normal linux loader, not
-        #  the special lsb-specified one.  This trades lsb-compatability
-        #  for ability to run out-of-the-box on more linuxen.
-        if os.path.exists(os.path.join(self.PREFIX,"bin","patchelf")):
-            try:
-                interp = self.bt("patchelf", "--print-interpreter", fpath)
-            except subprocess.CalledProcessError:
-                raise
-            else:
-                if interp.strip() == "/lib/ld-lsb.so.3":
-                    print "ADJUSTING INTERPRETER PATH", fpath
-                    new_interp = "/lib/ld-linux.so.2"
-                    self.do("patchelf", "--set-interpreter", new_interp, fpath)
+        for prefix in sorted(self.version_limits):
+            for (version,symbols) in info.requires_version(prefix):
+                if self._is_too_new(prefix,version[len(prefix):]):
+                    errors.append("%s: %s" % (version," ".join(symbols),))
+        return errors
+
+    def _get_rpath(self,fpath):
+        """Get the rpath that a binary at the given path should have."""
+        backrefs = []
+        froot = os.path.dirname(fpath)
+        while froot != self.PREFIX:
+            backrefs.append("..")
+            froot = os.path.dirname(froot)
+        rpath = "/".join(backrefs) + "/lib"
+        return "${ORIGIN}:${ORIGIN}/" + rpath
+
+    def _adjust_rpath(self,fpath,info=None):
+        """Set the rpath of a binary, returning False if that wasn't possible.
+
+        The rpath is rewritten in place, which requires there to be room for
+        it; there will be for anything linked with PLACEHOLDER_LDFLAGS.
+        Statically linked binaries have no rpath and are left alone.
+        """
+        if info is None:
+            info = elf.read_elf(fpath)
+        rpath = self._get_rpath(fpath)
+        if info.dynamic_offset is None or \
+           (info.runpath or info.rpath) == rpath:
+            return True
+        print "ADJUSTING RPATH", fpath
+        return elf.set_rpath(fpath,rpath)
+
+    def _adjust_interp_path(self,fpath,info=None):
+        """Set the interpreter of a binary, returning False if not possible.
+
+        Executables are tweaked to use the normal linux loader, not the
+        special lsb-specified one.  This trades lsb-compatability for the
+        ability to run out-of-the-box on more linuxen.  As with the rpath,
+        there's only room for this if linked with PLACEHOLDER_LDFLAGS.
+        """
+        if info is None:
+            info = elf.read_elf(fpath)
+        interp = info.interpreter
+        if interp and os.path.normpath(interp) == "/lib/ld-lsb.so.3":
+            print "ADJUSTING INTERPRETER PATH", fpath
+            return elf.set_interpreter(fpath,self.INTERPRETER)
+        return True
 
     def load_recipe(self,recipe):
         return self._load_recipe_subclass(recipe,MyppyEnv,_linux_recipes)
 
+
+def _parse_version(version):
+    """Parse a version string like "2.3.4" into a list of ints, or None."""
+    try:
+        return map(int,version.split("."))
+    except ValueError:
+        return None
+
+
+def _read_ccache_stats(path):
+    """Count the cache hits and misses recorded in a ccache stats log."""
+    hits = misses = 0
+    try:
+        with open(path,"r") as f:
+            for ln in f:
+                ln = ln.strip()
+                if ln.endswith("cache_hit"):
+                    hits += 1
+                elif ln == "cache_miss":
+                    misses += 1
+    except EnvironmentError, e:
+        if e.errno not in (errno.ENOENT,):
+            raise
+    return (hits,misses)
+
+
+#  Pool worker processes are forked from the installing process, so they
+#  can be handed the env itself rather than some picklable proxy for it.
+_worker_env = None
+
+def _init_worker(env):
+    global _worker_env
+    _worker_env = env
+
+def _postprocess_file_worker(job):
+    return _worker_env._postprocess_file(*job)
+
+def _audit_file_worker(fpath):
+    return _worker_env._audit_file(fpath)
@@ -0,0 +1,109 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.forkserver:  fork subprocesses from a helper without any threads
+
+"""
+
+from __future__ import with_statement
+
+import select
+import threading
+import traceback
+import multiprocessing
+
+
+class ForkServer(object):
+    """Run a function in forked subprocesses, without forking this process.
+
+    Forking a process that has other threads running is unsafe, since the
+    child can inherit locks held by threads that don't exist in it.  This
+    starts a helper process while there are still no other threads, and
+    has it fork a child to run target(name) for each name given to run().
+    The helper only ever has one thread, so its children are safe.
+
+    The callback is called as callback(name,result) from a background
+    thread in this process as each child finishes.  The result is whatever
+    target() returned, or None if it failed.  Since the helper is forked
+    when the server starts, the children see the state of this process as
+    it was at that time.
+    """
+
+    def __init__(self,target,callback):
+        self.target = target
+        self.callback = callback
+        (self._req_r,self._req_w) = multiprocessing.Pipe(duplex=False)
+        (self._res_r,self._res_w) = multiprocessing.Pipe(duplex=False)
+        self._proc = multiprocessing.Process(target=self._serve)
+        self._proc.start()
+        self._req_r.close()
+        self._res_w.close()
+        self._reader = threading.Thread(target=self._read_results)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def run(self,name):
+        """Start running target(name) in a forked child."""
+        self._req_w.send(name)
+
+    def close(self):
+        """Wait for all running children, then shut down the helper."""
+        self._req_w.close()
+        self._proc.join()
+        self._reader.join()
+
+    def _read_results(self):
+        while True:
+            try:
+                (name,result) = self._res_r.recv()
+            except EOFError:
+                break
+            self.callback(name,result)
+        self._res_r.close()
+
+    def _serve(self):
+        """Main loop of the helper process."""
+        self._req_w.close()
+        self._res_r.close()
+        children = {}
+        accepting = True
+        while accepting or children:
+            conns = children.keys()
+            if accepting:
+                conns.append(self._req_r)
+            for conn in select.select(conns,[],[])[0]:
+                if conn is self._req_r:
+                    try:
+                        name = conn.recv()
+                    except EOFError:
+                        accepting = False
+                    else:
+                        children.update(self._start_child(name))
+                else:
+                    (name,proc) = children.pop(conn)
+                    try:
+                        result = conn.recv()
+                    except EOFError:
+                        result = None
+                    conn.close()
+                    proc.join()
+                    if proc.exitcode != 0:
+                        result = None
+                    self._res_w.send((name,result))
+        self._res_w.close()
+
+    def _start_child(self,name):
+        (r_conn,w_conn) = multiprocessing.Pipe(duplex=False)
+        def run():
+            r_conn.close()
+            result = self.target(name)
+            try:
+                w_conn.send(result)
+            except Exception:
+                traceback.print_exc()
+                w_conn.send(None)
+        proc = multiprocessing.Process(target=run)
+        proc.start()
+        w_conn.close()
+        return {r_conn:(name,proc)}
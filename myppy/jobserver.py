@@ -0,0 +1,62 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.jobserver:  a GNU make jobserver shared by all concurrent builds
+
+"""
+
+from __future__ import with_statement
+
+import os
+import errno
+from contextlib import contextmanager
+
+
+class JobServer(object):
+    """A GNU make jobserver with a fixed budget of jobs.
+
+    This is just a pipe holding one token per job.  Every make run with our
+    MAKEFLAGS takes a token from the pipe before starting each extra job
+    and puts it back when the job finishes, so that all of them together,
+    across all the recipes being built at once, never run more than the
+    budgeted number of jobs.
+
+    GNU make gives every top-level make one job for free, so that has to be
+    paid for by holding a token from slot() while make is running.  The
+    pipe is created by the installing process and inherited by the forked
+    builds and by make itself.
+    """
+
+    def __init__(self,jobs):
+        assert jobs > 0
+        self.jobs = jobs
+        (self.rfd,self.wfd) = os.pipe()
+        os.write(self.wfd,"+" * jobs)
+
+    def get_makeflags(self,makeflags=""):
+        """Add the flags for using this jobserver to a MAKEFLAGS string."""
+        flags = [flag for flag in makeflags.split()
+                 if not flag.startswith(("-j","--jobserver-"))]
+        flags.extend(("-j","--jobserver-fds=%d,%d" % (self.rfd,self.wfd,)))
+        return " " + " ".join(flags)
+
+    @contextmanager
+    def slot(self):
+        """Context manager holding one job's token from the jobserver."""
+        while True:
+            try:
+                token = os.read(self.rfd,1)
+            except OSError, e:
+                if e.errno not in (errno.EINTR,):
+                    raise
+            else:
+                break
+        try:
+            yield
+        finally:
+            os.write(self.wfd,token)
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
@@ -0,0 +1,143 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.libgraph:  shared-library dependency graph of a myppy env
+
+"""
+
+from __future__ import with_statement
+
+import os
+import stat
+import shutil
+
+from myppy import util
+from myppy import elf
+
+
+class LibraryGraph(object):
+    """The DT_NEEDED graph of the ELF binaries installed in a myppy env.
+
+    The graph covers every ELF file recorded in the env's database.  Each
+    needed library is looked for in the binary's own rpath and then in the
+    env's lib directory; libraries that aren't found in the env are assumed
+    to be provided by the system, and aren't part of the graph.
+
+    Files with a DT_SONAME are considered to be libraries, which can be left
+    out of the env if nothing needs them.  Other ELF files (executables,
+    python extension modules, plugins) are the default entry points.
+    """
+
+    def __init__(self,target):
+        self.target = target
+        self.rootdir = target.rootdir
+        self.files = {}
+        self.recipes = {}
+        self.needs = {}
+        self._load()
+
+    def _load(self):
+        realpaths = {}
+        q = "SELECT recipe, filepath FROM installed_files"
+        for (recipe,relpath) in self.target._db.execute(q):
+            fpath = os.path.join(self.rootdir,relpath)
+            if os.path.islink(fpath) or not os.path.isfile(fpath):
+                continue
+            try:
+                info = elf.read_elf(fpath,symbols=False)
+            except (EnvironmentError,ValueError):
+                continue
+            if info is not None:
+                self.files[relpath] = info
+                self.recipes[relpath] = recipe
+                realpaths[os.path.realpath(fpath)] = relpath
+        for (relpath,info) in self.files.iteritems():
+            libdirs = elf.get_library_path(info)
+            libdirs.append(os.path.join(self.target.PREFIX,"lib"))
+            needs = self.needs[relpath] = []
+            for lib in info.needed:
+                for libdir in libdirs:
+                    libpath = os.path.join(libdir,lib)
+                    if os.path.exists(libpath):
+                        libpath = realpaths.get(os.path.realpath(libpath))
+                        if libpath is not None:
+                            needs.append(libpath)
+                        break
+
+    def is_library(self,relpath):
+        """Check whether the given file is a shared library."""
+        return (self.files[relpath].soname is not None)
+
+    def get_entry_points(self,names=()):
+        """Get the set of files named by the given entry points.
+
+        Each name can be the name of an installed recipe, meaning all of its
+        binaries, or the path of a binary, absolute or relative to the env.
+        If no names are given, all binaries that aren't libraries are used.
+        """
+        if not names:
+            return set(p for p in self.files if not self.is_library(p))
+        entries = set()
+        for name in names:
+            if self.target.is_installed(name):
+                for (relpath,recipe) in self.recipes.iteritems():
+                    if recipe == name:
+                        entries.add(relpath)
+                continue
+            fpath = os.path.realpath(os.path.join(self.rootdir,name))
+            relpath = fpath[len(os.path.realpath(self.rootdir))+1:]
+            if relpath not in self.files:
+                raise ValueError("not an installed binary: %s" % (name,))
+            entries.add(relpath)
+        return entries
+
+    def get_reachable(self,entries):
+        """Get the set of files reachable from the given entry points."""
+        reachable = set()
+        todo = list(entries)
+        while todo:
+            relpath = todo.pop()
+            if relpath not in reachable:
+                reachable.add(relpath)
+                todo.extend(self.needs[relpath])
+        return reachable
+
+    def get_unused(self,entries):
+        """Get the set of libraries not reachable from the entry points."""
+        reachable = self.get_reachable(entries)
+        return set(p for p in self.files
+                     if self.is_library(p) and p not in reachable)
+
+    def export(self,destdir,entries):
+        """Copy the env into destdir, leaving out any unused libraries.
+
+        Symlinks to unused libraries are left out as well.  The env's build
+        and cache directories and its database aren't copied.
+        """
+        if os.path.exists(destdir):
+            raise RuntimeError("export destination exists: %s" % (destdir,))
+        unused = set()
+        for relpath in self.get_unused(entries):
+            unused.add(os.path.realpath(os.path.join(self.rootdir,relpath)))
+        todo = [self.rootdir]
+        while todo:
+            srcdir = todo.pop()
+            dstdir = os.path.join(destdir,srcdir[len(self.rootdir)+1:])
+            os.makedirs(dstdir)
+            for (nm,st) in util.scandir(srcdir):
+                if st is None:
+                    continue
+                srcpath = os.path.join(srcdir,nm)
+                dstpath = os.path.join(dstdir,nm)
+                if self.target._is_tempfile(srcpath):
+                    continue
+                if os.path.realpath(srcpath) in unused:
+                    print "PRUNING", srcpath
+                    continue
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(srcpath),dstpath)
+                elif stat.S_ISDIR(st.st_mode):
+                    todo.append(srcpath)
+                else:
+                    shutil.copy2(srcpath,dstpath)
@@ -0,0 +1,71 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.mirrors:  map download URLs onto mirror sites
+
+"""
+
+from __future__ import with_statement
+
+import os
+import urllib
+
+
+class MirrorMap(object):
+    """Map URL prefixes onto lists of alternative mirrors.
+
+    A mirror spec has one entry per line, each of the form:
+
+        PREFIX  MIRROR  [MIRROR...]
+
+    meaning that URLs starting with PREFIX can also be found by replacing
+    that prefix with any of the given mirrors.  Mirrors can be URLs or local
+    directories.  Blank lines and lines starting with "#" are ignored, and
+    entries can also be separated by semicolons so that a whole spec fits
+    in an environment variable.
+    """
+
+    def __init__(self):
+        self.mirrors = {}
+
+    @classmethod
+    def load(cls,spec):
+        """Load a mirror map from a spec string, or the file it names."""
+        if os.path.isfile(spec):
+            with open(spec,"r") as f:
+                spec = f.read()
+        mirrors = cls()
+        for line in spec.replace(";","\n").splitlines():
+            line = line.strip()
+            if line and not line.startswith("#"):
+                bits = line.split()
+                mirrors.add(bits[0],bits[1:])
+        return mirrors
+
+    def add(self,prefix,mirrors):
+        """Add mirrors for the given URL prefix."""
+        urls = self.mirrors.setdefault(prefix,[])
+        for mirror in mirrors:
+            if "://" not in mirror:
+                mirror = os.path.abspath(os.path.expanduser(mirror))
+                mirror = "file://" + urllib.pathname2url(mirror)
+            if prefix.endswith("/") and not mirror.endswith("/"):
+                mirror += "/"
+            urls.append(mirror)
+
+    def get_sources(self,url):
+        """List the places the given URL could be downloaded from.
+
+        This returns a list of (base,url) pairs, where base is the mirror
+        that the url refers to.  The mirrors for the longest matching prefix
+        come first in the order they were given, then the original URL.
+        """
+        for prefix in sorted(self.mirrors,key=len,reverse=True):
+            if url.startswith(prefix):
+                sources = []
+                for mirror in self.mirrors[prefix]:
+                    sources.append((mirror,mirror + url[len(prefix):]))
+                sources.append((prefix,url))
+                return sources
+        return [(url,url)]
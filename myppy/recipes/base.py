@@ -5,6 +5,7 @@ from __future__ import with_statement
 
 import os
 import sys
+import errno
 import tempfile
 import urlparse
 import urllib2
@@ -63,6 +64,19 @@ class Recipe(object):
     MAKE_VARS = ()
     MAKE_RELPATH = "."
 
+    #  Recipes with the same SOURCE_GROUP share a single unpacked, patched
+    #  and configured source tree.  The first of them to be built prepares
+    #  it, and the others just run their own _make() in it, as long as they
+    #  have the same SOURCE_URL and configure options.
+    SOURCE_GROUP = None
+
+    #  Set this to false if the build breaks when make runs jobs in parallel.
+    PARALLEL_MAKE = True
+
+    #  Set this to true if install() can be redirected into a staging dir
+    #  via DESTDIR (or --root for distutils) and doesn't touch anything else.
+    STAGED_INSTALL = False
+
     @property
     def PREFIX(self):
         return self.target.PREFIX
@@ -71,26 +85,84 @@ class Recipe(object):
     def INSTALL_PREFIX(self):
         return self.PREFIX
 
+    @property
+    def STAGING_DIR(self):
+        """Directory into which install() puts files, for staged installs."""
+        stagedir = os.path.join(self.target.builddir,"stage")
+        return os.path.join(stagedir,self.__class__.__name__)
+
     def __init__(self,target):
         self.target = target
 
+    @property
+    def SOURCES(self):
+        """List of (url,md5) pairs for the files needed to build this recipe."""
+        return [(self.SOURCE_URL,self.SOURCE_MD5)]
+
     def fetch(self):
         """Download any files necessary to build this recipe."""
-        self.target.fetch(self.SOURCE_URL,self.SOURCE_MD5)
+        for (url,md5) in self.SOURCES:
+            self.target.fetch(url,md5)
 
     def build(self):
         """Build all of the files for this recipe."""
-        self._unpack()
-        self._patch()
-        self._configure()
+        self._prepare()
         self._make()
 
     def install(self):
         """Install all of the files for this recipe."""
         self._generic_make(target="install")
 
+    def _prepare(self):
+        """Unpack, patch and configure the source tree for this recipe.
+
+        If another recipe from the same SOURCE_GROUP has already prepared
+        the tree with the same options, during this run of myppy, then it
+        is used as-is.
+        """
+        stampfile = self._get_source_group_stampfile()
+        key = self._get_source_group_key()
+        if key is not None:
+            try:
+                with open(stampfile,"r") as f:
+                    if f.read() == key:
+                        print "REUSING SOURCE TREE FOR", self.SOURCE_GROUP
+                        return
+            except EnvironmentError, e:
+                if e.errno not in (errno.ENOENT,):
+                    raise
+        self._unpack()
+        self._patch()
+        self._configure()
+        if key is not None:
+            with open(stampfile,"w") as f:
+                f.write(key)
+
+    def _get_source_group_key(self):
+        """Get a string identifying how this recipe prepares its tree."""
+        if self.SOURCE_GROUP is None:
+            return None
+        script = self.CONFIGURE_SCRIPT
+        if not isinstance(script,basestring):
+            script = list(script)
+        return repr((self.target.session_id,self.SOURCE_GROUP,
+                     self.SOURCE_URL,self.CONFIGURE_DIR,script,
+                     list(self.CONFIGURE_ARGS),
+                     list(self.CONFIGURE_VARS or ()),))
+
+    def _get_source_group_stampfile(self):
+        """Get the file recording who prepared this recipe's source tree."""
+        updir = os.path.basename(self.SOURCE_URL)
+        return os.path.join(self.target.builddir,updir + ".prepared")
+
     def _unpack(self):
-        """Do a generic "tar -x" on the downloaded source tarball."""
+        """Unpack the downloaded source tarball into the build dir."""
+        #  Whoever prepared the existing tree, it's about to be replaced.
+        try:
+            os.unlink(self._get_source_group_stampfile())
+        except EnvironmentError, e:
+            if e.errno not in (errno.ENOENT,):
+                raise
         src = self.target.fetch(self.SOURCE_URL)
         updir = os.path.join(self.target.builddir,os.path.basename(src))
         return self._unpack_tarball(src,updir)
@@ -106,17 +178,7 @@ class Recipe(object):
 
     def _unpack_tarball(self,src,workdir):
         """Unpack the given tarball into the specified workdir."""
-        if not os.path.isdir(workdir):
-            os.makedirs(workdir)
-        if src.endswith(".bz2"):
-            cmd = ["tar","-xjf", src, "-C", workdir]
-        elif src.endswith(".gz") or src.endswith(".tgz"):
-            cmd = ["tar","-xzf", src, "-C", workdir]
-        elif src.endswith(".zip"):
-            cmd = ["unzip", src, "-d", workdir]
-        else:
-            cmd = ["tar","-xf", "-C", workdir]
-        self.target.do(*cmd)
+        self.target.unpack(src,workdir)
         return os.path.join(workdir,os.listdir(workdir)[0])
 
     def _generic_configure(self,script=None,vars=None,args=None,env={}):
@@ -157,13 +219,39 @@ class Recipe(object):
         cmd.extend(("-C",os.path.join(workdir,relpath)))
         if target is not None:
             cmd.append(target)
-        self.target.do(*cmd,env=env)
+        cmd.extend(self._get_staging_make_vars(target))
+        self._run_make(cmd,env)
+
+    def _run_make(self,cmd,env={}):
+        """Run a make command, using the env's jobserver if there is one.
+
+        The jobserver is shared by all the builds running at once, so make
+        can run jobs in parallel without oversubscribing the machine.  It's
+        not used for recipes that set PARALLEL_MAKE to false.
+        """
+        jobserver = self.target.jobserver
+        if jobserver is None or not self.PARALLEL_MAKE:
+            self.target.do(*cmd,env=env)
+            return
+        env = env.copy()
+        makeflags = env.get("MAKEFLAGS",self.target.env.get("MAKEFLAGS",""))
+        env["MAKEFLAGS"] = jobserver.get_makeflags(makeflags)
+        with jobserver.slot():
+            self.target.do(*cmd,env=env)
+
+    def _get_staging_make_vars(self,target):
+        """Get any extra make vars needed to stage the given make target."""
+        if target == "install" and self.STAGED_INSTALL:
+            return ["DESTDIR=" + self.STAGING_DIR]
+        return []
 
     def _generic_pyinstall(self,relpath="",args=[],env={}):
         """Do a generic "python setup.py install" for this recipe."""
         workdir = self._get_builddir()
         cmd = [self.target.PYTHON_EXECUTABLE,"setup.py","install"]
         cmd.extend(args)
+        if self.STAGED_INSTALL:
+            cmd.append("--root=" + self.STAGING_DIR)
         with cd(os.path.join(workdir,relpath)):
             self.target.do(*cmd,env=env)
 
@@ -214,8 +302,7 @@ class PipPyRecipe(PyRecipe):
     """
     DEPENDENCIES = ["py_pip","py_setuptools"]
     PYPI_PKG = ""
-    def fetch(self):
-        pass
+    SOURCES = []
     def build(self):
         pass
     def install(self):
@@ -408,6 +495,7 @@ class lib_bz2(Recipe):
 class lib_readline(Recipe):
     SOURCE_URL = "ftp://ftp.cwru.edu/pub/bash/readline-6.2.tar.gz"
     SOURCE_MD5 = "67948acb2ca081f23359d0256e9a271c"
+    STAGED_INSTALL = True
     CONFIGURE_ARGS = ("--disable-shared","--enable-static",)
 
 
@@ -427,18 +515,23 @@ class lib_zlib(Recipe):
 
 class lib_png(Recipe):
     SOURCE_URL = "http://downloads.sourceforge.net/project/libpng/libpng15/1.5.13/libpng-1.5.13.tar.gz"
+    STAGED_INSTALL = True
 
 
 class lib_jpeg(Recipe):
     SOURCE_URL = "http://www.ijg.org/files/jpegsrc.v8c.tar.gz"
+    STAGED_INSTALL = True
 
 
 class lib_tiff(Recipe):
     SOURCE_URL = "ftp://ftp.remotesensing.org/pub/libtiff/tiff-3.9.4.tar.gz"
+    STAGED_INSTALL = True
 
 
 class lib_openssl(Recipe):
     SOURCE_URL = "http://www.openssl.org/source/openssl-1.0.1c.tar.gz"
+    #  The makefiles for openssl 1.0.x have races between subdirs.
+    PARALLEL_MAKE = False
     CONFIGURE_SCRIPT = "./Configure"
     CONFIGURE_ARGS = ["linux-elf","shared"]
     CONFIGURE_VARS = None
@@ -471,6 +564,7 @@ class lib_openssl(Recipe):
 
 class lib_sqlite3(Recipe):
     SOURCE_URL = "http://www.sqlite.org/sqlite-autoconf-3070500.tar.gz"
+    STAGED_INSTALL = True
 
 
 class py_setuptools(PyRecipe):
@@ -480,8 +574,7 @@ class py_setuptools(PyRecipe):
 
 class py_pip(PyRecipe):
     DEPENDENCIES = ["py_setuptools"]
-    def fetch(self):
-        pass
+    SOURCES = []
     def build(self):
         pass
     def install(self):
@@ -489,8 +582,7 @@ class py_pip(PyRecipe):
 
 
 class py_myppy(Recipe):
-    def fetch(self):
-        pass
+    SOURCES = []
     def build(self):
         pass
     def install(self):
@@ -514,6 +606,7 @@ class py_myppy(Recipe):
 
 
 class lib_wxwidgets_base(Recipe):
+    SOURCE_GROUP = "wxwidgets"
     SOURCE_URL = "http://downloads.sourceforge.net/project/wxpython/wxPython/2.8.11.0/wxPython-src-2.8.11.0.tar.bz2"
     CONFIGURE_ARGS = ("--with-opengl","--enable-unicode","--enable-optimize","--enable-debug_flag",)
     def _unpack(self):
@@ -541,8 +634,7 @@ class lib_wxwidgets_stc(lib_wxwidgets_base):
 class lib_wxwidgets(Recipe):
     DEPENDENCIES = ["lib_wxwidgets_base","lib_wxwidgets_gizmos",
                     "lib_wxwidgets_stc"]
-    def fetch(self):
-        pass
+    SOURCES = []
     def build(self):
         pass
     def install(self):
@@ -561,16 +653,22 @@ class _lib_qt4_base(Recipe):
     CONFIGURE_VARS = None
     DISABLE_FEATURES = []
     @property
+    def FREETYPE_INCLUDE(self):
+        #  Work out where the tree will be unpacked rather than looking for
+        #  it, so the flags (and hence the build key) don't depend on it.
+        srcnm = os.path.basename(self.SOURCE_URL)
+        srcdir = srcnm[:-len(".tar.gz")]
+        workdir = os.path.join(self.target.builddir,srcnm,srcdir)
+        return os.path.join(workdir, "src/3rdparty/freetype/include")
+    @property
     def CFLAGS(self):
         flags = super(_lib_qt4_base,self).CFLAGS
-        workdir = self._get_builddir()
-        flags += " -I" + os.path.join(workdir, "src/3rdparty/freetype/include")
+        flags += " -I" + self.FREETYPE_INCLUDE
         return flags
     @property
     def CXXFLAGS(self):
         flags = super(_lib_qt4_base,self).CXXFLAGS
-        workdir = self._get_builddir()
-        flags += " -I" + os.path.join(workdir, "src/3rdparty/freetype/include")
+        flags += " -I" + self.FREETYPE_INCLUDE
         return flags
     @property
     def CONFIGURE_ARGS(self):
@@ -731,6 +829,7 @@ class lib_expat(Recipe):
     SOURCE_URL = "http://downloads.sourceforge.net/project/expat/expat/2.0.1/expat-2.0.1.tar.gz"
     SOURCE_MD5 = "ee8b492592568805593f81f8cdf2a04c"
     CONFIGURE_ARGS = ["--enable-static", "--enable-shared"]
+    STAGED_INSTALL = True
 
 
 class lib_openldap(Recipe):
@@ -831,8 +930,9 @@ class py_p4python121(PyRecipe):
     SOURCE_URL = "ftp://ftp.perforce.com/perforce/r12.1/bin.tools/p4python.tgz"
     P4API_URL = "ftp://ftp.perforce.com/perforce/r12.1/bin.linux26x86/p4api.tgz"
 
-    def fetch(self):
-        pass
+    @property
+    def SOURCES(self):
+        return [(self.SOURCE_URL,None),(self.P4API_URL,None)]
 
     def build(self):
         # fetch and upnpack source
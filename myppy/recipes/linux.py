@@ -86,7 +86,8 @@ class Recipe(base.Recipe):
         cmd.extend(("-C",os.path.join(workdir,relpath)))
         if target is not None:
             cmd.append(target)
-        self.target.do(*cmd,env=env)
+        cmd.extend(self._get_staging_make_vars(target))
+        self._run_make(cmd,env)
 
     def _generic_pyinstall(self,relpath="",args=[],env={}):
         env = env.copy()
@@ -191,12 +192,15 @@ class python27(base.python27,Recipe,):
                     yield "    return 'linux-i686'\n\n"
         self._patch_file(os.path.join(self.PREFIX, "lib/python2.7/distutils/util.py"),hardcode_platform)
 
-class patchelf(Recipe):
-    SOURCE_URL = "http://hydra.nixos.org/build/114505/download/2/patchelf-0.5.tar.bz2"
-    SOURCE_MD5 = "c41fc98091d15dc93ba876c3ef11f43c"
-
 
 class lib_openssl(base.lib_openssl,Recipe):
+    @property
+    def CONFIGURE_ARGS(self):
+        args = list(super(lib_openssl,self).CONFIGURE_ARGS)
+        #  Configure doesn't look at LDFLAGS, but passes any -Wl options it's
+        #  given through to every link, of both the libs and the apps.
+        args.extend(self.target.PLACEHOLDER_LDFLAGS.split())
+        return args
     def _configure(self):
         super(lib_openssl,self)._configure()
         def ensure_gnu_source(lines):
@@ -298,6 +302,13 @@ class _lib_qt4_base(base._lib_qt4_base,Recipe):
                 else:
                     yield ln
         self._patch_build_file("mkspecs/linux-lsb-g++/qmake.conf",force_i386)
+        #  qmake doesn't look at LDFLAGS, so add the placeholder rpath and
+        #  interpreter to the mkspec to leave room for relocating them.
+        def add_placeholders(lines):
+            for ln in lines:
+                yield ln
+            yield "QMAKE_LFLAGS += %s\n" % (self.target.PLACEHOLDER_LDFLAGS,)
+        self._patch_build_file("mkspecs/linux-lsb-g++/qmake.conf",add_placeholders)
         #  Disable some functions only available on newer linuxes.
         #  Fortunately qt provides runtime fallbacks for these.
         def dont_use_newer_funcs(lines):
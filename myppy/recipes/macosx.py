@@ -103,9 +103,10 @@ class Recipe(base.Recipe):
         cmd.extend(("-C",os.path.join(workdir,relpath)))
         if target is not None:
             cmd.append(target)
+        cmd.extend(self._get_staging_make_vars(target))
         env = env.copy()
         env.setdefault("DYLD_FALLBACK_LIBRARY_PATH",self.DYLD_FALLBACK_LIBRARY_PATH)
-        self.target.do(*cmd,env=env)
+        self._run_make(cmd,env)
 
     def _get_builddir(self):
         """Get the directory in which we build the given tarball.
@@ -0,0 +1,129 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.resolver:  memoized dependency information for a myppy env
+
+"""
+
+
+class DependencyResolver(object):
+    """Answer questions about the recipe dependency graph of a myppy env.
+
+    Loading a recipe can be surprisingly expensive (on some platforms it
+    synthesises a new subclass on the fly) so each recipe class is loaded
+    only once, and the transitive dependencies, reverse dependencies and
+    dependency order are computed once and then remembered.
+
+    Everything derived from the env's list of explicitly-installed recipes
+    is thrown away by calling invalidate(), which the env does whenever it
+    modifies that list.  Recipe classes don't change, so they are kept.
+    """
+
+    def __init__(self,target):
+        self.target = target
+        self._classes = {}
+        self._recipes = {}
+        self._dependencies = {}
+        self._required = None
+        self._dependents = None
+
+    def invalidate(self):
+        """Forget everything derived from the explicitly-installed recipes."""
+        self._required = None
+        self._dependents = None
+
+    def get_recipe_class(self,recipe):
+        """Get the class implementing the named recipe."""
+        try:
+            return self._classes[recipe]
+        except KeyError:
+            cls = self.target.load_recipe(recipe).__class__
+            self._classes[recipe] = cls
+            return cls
+
+    def get_recipe(self,recipe):
+        """Get a shared instance of the named recipe.
+
+        This is intended for inspecting recipe metadata; use load_recipe()
+        on the env to get an instance that can safely be built.
+        """
+        try:
+            return self._recipes[recipe]
+        except KeyError:
+            r = self.get_recipe_class(recipe)(self.target)
+            self._recipes[recipe] = r
+            return r
+
+    def get_direct_dependencies(self,recipe):
+        """Get the recipes that must be installed before the named recipe."""
+        r = self.get_recipe(recipe)
+        deps = []
+        for dep in r.DEPENDENCIES + r.BUILD_DEPENDENCIES:
+            if dep != recipe and dep not in deps:
+                deps.append(dep)
+        return deps
+
+    def get_dependencies(self,recipe):
+        """Get the set of all recipes that the named recipe depends on."""
+        try:
+            return self._dependencies[recipe]
+        except KeyError:
+            pass
+        for nm in self.get_order([recipe]):
+            if nm not in self._dependencies:
+                deps = set()
+                for dep in self.get_recipe(nm).DEPENDENCIES:
+                    if dep != nm:
+                        deps.add(dep)
+                        deps.update(self._dependencies[dep])
+                self._dependencies[nm] = frozenset(deps)
+        return self._dependencies[recipe]
+
+    def get_order(self,recipes):
+        """List the named recipes and all their deps, dependencies first."""
+        order = []
+        seen = set()
+        def add(recipe,stack):
+            if recipe in seen:
+                return
+            if recipe in stack:
+                cycle = " -> ".join(stack[stack.index(recipe):] + [recipe])
+                raise RuntimeError("dependency cycle: %s" % (cycle,))
+            stack.append(recipe)
+            for dep in self.get_direct_dependencies(recipe):
+                add(dep,stack)
+            stack.pop()
+            seen.add(recipe)
+            order.append(recipe)
+        for recipe in recipes:
+            add(recipe,[])
+        return order
+
+    def get_required(self):
+        """Get the set of recipes needed by the explicitly-installed ones.
+
+        This includes the base dependencies of the env, every recipe that
+        the user explicitly asked to install, and all of their dependencies.
+        """
+        if self._required is None:
+            roots = list(self.target.DEPENDENCIES)
+            q = "SELECT name FROM recipes WHERE explicit"
+            for row in self.target._db.execute(q):
+                roots.append(row[0])
+            required = set()
+            for recipe in roots:
+                required.add(recipe)
+                required.update(self.get_dependencies(recipe))
+            self._required = frozenset(required)
+        return self._required
+
+    def get_dependents(self,recipe):
+        """Get the set of required recipes that depend on the named recipe."""
+        if self._dependents is None:
+            dependents = {}
+            for nm in self.get_required():
+                for dep in self.get_dependencies(nm):
+                    dependents.setdefault(dep,set()).add(nm)
+            self._dependents = dependents
+        return frozenset(self._dependents.get(recipe,()))
@@ -5,10 +5,281 @@ from __future__ import with_statement
 
 import sys
 import os
+import shutil
+import tempfile
 import unittest
+import socket
+import hashlib
+import sqlite3
+import threading
+import Queue
+import time
+import stat
+import tarfile
+import zipfile
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
 from os.path import dirname
+from StringIO import StringIO
 
 import myppy
+from myppy import util
+from myppy import elf
+from myppy.libgraph import LibraryGraph
+from myppy.download import Downloader
+from myppy.cache import DownloadCache
+from myppy.mirrors import MirrorMap
+from myppy import unpack
+from myppy.artifacts import ArtifactCache, get_artifact_store
+from myppy.artifacts import HTTPArtifactStore
+from myppy.jobserver import JobServer
+from myppy.forkserver import ForkServer
+from myppy.envs import base as base_envs
+from myppy.envs import linux as linux_envs
+from myppy.recipes import base as base_recipes
+
+
+class _TestRecipe(base_recipes.Recipe):
+    """Recipe that "builds" a single text file named after itself."""
+    def fetch(self):
+        pass
+    def build(self):
+        self.built_by = os.getpid()
+    def install(self):
+        assert self.built_by
+        sharedir = os.path.join(self.PREFIX,"share")
+        if not os.path.isdir(sharedir):
+            os.makedirs(sharedir)
+        fnm = os.path.join(sharedir,self.__class__.__name__ + ".txt")
+        with open(fnm,"w") as f:
+            f.write(str(self.built_by))
+
+class lib_one(_TestRecipe):
+    SOURCE_URL = "http://example.com/one.tar.gz"
+
+class lib_two(_TestRecipe):
+    SOURCE_URL = "http://example.com/two.tar.gz"
+
+class lib_three(_TestRecipe):
+    DEPENDENCIES = ["lib_one"]
+    SOURCE_URL = "http://example.com/three.tar.gz"
+
+class app_main(_TestRecipe):
+    DEPENDENCIES = ["lib_three","lib_two"]
+    SOURCE_URL = "http://example.com/main.tar.gz"
+
+class app_other(_TestRecipe):
+    CONFLICTS_WITH = ["app_main"]
+    SOURCE_URL = "http://example.com/other.tar.gz"
+
+class lib_broken(_TestRecipe):
+    SOURCE_URL = "http://example.com/broken.tar.gz"
+    def build(self):
+        raise RuntimeError("this recipe never builds")
+
+class lib_staged(_TestRecipe):
+    """Recipe installed via "make install" into a staging dir."""
+    DEPENDENCIES = ["lib_one"]
+    SOURCE_URL = "http://example.com/staged.tar.gz"
+    STAGED_INSTALL = True
+    def build(self):
+        super(lib_staged,self).build()
+        workdir = os.path.join(self.target.builddir,"staged.tar.gz","src")
+        os.makedirs(workdir)
+        with open(os.path.join(workdir,"Makefile"),"w") as f:
+            f.write("install:\n")
+            f.write("\tmkdir -p $(DESTDIR)%s/share/staged\n" % (self.PREFIX,))
+            f.write("\techo %d > $(DESTDIR)%s/share/staged/%s.txt\n"
+                    % (self.built_by,self.PREFIX,self.__class__.__name__,))
+            f.write("\tmkdir -p $(DESTDIR)%s/var/empty\n" % (self.PREFIX,))
+    def install(self):
+        base_recipes.Recipe.install(self)
+
+class lib_parallel(_TestRecipe):
+    """Recipe whose two make targets can only finish if run in parallel."""
+    SOURCE_URL = "http://example.com/parallel.tar.gz"
+    def build(self):
+        super(lib_parallel,self).build()
+        workdir = os.path.join(self.target.builddir,"parallel.tar.gz","src")
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        with open(os.path.join(workdir,"Makefile"),"w") as f:
+            f.write("all: one two\n")
+            for (nm,other) in (("one","two"),("two","one")):
+                f.write("%s:\n" % (nm,))
+                f.write("\techo '$(MAKEFLAGS)' > %s.flags\n" % (nm,))
+                f.write("\ttouch %s.started\n" % (nm,))
+                f.write("\tfor i in `seq 50`; do test -e %s.started && "
+                        "break; sleep 0.1; done\n" % (other,))
+                f.write("\ttest -e %s.started\n" % (other,))
+        self._generic_make()
+
+class lib_serial(lib_parallel):
+    PARALLEL_MAKE = False
+    def _run_make(self,cmd,env={}):
+        #  Let the targets finish even though they run one at a time.
+        for nm in ("one","two"):
+            open(os.path.join(self._get_builddir(),nm + ".started"),"w").close()
+        super(lib_serial,self)._run_make(cmd,env)
+
+
+class _DownloadingRecipe(_TestRecipe):
+    """Recipe that fetches its source from the test HTTP server."""
+    @property
+    def SOURCES(self):
+        url = self.target.server_url + "/" + self.__class__.__name__ + ".txt"
+        return [(url,None)]
+    def fetch(self):
+        base_recipes.Recipe.fetch(self)
+    def build(self):
+        (url,_) = self.SOURCES[0]
+        with open(self.target.fetch(url)) as f:
+            self.built_by = f.read()
+
+class src_one(_DownloadingRecipe):
+    pass
+
+class src_two(_DownloadingRecipe):
+    DEPENDENCIES = ["src_one"]
+
+
+class _GroupRecipe(base_recipes.Recipe):
+    """Recipe sharing a prepared source tree with other _GroupRecipes."""
+    SOURCE_GROUP = "grp"
+    @property
+    def SOURCE_URL(self):
+        return self.target.server_url + "/grp.tar"
+    def _configure(self):
+        with open(os.path.join(self._get_builddir(),"configured"),"a") as f:
+            f.write(self.__class__.__name__ + "\n")
+    def _make(self):
+        with open(os.path.join(self._get_builddir(),"made"),"a") as f:
+            f.write(self.__class__.__name__ + "\n")
+
+class grp_one(_GroupRecipe):
+    pass
+
+class grp_two(_GroupRecipe):
+    pass
+
+class grp_other(_GroupRecipe):
+    CONFIGURE_ARGS = ["--other"]
+
+
+class _TestEnv(base_envs.MyppyEnv):
+    """MyppyEnv using the toy recipes defined in this module."""
+    DEPENDENCIES = []
+    DOWNLOAD_CACHE = "cache"
+    num_recipe_loads = 0
+    def load_recipe(self,recipe):
+        self.num_recipe_loads += 1
+        return globals()[recipe](self)
+
+
+class _TestHTTPServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    """Local stand-in for a remote HTTP server, serving files from a dir."""
+
+    daemon_threads = True
+
+    class RequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def translate_path(self,path):
+            path = path.split("?",1)[0].lstrip("/")
+            return os.path.join(self.server.docroot,path)
+        def log_message(self,*args):
+            pass
+        def do_GET(self):
+            self.server.num_requests += 1
+            SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+        def do_PUT(self):
+            path = self.translate_path(self.path)
+            data = self.rfile.read(int(self.headers["Content-Length"]))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path + ".tmp","wb") as f:
+                f.write(data)
+            os.rename(path + ".tmp",path)
+            self.server.uploads.append(self.path)
+            self.send_response(201)
+            self.send_header("Content-Length","0")
+            self.end_headers()
+        def send_head(self):
+            path = self.translate_path(self.path)
+            if not os.path.isfile(path):
+                self.send_error(404,"File not found")
+                return None
+            with open(path,"rb") as f:
+                data = f.read()
+            (start,end) = (0,len(data))
+            etag = '"%s"' % (hashlib.md5(data).hexdigest(),)
+            range = self.headers.get("Range")
+            if_range = self.headers.get("If-Range")
+            if if_range is not None and if_range != etag:
+                range = None
+            if range is not None and self.server.support_ranges:
+                self.server.ranges.append(range)
+                (start,end) = range.split("=",1)[1].split("-")
+                (start,end) = (int(start),int(end or len(data)-1) + 1)
+                end = min(end,len(data))
+                self.send_response(206)
+                self.send_header("Content-Range","bytes %d-%d/%d" % 
+                                 (start,end - 1,len(data),))
+            else:
+                self.send_response(200)
+            if self.server.support_ranges:
+                self.send_header("Accept-Ranges","bytes")
+            if self.server.send_etags:
+                self.send_header("ETag",etag)
+            self.send_header("Content-Length",str(end - start))
+            self.end_headers()
+            data = data[start:end]
+            if self.server.truncate_after is not None:
+                #  Simulate the connection dropping part-way through.
+                data = data[:self.server.truncate_after]
+                self.close_connection = 1
+            return StringIO(data)
+
+    def __init__(self,docroot):
+        self.docroot = docroot
+        self.num_connections = 0
+        self.num_requests = 0
+        self.open_requests = []
+        self.support_ranges = True
+        self.send_etags = True
+        self.truncate_after = None
+        self.ranges = []
+        self.uploads = []
+        BaseHTTPServer.HTTPServer.__init__(self,("127.0.0.1",0),
+                                           self.RequestHandler)
+        self.url = "http://127.0.0.1:%d" % (self.server_address[1],)
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def process_request(self,request,client_address):
+        self.num_connections += 1
+        self.open_requests.append(request)
+        SocketServer.ThreadingMixIn.process_request(self,request,
+                                                    client_address)
+
+    def add_file(self,name,data):
+        if not os.path.isdir(os.path.dirname(os.path.join(self.docroot,name))):
+            os.makedirs(os.path.dirname(os.path.join(self.docroot,name)))
+        with open(os.path.join(self.docroot,name),"wb") as f:
+            f.write(data)
+        return self.url + "/" + name
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        #  Don't leave handler threads blocked on idle keep-alive connections.
+        for request in self.open_requests:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
 
 
 class TestMyppy(unittest.TestCase):
@@ -34,3 +305,1224 @@ class TestMyppy(unittest.TestCase):
             f.write(myppy.__doc__.encode())
             f.close()
 
+
+class TestInstall(unittest.TestCase):
+
+  def setUp(self):
+    self.rootdir = tempfile.mkdtemp()
+    self.env = _TestEnv(self.rootdir)
+
+  def tearDown(self):
+    shutil.rmtree(self.rootdir)
+
+  def _installed_files(self,recipe):
+    q = "SELECT filepath FROM installed_files WHERE recipe=?"
+    return sorted(r[0] for r in self.env._db.execute(q,(recipe,)))
+
+  def test_install_order_respects_dependencies(self):
+    (order,prereqs,_) = self.env._get_install_graph(["app_main"])
+    self.assertEquals(order,["lib_one","lib_three","lib_two","app_main"])
+    self.assertEquals(prereqs["app_main"],set(["lib_three","lib_two"]))
+    self.assertEquals(prereqs["lib_two"],set())
+    (order,prereqs,_) = self.env._get_install_graph(["lib_two","lib_one"],
+                                                    ordered=True)
+    self.assertEquals(prereqs["lib_one"],set(["lib_two"]))
+
+  def test_resolver(self):
+    resolver = self.env.resolver
+    self.assertEquals(resolver.get_order(["app_main"]),
+                      ["lib_one","lib_three","lib_two","app_main"])
+    self.assertEquals(resolver.get_dependencies("app_main"),
+                      set(["lib_one","lib_two","lib_three"]))
+    self.assertEquals(resolver.get_required(),set())
+    self.env.install("app_main")
+    self.assertEquals(resolver.get_required(),
+                      set(["lib_one","lib_two","lib_three","app_main"]))
+    self.assertEquals(resolver.get_dependents("lib_one"),
+                      set(["lib_three","app_main"]))
+    #  Each recipe class was loaded only once.
+    num_loads = self.env.num_recipe_loads
+    self.assertEquals(num_loads,4)
+    self.env.clean()
+    self.assertTrue(self.env.is_explicitly_installed("lib_one"))
+    self.assertEquals(self.env.num_recipe_loads,num_loads)
+    #  Changing the explicitly-installed recipes is noticed.
+    self.env.uninstall("app_main")
+    self.assertFalse(self.env.is_explicitly_installed("lib_one"))
+    self.env.clean()
+    self.assertFalse(self.env.is_installed("lib_one"))
+
+  def test_find_new_files_snapshot(self):
+    def touch(*names):
+        path = os.path.join(self.env.PREFIX,*names)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path,"w").close()
+        return path
+    def age():
+        for (dirpath,_,_) in os.walk(self.rootdir):
+            os.utime(dirpath,(0,0))
+    scanned = []
+    orig_scan_dir = self.env._scan_dir
+    def scan_dir(dirpath):
+        #  The db journal comes and goes in PREFIX, so it's always listed.
+        if dirpath != self.env.PREFIX:
+            scanned.append(dirpath)
+        return orig_scan_dir(dirpath)
+    self.env._scan_dir = scan_dir
+    a = touch("lib","a.txt")
+    b = touch("lib","deep","b.txt")
+    c = touch("share","c.txt")
+    with self.env:
+        self.env.record_files("lib_one",[a,b,c])
+    age()
+    self.assertEquals(list(self.env.find_new_files()),[])
+    #  Nothing changed, so nothing needs to be listed again.
+    del scanned[:]
+    self.assertEquals(list(self.env.find_new_files()),[])
+    self.assertEquals(scanned,[])
+    #  Only the changed directories are listed again.
+    d = touch("lib","deep","d.txt")
+    self.assertEquals(list(self.env.find_new_files()),[d])
+    self.assertEquals(scanned,[os.path.dirname(d)])
+    #  Removed directories drop out of the snapshot.
+    shutil.rmtree(os.path.join(self.env.PREFIX,"lib"))
+    e = touch("lib","e.txt")
+    self.assertEquals(list(self.env.find_new_files()),[e])
+    q = "SELECT path FROM file_snapshot WHERE path LIKE '%deep%'"
+    self.assertEquals(self.env._db.execute(q).fetchall(),[])
+    #  The snapshot survives between env instances.
+    age()
+    env2 = _TestEnv(self.rootdir)
+    self.assertEquals(list(env2.find_new_files()),[e])
+
+  def test_staged_install(self):
+    self.env.build_jobs = 2
+    self.env.install("lib_one")
+    def find_new_files():
+        raise AssertionError("staged installs shouldn't scan the env")
+    self.env.find_new_files = find_new_files
+    self.env.install("lib_staged")
+    self.assertEquals(self._installed_files("lib_staged"),
+                      ["local/share/staged/lib_staged.txt","local/var/empty/"])
+    fnm = os.path.join(self.env.PREFIX,"share","staged","lib_staged.txt")
+    with open(fnm) as f:
+        self.assertNotEquals(int(f.read()),os.getpid())
+    self.assertFalse(os.path.exists(self.env.load_recipe("lib_staged")
+                                            .STAGING_DIR))
+
+  def test_db_migration(self):
+    rootdir = tempfile.mkdtemp()
+    try:
+        dbpath = os.path.join(rootdir,_TestEnv.DB_NAME)
+        os.makedirs(os.path.dirname(dbpath))
+        db = sqlite3.connect(dbpath)
+        db.execute("CREATE TABLE installed_recipes (recipe STRING NOT NULL)")
+        db.execute("CREATE TABLE installed_files ("
+                   " recipe STRING NOT NULL, filepath STRING NOT NULL)")
+        db.execute("INSERT INTO installed_recipes VALUES ('app_main')")
+        for recipe in ("lib_one","app_main"):
+            db.execute("INSERT INTO installed_files VALUES (?,?)",
+                       (recipe,"local/share/%s.txt" % (recipe,)))
+        db.commit()
+        db.close()
+        env = _TestEnv(rootdir)
+        q = "PRAGMA user_version"
+        self.assertEquals(env._db.execute(q).fetchone()[0],env.DB_VERSION)
+        self.assertTrue(env.is_installed("lib_one"))
+        self.assertTrue(env.is_explicitly_installed("app_main"))
+        self.assertFalse(env.is_installed("lib_two"))
+        self.assertTrue(env._is_oldfile(os.path.join(rootdir,"local",
+                                                     "share","app_main.txt")))
+        self.assertEquals(env._db.execute("PRAGMA journal_mode").fetchone(),
+                          ("wal",))
+        env.uninstall("app_main")
+        q = "SELECT recipe, filepath FROM installed_files"
+        self.assertEquals(env._db.execute(q).fetchall(),
+                          [("lib_one","local/share/lib_one.txt")])
+        q = "EXPLAIN QUERY PLAN SELECT 1 FROM recipe_files WHERE filepath=?"
+        plan = " ".join(str(r) for r in env._db.execute(q,("x",)))
+        self.assertTrue("INDEX" in plan.upper(),plan)
+    finally:
+        shutil.rmtree(rootdir)
+
+  def test_bulk_uninstall(self):
+    self.env.workers = 4
+    files = {}
+    for recipe in ("lib_one","lib_two"):
+        files[recipe] = []
+        for i in xrange(50):
+            fpath = os.path.join(self.env.PREFIX,"lib",recipe,"sub%d" % (i,),
+                                 "file.txt")
+            os.makedirs(os.path.dirname(fpath))
+            open(fpath,"w").close()
+            files[recipe].append(fpath)
+    keepdir = os.path.join(self.env.PREFIX,"lib","lib_one","keep") + os.sep
+    os.makedirs(keepdir)
+    with self.env:
+        self.env.record_files("lib_one",files["lib_one"])
+        self.env.record_files("lib_two",files["lib_two"])
+        self.env.record_files("lib_three",[keepdir])
+    self.env.uninstall_recipes(["lib_one","lib_two","app_main"])
+    self.assertEquals(self._installed_files("lib_one"),[])
+    self.assertEquals(self._installed_files("lib_two"),[])
+    #  Emptied dirs are pruned, but not recorded dirs or their parents.
+    self.assertFalse(os.path.exists(os.path.join(self.env.PREFIX,"lib",
+                                                 "lib_two")))
+    self.assertEquals(os.listdir(os.path.join(self.env.PREFIX,"lib")),
+                      ["lib_one"])
+    self.assertEquals(os.listdir(os.path.join(self.env.PREFIX,"lib",
+                                              "lib_one")),["keep"])
+    self.assertEquals(list(self.env.find_new_files()),[])
+
+  def test_serial_install(self):
+    self.env.install("app_main")
+    for recipe in ("lib_one","lib_two","lib_three","app_main"):
+        self.assertTrue(self.env.is_installed(recipe))
+        fnm = "local/share/%s.txt" % (recipe,)
+        self.assertEquals(self._installed_files(recipe),[fnm])
+    self.assertTrue(self.env.is_explicitly_installed("lib_one"))
+    q = "SELECT recipe FROM installed_recipes"
+    self.assertEquals([r[0] for r in self.env._db.execute(q)],["app_main"])
+
+  def test_parallel_install(self):
+    self.env.build_jobs = 3
+    self.env.install_recipes(["app_main"])
+    for recipe in ("lib_one","lib_two","lib_three","app_main"):
+        fnm = "local/share/%s.txt" % (recipe,)
+        self.assertEquals(self._installed_files(recipe),[fnm])
+        #  The build happened in a subprocess, but its state was kept.
+        with open(os.path.join(self.rootdir,fnm)) as f:
+            self.assertNotEquals(int(f.read()),os.getpid())
+
+  def test_parallel_build_failure(self):
+    self.env.build_jobs = 2
+    self.assertRaises(RuntimeError,self.env.install_recipes,
+                      ["lib_broken","lib_two"])
+    self.assertFalse(self.env.is_installed("lib_broken"))
+    self.assertTrue(self.env.is_installed("lib_two"))
+
+  def test_fork_server(self):
+    results = Queue.Queue()
+    def target(name):
+        if name == "fail":
+            os._exit(1)
+        return (name,os.getpid())
+    server = ForkServer(target,lambda name,res: results.put((name,res)))
+    for name in ("one","two","fail"):
+        server.run(name)
+    server.close()
+    got = dict(results.get_nowait() for _ in xrange(3))
+    self.assertEquals(got["fail"],None)
+    self.assertEquals(got["one"][0],"one")
+    self.assertNotEquals(got["one"][1],got["two"][1])
+    self.assertNotEquals(got["one"][1],os.getpid())
+
+  def test_artifact_cache(self):
+    recipes = ["lib_one","lib_two","lib_three","app_main","lib_staged"]
+    self.env.install_recipes(["app_main","lib_staged"])
+    files = dict((recipe,self._installed_files(recipe)) for recipe in recipes)
+    built = []
+    build_recipe = self.env._build_recipe
+    def count_builds(recipe,r):
+        built.append(recipe)
+        build_recipe(recipe,r)
+    self.env._build_recipe = count_builds
+    #  Reinstalling exactly the same builds just unpacks the artifacts.
+    self.env.uninstall_recipes(recipes)
+    self.env.install_recipes(["app_main","lib_staged"])
+    self.assertEquals(built,[])
+    for recipe in recipes:
+        self.assertEquals(self._installed_files(recipe),files[recipe])
+    self.assertTrue(os.path.isdir(os.path.join(self.env.PREFIX,"var","empty")))
+    #  Changing a recipe invalidates it and everything that depends on it.
+    self.env.uninstall_recipes(recipes)
+    shutil.rmtree(self.env.builddir)
+    lib_one.CONFIGURE_ARGS = ["--changed"]
+    try:
+        self.env.install_recipes(["app_main","lib_staged"])
+    finally:
+        del lib_one.CONFIGURE_ARGS
+    self.assertEquals(sorted(built),["app_main","lib_one","lib_staged",
+                                     "lib_three"])
+    #  Recipes recorded without a build key can't be used as deps.
+    self.env.uninstall_recipes(recipes)
+    with self.env:
+        fnm = os.path.join(self.env.PREFIX,"share","lib_one.txt")
+        os.makedirs(os.path.dirname(fnm))
+        open(fnm,"w").close()
+        self.env.record_files("lib_one",[fnm])
+    del built[:]
+    self.env.install("lib_three")
+    self.assertEquals(built,["lib_three"])
+
+  def test_update(self):
+    self.env.artifacts = None
+    self.env.install_recipes(["app_main","lib_two"])
+    q = "SELECT recipe FROM installed_recipes"
+    explicit = sorted(self.env._db.execute(q).fetchall())
+    built = []
+    build_recipe = self.env._build_recipe
+    def count_builds(recipe,r):
+        built.append(recipe)
+        build_recipe(recipe,r)
+    self.env._build_recipe = count_builds
+    self.env.update()
+    self.assertEquals(built,[])
+    #  A changed recipe is rebuilt along with its reverse dependencies.
+    lib_one.CONFIGURE_ARGS = ["--changed"]
+    try:
+        self.env.update()
+    finally:
+        del lib_one.CONFIGURE_ARGS
+    self.assertEquals(built,["lib_one","lib_three","app_main"])
+    for recipe in ("lib_one","lib_two","lib_three","app_main"):
+        self.assertTrue(self.env.is_installed(recipe))
+    self.assertEquals(sorted(self.env._db.execute(q).fetchall()),explicit)
+    #  Recipes without a recorded key are assumed to be up to date.
+    del built[:]
+    q = "UPDATE recipes SET build_key=NULL WHERE name='lib_one'"
+    self.env._db.execute(q)
+    lib_three.CONFIGURE_ARGS = ["--changed"]
+    try:
+        self.env.update()
+    finally:
+        del lib_three.CONFIGURE_ARGS
+    self.assertEquals(built,["lib_three","app_main"])
+    self.assertNotEquals(self.env._get_build_key("lib_one"),None)
+    #  Reverting a change is also a change.
+    del built[:]
+    self.env.update()
+    self.assertEquals(built,["lib_three","app_main"])
+    del built[:]
+    self.env.update()
+    self.assertEquals(built,[])
+
+  def test_build_key_ignores_build_tree(self):
+    env = linux_envs.MyppyEnv(os.path.join(self.rootdir,"real"))
+    (order,_,loaded) = env._get_install_graph(["lib_qt4"])
+    keys = env._get_build_keys(order,loaded)
+    srcnm = os.path.basename(loaded["lib_qt4"].SOURCE_URL)
+    workdir = os.path.join(env.builddir,srcnm,srcnm[:-len(".tar.gz")])
+    self.assertTrue(workdir in loaded["lib_qt4"].CFLAGS)
+    os.makedirs(workdir)
+    self.assertEquals(env._get_build_keys(order,loaded),keys)
+
+  def test_build_key_errors(self):
+    (order,_,loaded) = self.env._get_install_graph(["lib_one"])
+    def broken(self):
+        raise RuntimeError("no flags for you")
+    lib_one.CONFIGURE_ARGS = property(broken)
+    try:
+        self.assertRaises(RuntimeError,self.env._get_build_keys,order,loaded)
+    finally:
+        del lib_one.CONFIGURE_ARGS
+
+  def test_make_jobserver(self):
+    self.env.jobserver = JobServer(2)
+    self.env.build_jobs = 2
+    self.env.install("lib_parallel")
+    workdir = os.path.join(self.env.builddir,"parallel.tar.gz","src")
+    with open(os.path.join(workdir,"one.flags")) as f:
+        self.assertTrue("--jobserver-" in f.read())
+    #  All the tokens were handed back.
+    os.write(self.env.jobserver.wfd,"x")
+    self.assertEquals(os.read(self.env.jobserver.rfd,10),"++x")
+    #  Recipes can opt out of parallel make.
+    shutil.rmtree(self.env.builddir)
+    self.env.install("lib_serial")
+    with open(os.path.join(workdir,"one.flags")) as f:
+        self.assertFalse("--jobserver-" in f.read())
+    self.env.jobserver.close()
+
+  def test_audit_unsupported(self):
+    self.assertEquals(myppy._audit.run(self.env,["GLIBC_2.5"]),1)
+
+  def test_conflicting_recipes(self):
+    self.assertRaises(RuntimeError,self.env.install_recipes,
+                      ["app_main","app_other"])
+    self.env.install("app_main")
+    self.assertRaises(RuntimeError,self.env.install,"app_other")
+
+
+
+class TestFetch(unittest.TestCase):
+
+  def setUp(self):
+    self.rootdir = tempfile.mkdtemp()
+    self.docroot = tempfile.mkdtemp()
+    self.server = _TestHTTPServer(self.docroot)
+    self.env = _TestEnv(self.rootdir)
+    self.env.server_url = self.server.url
+
+  def tearDown(self):
+    self.server.stop()
+    shutil.rmtree(self.rootdir)
+    shutil.rmtree(self.docroot)
+
+  def test_downloader_reuses_connections(self):
+    downloader = Downloader()
+    for i in xrange(3):
+        url = self.server.add_file("file%d.txt" % (i,),"X" * (i * 100000))
+        with tempfile.TemporaryFile() as f:
+            downloader.download(url,f)
+            f.seek(0)
+            self.assertEquals(f.read(),"X" * (i * 100000))
+    self.assertEquals(self.server.num_connections,1)
+
+  def test_fetch_checks_md5(self):
+    url = self.server.add_file("data.txt","hello world")
+    md5 = hashlib.md5("hello world").hexdigest()
+    cachefile = self.env.fetch(url,md5)
+    self.assertEquals(util.md5file(cachefile),md5)
+    self.assertEquals(os.listdir(os.path.dirname(cachefile)),["data.txt"])
+    self.server.add_file("data.txt","corrupted")
+    os.unlink(cachefile)
+    self.assertRaises(RuntimeError,self.env.fetch,url,md5)
+
+  def test_download_cache(self):
+    cachedir = os.path.join(self.rootdir,"shared-cache")
+    cache1 = DownloadCache(cachedir)
+    cache2 = DownloadCache(cachedir)
+    url1 = self.server.add_file("one/data.txt","one")
+    url2 = self.server.add_file("two/data.txt","two")
+    md5 = hashlib.md5("one").hexdigest()
+    path1 = cache1.fetch(url1,md5)
+    path2 = cache2.fetch(url2)
+    self.assertNotEquals(path1,path2)
+    self.assertEquals(os.path.basename(path1),"data.txt")
+    self.assertEquals(open(path1).read(),"one")
+    self.assertEquals(open(path2).read(),"two")
+    #  Other caches sharing the dir, and mirrors with the same md5, hit.
+    self.assertEquals(self.server.num_requests,2)
+    self.assertEquals(cache2.fetch(url1),path1)
+    self.assertEquals(cache2.fetch(self.server.url + "/mirror/data.txt",md5),
+                      path1)
+    self.assertEquals(self.server.num_requests,2)
+    #  Valid files aren't re-hashed, but changed ones are caught.
+    real_hashfile = util.hashfile
+    util.hashfile = None
+    try:
+        self.assertEquals(cache1.fetch(url1,md5),path1)
+    finally:
+        util.hashfile = real_hashfile
+    with open(path1,"w") as f:
+        f.write("bad")
+    os.utime(path1,(0,0))
+    self.assertEquals(open(cache1.fetch(url1,md5)).read(),"one")
+    self.assertEquals(self.server.num_requests,3)
+    bad_md5 = hashlib.md5("nope").hexdigest()
+    self.assertRaises(RuntimeError,cache1.fetch,url2,bad_md5)
+    self.assertEquals(os.listdir(os.path.join(cachedir,"tmp")),[])
+    #  Least recently used files are evicted to stay under the limit.
+    cache1.max_size = 8
+    cache1.EVICTION_GRACE = 0
+    cache1.fetch(url2)
+    time.sleep(0.01)
+    url3 = self.server.add_file("three/data.txt","three")
+    path3 = cache1.fetch(url3)
+    self.assertFalse(os.path.exists(path1))
+    self.assertTrue(os.path.exists(path2))
+    self.assertTrue(os.path.exists(path3))
+    self.assertEquals(cache2.lookup(url1),None)
+
+  def test_resume_download(self):
+    data = os.urandom(300000)
+    url = self.server.add_file("big.bin",data)
+    cache = DownloadCache(os.path.join(self.rootdir,"cache"))
+    self.server.truncate_after = 100000
+    self.assertRaises(IOError,cache.fetch,url)
+    partfile = hashlib.sha1(url).hexdigest() + ".part"
+    self.assertEquals(sorted(os.listdir(os.path.join(cache.cachedir,"tmp"))),
+                      [partfile,partfile + ".validator"])
+    self.server.truncate_after = None
+    path = cache.fetch(url,hashlib.md5(data).hexdigest())
+    self.assertEquals(self.server.ranges,["bytes=100000-"])
+    self.assertEquals(open(path,"rb").read(),data)
+    self.assertEquals(os.listdir(os.path.join(cache.cachedir,"tmp")),[])
+    #  A file that changed since the part was downloaded is started over.
+    url = self.server.add_file("changing.bin",data)
+    self.server.truncate_after = 100000
+    self.assertRaises(IOError,cache.fetch,url)
+    self.server.truncate_after = None
+    data2 = os.urandom(300000)
+    self.server.add_file("changing.bin",data2)
+    self.assertEquals(open(cache.fetch(url),"rb").read(),data2)
+    #  As is one that can't be validated.
+    self.server.send_etags = False
+    url = self.server.add_file("unvalidated.bin",data)
+    self.server.truncate_after = 100000
+    self.assertRaises(IOError,cache.fetch,url)
+    self.server.truncate_after = None
+    self.server.ranges = []
+    self.assertEquals(open(cache.fetch(url),"rb").read(),data)
+    self.assertEquals(self.server.ranges,[])
+    self.server.send_etags = True
+    #  Servers that won't do ranges get the whole file requested again.
+    url = self.server.add_file("big2.bin",data)
+    self.server.support_ranges = False
+    self.server.truncate_after = 100000
+    self.assertRaises(IOError,cache.fetch,url)
+    self.server.truncate_after = None
+    path = cache.fetch(url,hashlib.md5(data).hexdigest())
+    self.assertEquals(open(path,"rb").read(),data)
+
+  def test_segmented_download(self):
+    data = os.urandom(300000)
+    url = self.server.add_file("big.bin",data)
+    cache = DownloadCache(os.path.join(self.rootdir,"cache"),segments=4)
+    cache.SEGMENT_MIN_SIZE = 1000
+    path = cache.fetch(url,hashlib.md5(data).hexdigest())
+    self.assertEquals(open(path,"rb").read(),data)
+    self.assertEquals(sorted(self.server.ranges),["bytes=0-74999",
+                                                  "bytes=150000-224999",
+                                                  "bytes=225000-299999",
+                                                  "bytes=75000-149999"])
+    self.assertEquals(os.listdir(os.path.join(cache.cachedir,"tmp")),[])
+    #  Small files, and servers that won't do ranges, aren't segmented.
+    url = self.server.add_file("big2.bin",data)
+    self.server.support_ranges = False
+    self.server.ranges = []
+    path = cache.fetch(url)
+    self.assertEquals(open(path,"rb").read(),data)
+    self.assertEquals(self.server.ranges,[])
+
+  def test_mirrors(self):
+    #  The original host never answers, but there's a local and a remote
+    #  mirror.
+    dead = socket.socket()
+    dead.bind(("127.0.0.1",0))
+    dead.listen(5)
+    deadurl = "http://127.0.0.1:%d/dead/" % (dead.getsockname()[1],)
+    localdir = os.path.join(self.rootdir,"mirror")
+    os.makedirs(localdir)
+    with open(os.path.join(localdir,"one.txt"),"w") as f:
+        f.write("one")
+    for nm in ("one","two","three"):
+        self.server.add_file("src/%s.txt" % (nm,),nm)
+    mirrors = MirrorMap.load("%s %s %s/src" %
+                             (deadurl,localdir,self.server.url,))
+    cache = DownloadCache(os.path.join(self.rootdir,"cache"),mirrors=mirrors)
+    cache.PROBE_TIMEOUT = 0.5
+    self.assertEquals(len(mirrors.get_sources(deadurl + "x")),3)
+    self.assertEquals(mirrors.get_sources("http://other/x"),
+                      [("http://other/x","http://other/x")])
+    #  A local mirror with the file is used without probing anything.
+    path = cache.fetch(deadurl + "one.txt")
+    self.assertEquals(open(path).read(),"one")
+    db = cache._db()
+    self.assertEquals(db.execute("SELECT base FROM mirrors").fetchall(),
+                      [("file://" + localdir + "/",)])
+    self.assertEquals(self.server.num_requests,0)
+    #  Otherwise they're all probed, and those that hang time out.
+    path = cache.fetch(deadurl + "two.txt")
+    self.assertEquals(open(path).read(),"two")
+    throughputs = dict(db.execute("SELECT base, throughput FROM mirrors"))
+    self.assertEquals(len(throughputs),3)
+    self.assertEquals(throughputs[deadurl],-1)
+    self.assertTrue(throughputs[self.server.url + "/src/"] > 0)
+    #  Mirrors that don't have the file are skipped, without re-probing.
+    db.execute("UPDATE mirrors SET throughput=1000000000"
+               "  WHERE base LIKE 'file:%'")
+    num_requests = self.server.num_requests
+    path = cache.fetch(deadurl + "three.txt")
+    self.assertEquals(open(path).read(),"three")
+    self.assertEquals(self.server.num_requests,num_requests + 1)
+    throughputs = dict(db.execute("SELECT base, throughput FROM mirrors"))
+    self.assertEquals(throughputs["file://" + localdir + "/"],-1)
+    #  The cache is keyed by the original URL.
+    self.assertEquals(cache.lookup(deadurl + "three.txt"),path)
+    dead.close()
+    self.assertRaises(EnvironmentError,cache.fetch,deadurl + "four.txt")
+
+  def test_bundle_sources(self):
+    self.server.add_file("src_one.txt","one")
+    self.server.add_file("src_two.txt","two")
+    bundle = os.path.join(self.rootdir,"sources.tar")
+    self.env.bundle_sources(["src_two"],bundle)
+    otherdir = os.path.join(self.rootdir,"other")
+    other = _TestEnv(otherdir)
+    other.server_url = self.server.url
+    num_requests = self.server.num_requests
+    urls = other.import_sources(bundle)
+    self.assertEquals(sorted(urls),[self.server.url + "/src_one.txt",
+                                    self.server.url + "/src_two.txt"])
+    other.fetch_recipes(["src_two"])
+    self.assertEquals(self.server.num_requests,num_requests)
+    path = other.download_cache.lookup(self.server.url + "/src_two.txt")
+    self.assertEquals(open(path).read(),"two")
+    #  Files that are already cached aren't read again.
+    called = []
+    def hashfile(*args):
+        called.append(args)
+        return util.hashfile(*args)
+    old_hashfile = util.hashfile
+    util.hashfile = hashfile
+    try:
+        other.import_sources(bundle)
+    finally:
+        util.hashfile = old_hashfile
+    self.assertEquals(called,[])
+    #  Corrupted bundles are rejected.
+    with open(bundle,"rb") as f:
+        data = f.read()
+    with open(bundle,"wb") as f:
+        f.write(data.replace("two\0","TWO\0"))
+    shutil.rmtree(otherdir)
+    other = _TestEnv(otherdir)
+    self.assertRaises(RuntimeError,other.import_sources,bundle)
+    self.assertEquals(other.download_cache.lookup(
+                        self.server.url + "/src_two.txt"),None)
+
+  def test_source_groups(self):
+    tarball = os.path.join(self.docroot,"grp.tar")
+    tf = tarfile.open(tarball,"w")
+    info = tarfile.TarInfo("grp-1.0/README")
+    info.size = 5
+    tf.addfile(info,StringIO("hello"))
+    tf.close()
+    def read(nm):
+        workdir = os.path.join(self.env.builddir,"grp.tar","grp-1.0")
+        with open(os.path.join(workdir,nm)) as f:
+            return f.read().split()
+    self.env.load_recipe("grp_one").build()
+    self.env.load_recipe("grp_two").build()
+    self.assertEquals(read("configured"),["grp_one"])
+    self.assertEquals(read("made"),["grp_one","grp_two"])
+    #  Recipes with different options get a freshly prepared tree.
+    self.env.load_recipe("grp_other").build()
+    self.assertEquals(read("configured"),["grp_one","grp_other"])
+    self.env.load_recipe("grp_one").build()
+    self.assertEquals(read("configured"),["grp_one","grp_other","grp_one"])
+    #  Trees aren't shared between different runs of myppy.
+    env = _TestEnv(self.rootdir)
+    env.server_url = self.server.url
+    env.load_recipe("grp_two").build()
+    self.assertEquals(read("configured"),
+                      ["grp_one","grp_other","grp_one","grp_two"])
+
+  def test_recompress(self):
+    srcdir = os.path.join(self.rootdir,"src")
+    os.makedirs(os.path.join(srcdir,"pkg-1.0"))
+    with open(os.path.join(srcdir,"pkg-1.0","README"),"w") as f:
+        f.write("hello" * 1000)
+    tf = tarfile.open(os.path.join(self.docroot,"pkg.tar.bz2"),"w:bz2")
+    tf.add(os.path.join(srcdir,"pkg-1.0"),"pkg-1.0")
+    tf.close()
+    self.server.add_file("other.txt","other")
+    self.assertRaises(ValueError,DownloadCache,self.rootdir,recompress="xx")
+    formats = ["tar"]
+    for format in ("zstd","lz4"):
+        if util.which(format) is not None:
+            formats.append(format)
+    for format in formats:
+        cachedir = os.path.join(self.rootdir,"cache-" + format)
+        cache = DownloadCache(cachedir,recompress=format)
+        path = cache.fetch(self.server.url + "/pkg.tar.bz2")
+        fastpath = cache.get_fast_copy(path)
+        self.assertEquals(os.path.dirname(fastpath),os.path.dirname(path))
+        self.assertTrue(fastpath.endswith(unpack.RECOMPRESS_FORMATS[format][0]))
+        #  The original is kept, and unpacks the same as the fast copy.
+        self.assertEquals(util.hashfile(path,("sha256",))[0],
+                          cache.get_sha256(path))
+        destdir = os.path.join(self.rootdir,"dest-" + format)
+        unpack.extract(fastpath,destdir)
+        with open(os.path.join(destdir,"pkg-1.0","README")) as f:
+            self.assertEquals(f.read(),"hello" * 1000)
+        #  Files that aren't slow tarballs aren't recompressed.
+        other = cache.fetch(self.server.url + "/other.txt")
+        self.assertEquals(cache.get_fast_copy(other),None)
+        self.assertEquals(len(os.listdir(os.path.dirname(other))),1)
+        #  Evicting the original also evicts the fast copy.
+        cache.EVICTION_GRACE = -1
+        cache.max_size = 10
+        cache._evict(other)
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
+        self.assertEquals(cache.lookup(self.server.url + "/pkg.tar.bz2"),None)
+    #  The env unpacks from the fast copy if there is one.
+    self.env.download_cache.recompress = "tar"
+    src = self.env.fetch(self.server.url + "/pkg.tar.bz2")
+    unpacked = []
+    old_unpack = self.env.source_trees.unpack
+    def unpack_tree(src,*args):
+        unpacked.append(src)
+        return old_unpack(src,*args)
+    self.env.source_trees.unpack = unpack_tree
+    self.env.unpack(src,os.path.join(self.rootdir,"dest"))
+    self.assertEquals(unpacked,[src[:-len(".tar.bz2")] + ".tar"])
+    #  Tarballs that can't be decompressed aren't recompressed.
+    xzfile = os.path.join(self.rootdir,"pkg.tar.xz")
+    with open(xzfile,"wb") as f:
+        f.write("\xfd7zXZ\x00 not really")
+    find_decompressor = unpack.find_decompressor
+    unpack.find_decompressor = lambda src: None
+    try:
+        dst = os.path.join(self.rootdir,"pkg.tar")
+        self.assertFalse(unpack.recompress(xzfile,dst,"tar"))
+        self.assertFalse(os.path.exists(dst))
+    finally:
+        unpack.find_decompressor = find_decompressor
+
+  def test_fetch_recipes(self):
+    self.server.add_file("src_one.txt","one")
+    self.server.add_file("src_two.txt","two")
+    self.env.install("src_one")
+    os.unlink(self.env.fetch(self.server.url + "/src_one.txt"))
+    self.env.fetch_jobs = 2
+    self.env.fetch_recipes(["src_two"])
+    for nm in ("src_one.txt","src_two.txt"):
+        self.assertTrue(self.env.download_cache.lookup(self.server.url+"/"+nm))
+    os.unlink(self.env.download_cache.lookup(self.server.url+"/src_one.txt"))
+    os.unlink(os.path.join(self.docroot,"src_one.txt"))
+    self.assertRaises(RuntimeError,self.env.fetch_recipes,["src_two"])
+
+  def test_install_with_prefetch(self):
+    self.server.add_file("src_one.txt","one")
+    self.server.add_file("src_two.txt","two")
+    self.env.fetch_jobs = 2
+    self.env.build_jobs = 2
+    self.env.install("src_two")
+    with open(os.path.join(self.env.PREFIX,"share","src_two.txt")) as f:
+        self.assertEquals(f.read(),"two")
+    #  A missing source file fails the install.
+    self.env.artifacts = None
+    self.env.uninstall("src_two")
+    os.unlink(self.env.download_cache.lookup(self.server.url+"/src_two.txt"))
+    os.unlink(os.path.join(self.docroot,"src_two.txt"))
+    self.assertRaises(RuntimeError,self.env.install,"src_two")
+    self.assertFalse(self.env.is_installed("src_two"))
+
+  def test_http_artifact_store(self):
+    self.server.add_file("src_one.txt","one")
+    self.server.add_file("src_two.txt","two")
+    def make_env():
+        env = _TestEnv(self.rootdir)
+        env.server_url = self.server.url
+        store = get_artifact_store(self.server.url + "/artifacts")
+        env.artifacts = ArtifactCache(store,os.path.join(env.builddir,"a"))
+        env.DEPENDENCIES = ["src_two"]
+        return env
+    self.env = make_env()
+    self.env.init()
+    self.assertEquals(self.env.artifact_report["miss"],["src_one","src_two"])
+    self.assertEquals(len(self.server.uploads),4)
+    #  A fresh env at the same path gets both recipes from the server,
+    #  without fetching their sources.
+    for nm in ("src_one.txt","src_two.txt"):
+        os.rename(os.path.join(self.docroot,nm),
+                  os.path.join(self.docroot,nm + ".hidden"))
+    shutil.rmtree(self.rootdir)
+    self.env = make_env()
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        self.env.init()
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    self.assertEquals(self.env.artifact_report["hit"],["src_one","src_two"])
+    self.assertTrue("ARTIFACT CACHE: 2 HITS, 0 MISSES, 0 UNCACHEABLE"
+                    in output,output)
+    with open(os.path.join(self.env.PREFIX,"share","src_two.txt")) as f:
+        self.assertEquals(f.read(),"two")
+    #  A corrupted artifact is rebuilt and published again.
+    for nm in ("src_one.txt","src_two.txt"):
+        os.rename(os.path.join(self.docroot,nm + ".hidden"),
+                  os.path.join(self.docroot,nm))
+    for nm in os.listdir(os.path.join(self.docroot,"artifacts")):
+        if nm.endswith(".tar.gz"):
+            with open(os.path.join(self.docroot,"artifacts",nm),"r+b") as f:
+                f.seek(20)
+                f.write("CORRUPTED")
+    shutil.rmtree(self.rootdir)
+    self.env = make_env()
+    del self.server.uploads[:]
+    self.env.init()
+    self.assertEquals(self.env.artifact_report["hit"],[])
+    self.assertEquals(self.env.artifact_report["miss"],["src_one","src_two"])
+    self.assertEquals(len(self.server.uploads),4)
+    self.env.uninstall_recipes(["src_one","src_two"])
+    self.env.install("src_two")
+    self.assertEquals(self.env.artifact_report["hit"],["src_one","src_two"])
+
+  def test_http_artifact_store_timeout(self):
+    #  A server that never answers is just a cache miss.
+    dead = socket.socket()
+    dead.bind(("127.0.0.1",0))
+    dead.listen(5)
+    deadurl = "http://127.0.0.1:%d/artifacts" % (dead.getsockname()[1],)
+    store = HTTPArtifactStore(deadurl,timeout=0.5)
+    cache = ArtifactCache(store,os.path.join(self.rootdir,"a"))
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        self.assertFalse(cache.has("somekey"))
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    self.assertTrue("ARTIFACT STORE ERROR FOR somekey" in output,output)
+
+
+class TestUnpack(unittest.TestCase):
+
+  def setUp(self):
+    self.workdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    for (dirnm,dirs,_) in os.walk(self.workdir):
+        for nm in dirs:
+            os.chmod(os.path.join(dirnm,nm),0755)
+    shutil.rmtree(self.workdir)
+
+  def _make_tarball(self,name,mode="w:gz"):
+    srcdir = os.path.join(self.workdir,"src")
+    os.makedirs(os.path.join(srcdir,"pkg-1.0","bin"))
+    with open(os.path.join(srcdir,"pkg-1.0","README"),"w") as f:
+        f.write("hello")
+    with open(os.path.join(srcdir,"pkg-1.0","bin","run"),"w") as f:
+        f.write("#!/bin/sh\n")
+    os.chmod(os.path.join(srcdir,"pkg-1.0","bin","run"),0755)
+    os.symlink("README",os.path.join(srcdir,"pkg-1.0","LINK"))
+    tarball = os.path.join(self.workdir,name)
+    tf = tarfile.open(tarball,mode)
+    tf.add(os.path.join(srcdir,"pkg-1.0"),"pkg-1.0")
+    tf.close()
+    shutil.rmtree(srcdir)
+    return tarball
+
+  def _check_tree(self,destdir):
+    pkgdir = os.path.join(destdir,"pkg-1.0")
+    self.assertEquals(open(os.path.join(pkgdir,"README")).read(),"hello")
+    self.assertEquals(os.readlink(os.path.join(pkgdir,"LINK")),"README")
+    mode = os.stat(os.path.join(pkgdir,"bin","run")).st_mode
+    self.assertEquals(stat.S_IMODE(mode),0755)
+
+  def test_extract(self):
+    for (name,mode) in (("a.tar.gz","w:gz"),("a.tar.bz2","w:bz2"),
+                        ("a.tar","w")):
+        tarball = self._make_tarball(name,mode)
+        destdir = os.path.join(self.workdir,"dest-" + name)
+        unpack.extract(tarball,destdir)
+        self._check_tree(destdir)
+    zfnm = os.path.join(self.workdir,"a.zip")
+    zf = zipfile.ZipFile(zfnm,"w")
+    info = zipfile.ZipInfo("pkg-1.0/bin/run")
+    info.external_attr = 0100755 << 16
+    zf.writestr(info,"#!/bin/sh\n")
+    zf.close()
+    unpack.extract(zfnm,os.path.join(self.workdir,"dest-zip"))
+    runfile = os.path.join(self.workdir,"dest-zip","pkg-1.0","bin","run")
+    self.assertEquals(stat.S_IMODE(os.stat(runfile).st_mode),0755)
+    #  Members can't escape from the destination directory.
+    tarball = os.path.join(self.workdir,"evil.tar")
+    tf = tarfile.open(tarball,"w")
+    info = tarfile.TarInfo("../evil.txt")
+    tf.addfile(info,StringIO(""))
+    tf.close()
+    self.assertRaises(ValueError,unpack.extract,tarball,
+                      os.path.join(self.workdir,"dest-evil"))
+    self.assertFalse(os.path.exists(os.path.join(self.workdir,"evil.txt")))
+    #  Not even via symlinks.
+    outside = os.path.join(self.workdir,"outside")
+    os.makedirs(outside)
+    evils = ([("d",outside),("d/evil.txt",None)],
+             [("d",".."),("d/outside/evil.txt",None)],
+             [("d","."),("d/e",".."),("d/e/outside/evil.txt",None)])
+    for members in evils:
+        tf = tarfile.open(tarball,"w")
+        for (name,target) in members:
+            info = tarfile.TarInfo(name)
+            if target is None:
+                tf.addfile(info,StringIO(""))
+            else:
+                info.type = tarfile.SYMTYPE
+                info.linkname = target
+                tf.addfile(info)
+        tf.close()
+        destdir = os.path.join(self.workdir,"dest-evil")
+        self.assertRaises(ValueError,unpack.extract,tarball,destdir)
+        self.assertEquals(os.listdir(outside),[])
+        shutil.rmtree(destdir)
+
+  def test_source_tree_cache(self):
+    tarball = self._make_tarball("pkg.tar.gz")
+    cache = unpack.SourceTreeCache(os.path.join(self.workdir,"trees"))
+    extracted = []
+    old_extract = cache._extract
+    def _extract(*args):
+        extracted.append(args)
+        return old_extract(*args)
+    cache._extract = _extract
+    cache.unpack(tarball,os.path.join(self.workdir,"one"))
+    self._check_tree(os.path.join(self.workdir,"one"))
+    cache.unpack(tarball,os.path.join(self.workdir,"two"))
+    self._check_tree(os.path.join(self.workdir,"two"))
+    self.assertEquals(len(extracted),1)
+    #  Writing into a clone must never corrupt later unpacks, even if
+    #  it was hardlinked to the cached tree.
+    time.sleep(0.01)
+    with open(os.path.join(self.workdir,"two","pkg-1.0","README"),"w") as f:
+        f.write("changed")
+    cache.unpack(tarball,os.path.join(self.workdir,"three"))
+    self._check_tree(os.path.join(self.workdir,"three"))
+    self.assertTrue(len(extracted) in (1,2))
+
+
+class TestELF(unittest.TestCase):
+
+  def setUp(self):
+    self.workdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.workdir)
+
+  def _compile(self,name,source,*args):
+    """Compile a small C program into the workdir, return its path."""
+    srcfile = os.path.join(self.workdir,name + ".c")
+    with open(srcfile,"w") as f:
+        f.write(source)
+    outfile = os.path.join(self.workdir,name)
+    util.do("gcc","-o",outfile,srcfile,*args)
+    return outfile
+
+  def _build_fixtures(self):
+    lib = self._compile("libfixture.so.1",
+                        "#include <math.h>\n"
+                        "double fixture(double x) { return sqrt(x); }\n",
+                        "-shared","-fPIC","-Wl,-soname,libfixture.so.1",
+                        "-Wl,--no-as-needed","-lm",
+                        "-Wl,--disable-new-dtags","-Wl,-rpath,/opt/fixture/lib")
+    os.symlink(lib,os.path.join(self.workdir,"libfixture.so"))
+    exe = self._compile("prog",
+                        "#include <stdio.h>\n"
+                        "double fixture(double x);\n"
+                        "int main() { printf(\"%f\", fixture(2)); }\n",
+                        "-L" + self.workdir,"-lfixture",
+                        "-Wl,--enable-new-dtags","-Wl,-rpath,$ORIGIN")
+    return (lib,exe)
+
+  @unittest.skipUnless(util.which("gcc"),"gcc is not available")
+  def test_read_elf(self):
+    (lib,exe) = self._build_fixtures()
+    info = elf.read_elf(lib)
+    self.assertEquals(info.type,"shared object")
+    self.assertFalse(info.is_executable)
+    self.assertEquals(info.interpreter,None)
+    self.assertEquals(info.soname,"libfixture.so.1")
+    self.assertEquals(info.rpath,"/opt/fixture/lib")
+    self.assertEquals(info.runpath,None)
+    self.assertTrue("libm.so.6" in info.needed)
+    self.assertTrue("libc.so.6" in info.needed)
+    glibc = dict(info.requires_version("GLIBC_"))
+    self.assertTrue(any("sqrt" in syms for syms in glibc.itervalues()))
+    info = elf.read_elf(exe)
+    self.assertTrue(info.is_executable)
+    self.assertTrue(info.interpreter.startswith("/lib"))
+    self.assertEquals(info.runpath,"$ORIGIN")
+    self.assertEquals(info.rpath,None)
+    self.assertEquals(info.needed[0],"libfixture.so.1")
+    self.assertEquals(info.symbol_versions.get("fixture"),None)
+    self.assertTrue(info.symbol_versions["printf"].startswith("GLIBC_"))
+
+  @unittest.skipUnless(util.which("gcc"),"gcc is not available")
+  def test_edit_elf(self):
+    (lib,exe) = self._build_fixtures()
+    self.assertTrue(elf.set_rpath(lib,"/opt/fix"))
+    self.assertEquals(elf.read_elf(lib).rpath,"/opt/fix")
+    self.assertFalse(elf.set_rpath(lib,"/opt/fixture/lib/is/too/long"))
+    self.assertEquals(elf.read_elf(lib).rpath,"/opt/fix")
+    interp = elf.read_elf(exe).interpreter
+    self.assertFalse(elf.set_interpreter(exe,interp + "-too-long"))
+    self.assertFalse(elf.set_interpreter(lib,interp))
+    self.assertTrue(elf.set_interpreter(exe,interp))
+    for path in (lib,exe):
+        size = os.path.getsize(path)
+        self.assertTrue(elf.strip(path))
+        self.assertTrue(os.path.getsize(path) < size)
+        size = os.path.getsize(path)
+        self.assertTrue(elf.strip(path))
+        self.assertEquals(os.path.getsize(path),size)
+    self.assertEquals(elf.read_elf(exe).runpath,"$ORIGIN")
+    self.assertEquals(util.bt(exe),"1.414214")
+
+  @unittest.skipUnless(util.which("gcc"),"gcc is not available")
+  def test_strip_emitted_relocs(self):
+    #  Kept relocations refer to the symbol table, so they must go too.
+    exe = self._compile("relocs","#include <stdio.h>\n"
+                        "int main() { printf(\"ok\"); return 0; }\n",
+                        "-g","-Wl,--emit-relocs")
+    size = os.path.getsize(exe)
+    self.assertTrue(elf.strip(exe))
+    self.assertTrue(os.path.getsize(exe) < size)
+    self.assertEquals(util.bt(exe),"ok")
+    if util.which("readelf"):
+        sections = util.bt("readelf","-S",exe)
+        self.assertFalse(".symtab" in sections)
+        self.assertFalse(".rela.text" in sections)
+
+  @unittest.skipUnless(util.which("gcc"),"gcc is not available")
+  def test_adjust_interpreter(self):
+    env = linux_envs.MyppyEnv(os.path.join(self.workdir,"env"))
+    exe = self._compile("lsbprog","int main() { return 0; }\n",
+                        "-Wl,--dynamic-linker=" + env.INTERP_PLACEHOLDER)
+    self.assertEquals(elf.read_elf(exe).interpreter,env.INTERP_PLACEHOLDER)
+    self.assertTrue(env._adjust_interp_path(exe))
+    self.assertEquals(elf.read_elf(exe).interpreter,"/lib/ld-linux.so.2")
+
+  @unittest.skipUnless(util.which("gcc"),"gcc is not available")
+  def test_postprocess_without_placeholders(self):
+    #  Binaries not linked with PLACEHOLDER_LDFLAGS can't be relocated,
+    #  and that's an error rather than something to quietly skip.
+    env = linux_envs.MyppyEnv(os.path.join(self.workdir,"env"))
+    env.workers = 1
+    lib = self._compile("libbare.so","int bare(void) { return 42; }\n",
+                        "-shared","-fPIC","-Wl,-rpath,/opt/fix")
+    libpath = os.path.join(env.PREFIX,"lib","libbare.so")
+    os.rename(lib,libpath)
+    exe = self._compile("bareprog","int main() { return 0; }\n",
+                        "-Wl,-rpath," + env.RPATH_PLACEHOLDER,
+                        "-Wl,--dynamic-linker=/lib/ld-lsb.so.3")
+    exepath = os.path.join(env.PREFIX,"bin","bareprog")
+    os.makedirs(os.path.dirname(exepath))
+    os.rename(exe,exepath)
+    try:
+        env._postprocess_files("lib_bare",[libpath,exepath])
+    except RuntimeError, e:
+        msg = str(e)
+    else:
+        self.fail("relocating the binaries should have failed")
+    self.assertTrue(libpath + ": no room to set rpath" in msg,msg)
+    self.assertFalse(exepath + ": no room to set rpath" in msg,msg)
+    self.assertTrue(exepath + ": no room to set interpreter" in msg,msg)
+
+  @unittest.skipUnless(util.which("gcc"),"gcc is not available")
+  def test_read_bad_files(self):
+    (lib,_) = self._build_fixtures()
+    self.assertEquals(elf.read_elf(__file__),None)
+    truncated = os.path.join(self.workdir,"truncated.so")
+    with open(lib,"rb") as fIn:
+        with open(truncated,"wb") as fOut:
+            fOut.write(fIn.read(100))
+    self.assertRaises(ValueError,elf.read_elf,truncated)
+
+  def _build_glibc_fixtures(self,env):
+    """Build two libs needing too new a glibc and one that's fine."""
+    libs = []
+    for nm in ("libnew1.so","libnew2.so","libold.so"):
+        if nm == "libold.so":
+            source = "int old(void) { return 42; }\n"
+        else:
+            source = "#define _GNU_SOURCE\n#include <stdlib.h>\n" \
+                     "char* new(void) { return secure_getenv(\"HOME\"); }\n"
+        lib = self._compile(nm,source,"-shared","-fPIC",
+                            "-Wl,-rpath," + env.RPATH_PLACEHOLDER)
+        libs.append(os.path.join(env.PREFIX,"lib",nm))
+        os.rename(lib,libs[-1])
+    return libs
+
+  @unittest.skipUnless(util.which("gcc"),"gcc is not available")
+  def test_postprocess_reports_all_errors(self):
+    env = linux_envs.MyppyEnv(os.path.join(self.workdir,"env"))
+    env.workers = 2
+    libs = self._build_glibc_fixtures(env)
+    try:
+        env._postprocess_files("lib_new",libs)
+    except RuntimeError, e:
+        msg = str(e)
+    else:
+        self.fail("glibc symbol check should have failed")
+    self.assertTrue(libs[0] + ": GLIBC_2.17: secure_getenv" in msg)
+    self.assertTrue(libs[1] + ": GLIBC_2.17: secure_getenv" in msg)
+    self.assertFalse(libs[2] in msg)
+    env._postprocess_files("lib_old",libs[2:])
+    self.assertEquals(elf.read_elf(libs[2]).runpath,
+                      "${ORIGIN}:${ORIGIN}/../lib")
+
+  @unittest.skipUnless(util.which("gcc"),"gcc is not available")
+  def test_audit_cache(self):
+    env = linux_envs.MyppyEnv(os.path.join(self.workdir,"env"))
+    env.workers = 1
+    libs = self._build_glibc_fixtures(env)
+    try:
+        env._postprocess_files("lib_new",libs)
+    except RuntimeError, e:
+        msg = str(e)
+    else:
+        self.fail("glibc symbol check should have failed")
+    env._postprocess_files("lib_old",libs[2:])
+    #  Only the cache entries for the files being processed are loaded.
+    with env:
+        q = "INSERT INTO binary_audit (hash, policy, errors, stripped)" \
+            "  VALUES (?,?,'',0)"
+        env._db.execute(q,("0" * 40,env.AUDIT_POLICY))
+    loaded = []
+    postprocess_file = env._postprocess_file
+    def record_cache(*args):
+        loaded.extend(env._audit_cache)
+        return postprocess_file(*args)
+    env._postprocess_file = record_cache
+    #  Identical binaries are served from the audit cache.
+    def fail(*args):
+        raise RuntimeError("binary processed twice")
+    env._strip = env._check_glibc_symbols = fail
+    env._postprocess_files("lib_old",libs[2:])
+    #  Only the offending symbols need to be looked up again.
+    del env._check_glibc_symbols
+    try:
+        env._postprocess_files("lib_new",libs[:2])
+    except RuntimeError, e:
+        self.assertEquals(str(e),msg)
+    else:
+        self.fail("cached glibc errors should have been reported")
+    q = "SELECT COUNT(*) FROM binary_audit WHERE stripped"
+    self.assertEquals(env._db.execute(q).fetchone()[0],2)
+    self.assertTrue(loaded)
+    self.assertFalse("0" * 40 in loaded)
+
+  @unittest.skipUnless(util.which("gcc"),"gcc is not available")
+  def test_audit(self):
+    env = linux_envs.MyppyEnv(os.path.join(self.workdir,"env"))
+    env.workers = 2
+    libdir = os.path.join(env.PREFIX,"lib")
+    sources = {
+      "libnew.so": "#define _GNU_SOURCE\n#include <stdlib.h>\n"
+                   "char* new(void) { return secure_getenv(\"HOME\"); }\n",
+      "libgone.so": "int gone(void) { return 42; }\n",
+      "libuser.so": "int gone(void);\nint user(void) { return gone(); }\n",
+    }
+    for nm in sorted(sources):
+        lib = self._compile(nm,sources[nm],"-shared","-fPIC",
+                            "-L" + libdir,"-Wl,--no-as-needed","-lc",
+                            *(["-lgone"] if nm == "libuser.so" else []))
+        os.rename(lib,os.path.join(libdir,nm))
+    os.unlink(os.path.join(libdir,"libgone.so"))
+    with open(os.path.join(libdir,"README.txt"),"w") as f:
+        f.write("not a binary")
+    report = env.audit()
+    files = dict((r["path"],r) for r in report["files"])
+    self.assertEquals(sorted(files),["local/lib/libnew.so",
+                                     "local/lib/libuser.so"])
+    self.assertEquals(report["failures"],2)
+    libnew = files["local/lib/libnew.so"]
+    self.assertEquals(libnew["glibc"],"2.17")
+    self.assertEquals(libnew["errors"],["GLIBC_2.17: secure_getenv"])
+    self.assertEquals(libnew["unresolved"],[])
+    self.assertEquals(files["local/lib/libuser.so"]["unresolved"],
+                      ["libgone.so"])
+    self.assertEquals(files["local/lib/libuser.so"]["errors"],[])
+    env.set_version_limit("GLIBC_2.18")
+    report = env.audit()
+    self.assertEquals(report["failures"],1)
+    self.assertEquals(report["limits"]["GLIBC_"],"2.18")
+
+  @unittest.skipUnless(util.which("gcc"),"gcc is not available")
+  def test_libgraph(self):
+    env = linux_envs.MyppyEnv(os.path.join(self.workdir,"env"))
+    (lib,exe) = self._build_fixtures()
+    unused = self._compile("libunused.so.1","int unused(void) { return 1; }",
+                           "-shared","-fPIC","-Wl,-soname,libunused.so.1")
+    libdir = os.path.join(env.PREFIX,"lib")
+    bindir = os.path.join(env.PREFIX,"bin")
+    os.makedirs(bindir)
+    files = {"lib_fixture": [], "app_prog": []}
+    for (src,dst) in ((lib,libdir),(unused,libdir),(exe,bindir)):
+        os.rename(src,os.path.join(dst,os.path.basename(src)))
+    for nm in ("libfixture.so.1","libunused.so.1"):
+        os.symlink(nm,os.path.join(libdir,nm[:-2]))
+        files["lib_fixture"].append(os.path.join(libdir,nm))
+        files["lib_fixture"].append(os.path.join(libdir,nm[:-2]))
+    files["app_prog"].append(os.path.join(bindir,"prog"))
+    with open(os.path.join(bindir,"script.sh"),"w") as f:
+        f.write("#!/bin/sh\n")
+    files["app_prog"].append(os.path.join(bindir,"script.sh"))
+    with env:
+        for recipe in files:
+            base_envs.MyppyEnv.record_files(env,recipe,files[recipe])
+    graph = LibraryGraph(env)
+    self.assertEquals(sorted(graph.files),["local/bin/prog",
+                                           "local/lib/libfixture.so.1",
+                                           "local/lib/libunused.so.1"])
+    self.assertEquals(graph.needs["local/bin/prog"],
+                      ["local/lib/libfixture.so.1"])
+    self.assertEquals(graph.get_entry_points(),set(["local/bin/prog"]))
+    self.assertEquals(graph.get_entry_points(["app_prog"]),
+                      set(["local/bin/prog"]))
+    self.assertEquals(graph.get_entry_points(["local/lib/libunused.so.1"]),
+                      set(["local/lib/libunused.so.1"]))
+    self.assertRaises(ValueError,graph.get_entry_points,["local/bin/nope"])
+    entries = graph.get_entry_points()
+    self.assertEquals(graph.get_unused(entries),
+                      set(["local/lib/libunused.so.1"]))
+    destdir = os.path.join(self.workdir,"export")
+    graph.export(destdir,entries)
+    self.assertTrue(os.path.exists(os.path.join(destdir,"local/bin/prog")))
+    self.assertTrue(os.path.exists(os.path.join(destdir,"local/bin/script.sh")))
+    self.assertTrue(os.path.islink(os.path.join(destdir,"local/lib/libfixture.so")))
+    self.assertFalse(os.path.lexists(os.path.join(destdir,"local/lib/libunused.so")))
+    self.assertFalse(os.path.lexists(os.path.join(destdir,"local/lib/libunused.so.1")))
+    self.assertFalse(os.path.lexists(os.path.join(destdir,env.DB_NAME)))
+    self.assertTrue(os.path.exists(os.path.join(destdir,
+                                                "local/lib/libfixture.so.1")))
+
+
+class _CompilingRecipe(_TestRecipe):
+    """Recipe whose "compiler" writes a fake ccache stats log."""
+    def build(self):
+        super(_CompilingRecipe,self).build()
+        log = "# one.c\ndirect_cache_hit\n# two.c\ncache_miss\n" \
+              "# three.c\npreprocessed_cache_hit\n"
+        self.target.do("sh","-c","printf '%s' >> $CCACHE_STATSLOG" % (log,))
+
+
+class TestCompilerCache(unittest.TestCase):
+
+  def setUp(self):
+    self.workdir = tempfile.mkdtemp()
+    bindir = os.path.join(self.workdir,"bin")
+    os.makedirs(bindir)
+    with open(os.path.join(bindir,"ccache"),"w") as f:
+        f.write("#!/bin/sh\n")
+    self._old_environ = os.environ.copy()
+    os.environ["PATH"] = bindir + ":" + os.environ.get("PATH","")
+    os.environ["MYPPY_CCACHE_DIR"] = os.path.join(self.workdir,"ccache")
+
+  def tearDown(self):
+    os.environ.clear()
+    os.environ.update(self._old_environ)
+    shutil.rmtree(self.workdir)
+
+  def test_ccache_setup(self):
+    envs = []
+    for nm in ("env1","env2"):
+        env = linux_envs.MyppyEnv(os.path.join(self.workdir,nm))
+        envs.append(env)
+        bindir = env.env["PATH"].split(":")[0]
+        self.assertEquals(bindir,os.path.join(env.cachedir,"ccache-bin"))
+        for compiler in ("lsbcc","lsbc++"):
+            self.assertEquals(os.readlink(os.path.join(bindir,compiler)),
+                              os.path.join(self.workdir,"bin","ccache"))
+        self.assertEquals(env.env["CCACHE_DIR"],
+                          os.path.join(self.workdir,"ccache"))
+        self.assertEquals(env.env["CCACHE_BASEDIR"],env.rootdir)
+        #  Recipes still see the plain LSB compiler.
+        self.assertEquals(env.CC,"lsbcc -m32")
+    #  Envs in different places can share the cache.
+    self.assertEquals(envs[0].env["CCACHE_COMPILERCHECK"],
+                      envs[1].env["CCACHE_COMPILERCHECK"])
+    envs[1].env["LSBCC_LIBS"] = "/somewhere/else"
+    envs[1]._setup_ccache()
+    self.assertNotEquals(envs[0].env["CCACHE_COMPILERCHECK"],
+                         envs[1].env["CCACHE_COMPILERCHECK"])
+
+  def test_ccache_stats(self):
+    env = linux_envs.MyppyEnv(os.path.join(self.workdir,"env"))
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        env._build_recipe("lib_compiled",_CompilingRecipe(env))
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    self.assertTrue("COMPILER CACHE FOR lib_compiled: 2 HITS, 1 MISSES (67%)"
+                    in output,output)
+    self.assertFalse("CCACHE_STATSLOG" in env.env)
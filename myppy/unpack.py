@@ -0,0 +1,381 @@
+#  Copyright (c) 2009-2010, Cloud Matrix Pty. Ltd.
+#  All rights reserved; available under the terms of the BSD License.
+"""
+
+  myppy.unpack:  unpack source archives, with a cache of extracted trees
+
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import bz2
+import copy
+import gzip
+import stat
+import errno
+import shutil
+import tarfile
+import zipfile
+import subprocess
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from myppy import util
+
+
+#  External decompressors to use if they're available, by file extension.
+#  Those for bzip2 and gzip are parallel, so faster than the tarfile module.
+DECOMPRESSORS = (
+    ((".tar.bz2",".tbz2",".tbz",),("lbzip2","pbzip2",)),
+    ((".tar.gz",".tgz",),("pigz",)),
+    ((".tar.xz",".txz",),("xz",)),
+    ((".tar.zst",),("zstd",)),
+    ((".tar.lz4",),("lz4",)),
+)
+
+#  Formats that tarballs can be recompressed into for faster unpacking,
+#  giving the extension and the command to compress into that format.
+RECOMPRESS_FORMATS = {
+    "zstd": (".tar.zst",["zstd","-q","-T0","-c"]),
+    "lz4": (".tar.lz4",["lz4","-q","-c"]),
+    "tar": (".tar",None),
+}
+
+#  Tarball formats that are slow enough to unpack to be worth recompressing.
+SLOW_FORMATS = (".tar.gz",".tgz",".tar.bz2",".tbz2",".tbz",".tar.xz",".txz",)
+
+#  Tarball formats that we can decompress without an external tool.
+NATIVE_FORMATS = (".tar",".tar.gz",".tgz",".tar.bz2",".tbz2",".tbz",)
+
+#  The linux ioctl for making a copy-on-write clone of a file.
+FICLONE = 0x40049409
+
+
+def _fsencode(path):
+    if isinstance(path,unicode):
+        path = path.encode(sys.getfilesystemencoding())
+    return path
+
+
+def _check_member_path(destdir,name):
+    """Check that an archive member would be extracted inside destdir."""
+    path = os.path.normpath(os.path.join(destdir,name))
+    if path != destdir and not path.startswith(os.path.join(destdir,"")):
+        raise ValueError("archive member outside of destdir: %s" % (name,))
+    return path
+
+
+def find_decompressor(src):
+    """Find an external decompressor for the given tarball, or None."""
+    for (exts,tools) in DECOMPRESSORS:
+        if src.endswith(exts):
+            for tool in tools:
+                if util.which(tool) is not None:
+                    return tool
+    return None
+
+
+def extract(src,destdir):
+    """Extract the given archive into destdir, without shelling out to tar.
+
+    Tarballs are read as a stream, through an external decompressor such as
+    pigz or pbzip2 if one can be found.  Archive members that would end up
+    outside of destdir cause a ValueError.
+    """
+    src = _fsencode(src)
+    destdir = os.path.normpath(_fsencode(destdir))
+    if not os.path.isdir(destdir):
+        os.makedirs(destdir)
+    if src.endswith(".zip"):
+        _extract_zip(src,destdir)
+        return
+    if find_decompressor(src) is None:
+        tar = tarfile.open(src,"r|*")
+        try:
+            _extract_tar(tar,destdir)
+        finally:
+            tar.close()
+        return
+    with _decompressed(src) as f:
+        tar = tarfile.open(fileobj=f,mode="r|")
+        try:
+            _extract_tar(tar,destdir)
+        finally:
+            tar.close()
+
+
+def recompress(src,dst,format):
+    """Recompress the tarball src into dst, in one of RECOMPRESS_FORMATS.
+
+    This returns False without doing anything if src isn't in one of the
+    SLOW_FORMATS, or if there's no way to decompress it.
+    """
+    src = _fsencode(src)
+    if not src.endswith(SLOW_FORMATS):
+        return False
+    if find_decompressor(src) is None and not src.endswith(NATIVE_FORMATS):
+        return False
+    (_,cmd) = RECOMPRESS_FORMATS[format]
+    tmpfile = "%s.tmp%d" % (dst,os.getpid(),)
+    try:
+        with _decompressed(src) as fIn:
+            with open(tmpfile,"wb") as fOut:
+                if cmd is None:
+                    shutil.copyfileobj(fIn,fOut,1024 * 512)
+                else:
+                    proc = subprocess.Popen(cmd,stdin=subprocess.PIPE,
+                                            stdout=fOut)
+                    try:
+                        shutil.copyfileobj(fIn,proc.stdin,1024 * 512)
+                    finally:
+                        proc.stdin.close()
+                        retcode = proc.wait()
+                    if retcode != 0:
+                        raise subprocess.CalledProcessError(retcode,cmd[0])
+        os.rename(tmpfile,dst)
+    except Exception:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        raise
+    return True
+
+
+@contextmanager
+def _decompressed(src):
+    """Context manager giving a stream of the decompressed tarball src."""
+    tool = find_decompressor(src)
+    if tool is None:
+        if src.endswith((".gz",".tgz",)):
+            f = gzip.GzipFile(src,"rb")
+        elif src.endswith((".bz2",".tbz2",".tbz",)):
+            f = bz2.BZ2File(src,"rb")
+        elif src.endswith(".tar"):
+            f = open(src,"rb")
+        else:
+            raise ValueError("can't decompress %s" % (src,))
+        try:
+            yield f
+        finally:
+            f.close()
+        return
+    proc = subprocess.Popen([tool,"-dc",src],stdout=subprocess.PIPE)
+    try:
+        yield proc.stdout
+        #  Read any trailing padding, so the decompressor exits cleanly.
+        while proc.stdout.read(1024 * 64):
+            pass
+    finally:
+        proc.stdout.close()
+        retcode = proc.wait()
+    if retcode != 0:
+        raise subprocess.CalledProcessError(retcode,tool)
+
+
+def _check_parent_dirs(destdir,path,safe):
+    """Check that no directory between destdir and path is a symlink.
+
+    Directories already known to be safe are kept in the given set.
+    """
+    dirpath = os.path.dirname(path)
+    todo = []
+    while dirpath not in safe and len(dirpath) > len(destdir):
+        todo.append(dirpath)
+        dirpath = os.path.dirname(dirpath)
+    for dirpath in todo:
+        if os.path.islink(dirpath):
+            raise ValueError("archive member inside symlink: %s" % (path,))
+    safe.update(todo)
+
+
+def _extract_tar(tar,destdir):
+    """Extract all members of a tarfile, which may be a stream.
+
+    Members that would be written outside of destdir, either directly or
+    through a symlink, cause a ValueError, as do links pointing outside it.
+    """
+    #  Like TarFile.extractall, create dirs writable and fix them up later.
+    dirs = []
+    safe = set()
+    for info in tar:
+        path = _check_member_path(destdir,info.name)
+        _check_parent_dirs(destdir,path,safe)
+        if info.islnk():
+            _check_member_path(destdir,info.linkname)
+        elif info.issym():
+            target = os.path.join(os.path.dirname(info.name),info.linkname)
+            _check_member_path(destdir,target)
+            #  It might be replacing a dir that we'd checked.
+            safe.clear()
+        if info.isdir():
+            dirs.append(info)
+            info = copy.copy(info)
+            info.mode = 0700
+        tar.extract(info,destdir)
+    dirs.sort(key=lambda info: info.name,reverse=True)
+    for info in dirs:
+        dirpath = os.path.join(destdir,info.name)
+        tar.chown(info,dirpath)
+        tar.utime(info,dirpath)
+        tar.chmod(info,dirpath)
+
+
+def _extract_zip(src,destdir):
+    """Extract all members of a zipfile, keeping their permissions."""
+    zf = zipfile.ZipFile(src)
+    try:
+        for info in zf.infolist():
+            path = _check_member_path(destdir,info.filename)
+            zf.extract(info,destdir)
+            mode = info.external_attr >> 16
+            if mode and not stat.S_ISLNK(mode):
+                os.chmod(path,stat.S_IMODE(mode))
+    finally:
+        zf.close()
+
+
+class SourceTreeCache(object):
+    """A cache of pristine trees extracted from source archives.
+
+    Each archive is extracted once, into a directory named for its sha256
+    hash, and later unpacks of that archive just clone the tree into place
+    using copy-on-write reflinks or hardlinks, falling back to a copy.
+
+    The size and mtime of every file in a tree are recorded when it's
+    extracted.  If any of them change (say, because a build wrote through
+    a hardlink) then the tree is thrown away and extracted again.
+    """
+
+    def __init__(self,cachedir):
+        self.cachedir = cachedir
+        self._can_reflink = (fcntl is not None)
+        self._can_link = True
+
+    def unpack(self,src,destdir,sha256=None):
+        """Unpack the given archive into destdir, extracting it if necessary.
+
+        If not given, the sha256 hash of the archive is calculated.
+        """
+        if sha256 is None:
+            sha256 = util.hashfile(src,("sha256",))[0]
+        src = _fsencode(src)
+        destdir = _fsencode(destdir)
+        treedir = os.path.join(_fsencode(self.cachedir),sha256)
+        files = self._load_manifest(treedir)
+        if files is not None:
+            print "CLONING SOURCE TREE", src
+            if self._clone(treedir,destdir,files):
+                return
+            print "STALE SOURCE TREE", treedir
+        print "UNPACKING", src
+        files = self._extract(src,treedir)
+        if not self._clone(treedir,destdir,files):
+            raise RuntimeError("source tree changed while cloning: %s" % (src,))
+
+    def _load_manifest(self,treedir):
+        """Load the recorded (size,mtime) of each file in a tree, or None."""
+        files = {}
+        try:
+            with open(treedir + ".files","rb") as f:
+                for ln in f:
+                    (size,mtime,relpath) = ln.rstrip("\n").split(" ",2)
+                    files[relpath] = (int(size),float(mtime))
+        except EnvironmentError, e:
+            if e.errno not in (errno.ENOENT,):
+                raise
+            return None
+        except ValueError:
+            return None
+        if not os.path.isdir(treedir):
+            return None
+        return files
+
+    def _extract(self,src,treedir):
+        """Extract an archive into the cache, returning its manifest."""
+        for path in (treedir,"%s.tmp%d" % (treedir,os.getpid(),)):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        tmpdir = "%s.tmp%d" % (treedir,os.getpid(),)
+        extract(src,tmpdir)
+        files = {}
+        todo = [""]
+        while todo:
+            reldir = todo.pop()
+            for (nm,st) in util.scandir(os.path.join(tmpdir,reldir)):
+                relpath = os.path.join(reldir,nm)
+                if stat.S_ISDIR(st.st_mode):
+                    todo.append(relpath)
+                elif stat.S_ISREG(st.st_mode):
+                    files[relpath] = (st.st_size,st.st_mtime)
+        os.rename(tmpdir,treedir)
+        with open(treedir + ".files.tmp","wb") as f:
+            for (relpath,(size,mtime)) in files.iteritems():
+                f.write("%d %r %s\n" % (size,mtime,relpath,))
+        os.rename(treedir + ".files.tmp",treedir + ".files")
+        return files
+
+    def _clone(self,treedir,destdir,files):
+        """Clone a cached tree into destdir, checking it against its manifest.
+
+        This returns False if the tree doesn't match the manifest.
+        """
+        dirs = []
+        seen = 0
+        todo = [""]
+        while todo:
+            reldir = todo.pop()
+            dstdir = os.path.join(destdir,reldir)
+            if not os.path.isdir(dstdir):
+                os.makedirs(dstdir)
+            for (nm,st) in util.scandir(os.path.join(treedir,reldir)):
+                relpath = os.path.join(reldir,nm)
+                srcpath = os.path.join(treedir,relpath)
+                dstpath = os.path.join(destdir,relpath)
+                if stat.S_ISDIR(st.st_mode):
+                    todo.append(relpath)
+                    dirs.append((dstpath,st.st_mode))
+                    continue
+                if os.path.lexists(dstpath) and not util.isrealdir(dstpath):
+                    os.unlink(dstpath)
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(srcpath),dstpath)
+                else:
+                    if files.get(relpath) != (st.st_size,st.st_mtime):
+                        return False
+                    self._clone_file(srcpath,dstpath)
+                    seen += 1
+        for (dstpath,mode) in dirs:
+            os.chmod(dstpath,stat.S_IMODE(mode))
+        return (seen == len(files))
+
+    def _clone_file(self,src,dst):
+        """Clone a single file by reflink, hardlink or copy."""
+        if self._can_reflink:
+            try:
+                with open(src,"rb") as fIn:
+                    with open(dst,"wb") as fOut:
+                        fcntl.ioctl(fOut.fileno(),FICLONE,fIn.fileno())
+            except EnvironmentError, e:
+                if e.errno not in (errno.EOPNOTSUPP,errno.ENOTTY,errno.EXDEV,
+                                   errno.EINVAL,errno.ENOSYS,):
+                    raise
+                self._can_reflink = False
+                os.unlink(dst)
+            else:
+                shutil.copystat(src,dst)
+                return
+        if self._can_link:
+            try:
+                os.link(src,dst)
+            except OSError, e:
+                if e.errno not in (errno.EXDEV,errno.EPERM,errno.EMLINK,):
+                    raise
+                self._can_link = False
+            else:
+                return
+        shutil.copy2(src,dst)
@@ -18,6 +18,14 @@ import hashlib
 import contextlib
 from fnmatch import fnmatch
 
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
 
 class tempdir:
     """Context manager for creating auto-removed temp dirs.
@@ -78,13 +86,37 @@ def which(name):
 
 def md5file(path):
     """Calculate md5 of given file."""
-    hash = hashlib.md5()
+    return hashfile(path,("md5",))[0]
+
+
+def sha1file(path):
+    """Calculate sha1 of given file."""
+    return hashfile(path,("sha1",))[0]
+
+
+def hashfile(path,algorithms=("md5","sha256",)):
+    """Calculate several hashes of given file, reading it only once.
+
+    This returns a list of hex digests, one for each of the named hashlib
+    algorithms.
+    """
+    hashes = [hashlib.new(nm) for nm in algorithms]
     with open(path,"rb") as f:
         chunk = f.read(1024*512)
         while chunk:
-            hash.update(chunk)
+            for hash in hashes:
+                hash.update(chunk)
             chunk = f.read(1024*512)
-    return hash.hexdigest()
+    return [hash.hexdigest() for hash in hashes]
+
+
+def parse_size(size):
+    """Parse a size in bytes, with an optional K, M or G suffix."""
+    size = size.strip().upper()
+    for (i,suffix) in enumerate("KMG"):
+        if size.endswith(suffix):
+            return int(float(size[:-1]) * 1024**(i+1))
+    return int(size)
 
 
 def do(*cmdline):
@@ -124,12 +156,12 @@ def relpath(path):
 
 
 def prune_dir(path):
-    """Remove a directory if it's empty."""
+    """Remove a directory if it's empty, returning True if it was removed."""
     try:
         os.rmdir(path)
     except EnvironmentError, e:
         if e.errno == errno.ENOTEMPTY:
-            pass
+            return False
         elif e.errno == errno.ENOTDIR:
             while path.endswith("/"):
                 path = path[:-1]
@@ -139,6 +171,7 @@ def prune_dir(path):
                 raise
         else:
             raise
+    return True
 
 
 def relpath_from(src,dst):
@@ -171,3 +204,29 @@ def isrealdir(path):
     """Check if path is a real directory, not a symlink to a directory."""
     return (os.path.isdir(path) and not os.path.islink(path))
 
+
+def scandir(path):
+    """Iterate over (name,stat) pairs for the entries in the given directory.
+
+    The stat results are as returned by os.lstat.  If an entry's name can't
+    be decoded using the filesystem encoding, its stat will be None.  This
+    uses the scandir module if it's available, and os.listdir if not.
+    """
+    if _scandir is not None:
+        for entry in _scandir(path):
+            if isinstance(path,unicode) and not isinstance(entry.name,unicode):
+                yield (entry.name,None)
+            else:
+                yield (entry.name,entry.stat(follow_symlinks=False))
+    else:
+        for nm in os.listdir(path):
+            try:
+                fpath = os.path.join(path,nm)
+            except UnicodeDecodeError:
+                yield (nm,None)
+            else:
+                try:
+                    yield (nm,os.lstat(fpath))
+                except OSError, e:
+                    if e.errno not in (errno.ENOENT,):
+                        raise